@@ -1,14 +1,56 @@
+from typing import Optional
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from starlette.requests import HTTPConnection
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
+from app.core.cache import TTLCache
+from app.core.cluster import cluster
 from app.core.config import settings
-from app.db.session import get_db
+from app.db.session import get_async_db
 from app.models.user import User
+from app.schemas.auth import Principal
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/auth/login")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# Authenticated principals by user id, so most requests skip the user lookup
+principal_cache = TTLCache(settings.AUTH_CACHE_MAX_SIZE, settings.AUTH_CACHE_TTL_SECONDS)
+
+def invalidate_principal(user_id):
+    """Forget a cached user, e.g. after their role changed or they were deleted"""
+    principal_cache.invalidate(user_id)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_changed_user(mapper, connection, target):
+    invalidate_principal(target.id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_users", {})[target.id] = target.username
+
+@event.listens_for(Session, "after_commit")
+def _broadcast_changed_users(session):
+    for user_id, username in session.info.pop("changed_users", {}).items():
+        # Again, in case a request cached the old row before the commit
+        invalidate_principal(user_id)
+        # Every worker caches users here, the MQTT broker by username
+        cluster.invalidate("user", {"id": user_id, "username": username})
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_changed_users(session, previous_transaction):
+    session.info.pop("changed_users", None)
+
+def _invalidate_remote_user(key):
+    if key is None:
+        principal_cache.clear()
+    else:
+        invalidate_principal(key["id"])
+
+cluster.on_invalidate("user", _invalidate_remote_user)
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -21,19 +63,47 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
-    except JWTError:
+        user_id = int(user_id)
+    except (JWTError, ValueError):
         raise credentials_exception
-    user = db.query(User).filter(User.id == user_id).first()
+
+    if settings.AUTH_TRUST_TOKEN_CLAIMS and "role" in payload and "username" in payload:
+        return Principal(id=user_id, username=payload["username"], role=payload["role"])
+
+    principal = principal_cache.get(user_id)
+    if principal is not None:
+        return principal
+
+    user = await db.get(User, user_id)
     if user is None:
         raise credentials_exception
-    return user
+    principal = Principal.model_validate(user)
+    principal_cache.set(user_id, principal)
+    return principal
 
-def get_current_active_user(current_user: User = Depends(get_current_user)):
+async def get_stream_user(
+    connection: HTTPConnection, token: Optional[str] = None, db: AsyncSession = Depends(get_async_db)
+):
+    """Authenticate a streaming client by `?token=` (browsers cannot set headers on
+    WebSocket or EventSource requests) or, failing that, the Authorization header"""
+    if token is None:
+        scheme, _, credentials = connection.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer":
+            token = credentials
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await get_current_user(token, db)
+
+async def get_current_active_user(current_user: User = Depends(get_current_user)):
     return current_user
 
-def get_current_admin_user(current_user: User = Depends(get_current_user)):
+async def get_current_admin_user(current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(
             status_code=403, detail="Not enough permissions"
         )
-    return current_user
\ No newline at end of file
+    return current_user
@@ -1,8 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from app.core.security import verify_password, create_access_token, create_refresh_token, get_password_hash
-from app.api.dependencies import get_db, get_current_admin_user
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.security import PasswordHasherBusy, access_token_claims, create_access_token, create_refresh_token, password_hasher
+from app.api.dependencies import get_async_db, get_current_admin_user
 from app.models.user import User
 from app.schemas.auth import Token
 from app.schemas.user import UserCreate, User as UserSchema
@@ -13,19 +14,34 @@ from app.core.config import settings
 router = APIRouter()
 
 
+def _hasher_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many concurrent password operations, retry shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
 @router.post("/login", response_model=Token)
-def login(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
+async def login(
+    form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    result = await db.execute(select(User).where(User.username == form_data.username))
+    user = result.scalars().first()
+    try:
+        valid = user is not None and await password_hasher.verify(
+            form_data.password, user.hashed_password
+        )
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token = create_access_token(data={"sub": str(user.id)})
+    access_token = create_access_token(data=access_token_claims(user))
     refresh_token = create_refresh_token(data={"sub": str(user.id)})
 
     return {
@@ -36,21 +52,21 @@ def login(
 
 
 @router.post("/refresh", response_model=Token)
-def refresh_token(token: str, db: Session = Depends(get_db)):
+async def refresh_token(token: str, db: AsyncSession = Depends(get_async_db)):
     try:
         payload = jwt.decode(
             token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]
         )
-        user_id = payload.get("sub")
-        user = db.query(User).filter(User.id == user_id).first()
+        user_id = int(payload.get("sub"))
+        user = await db.get(User, user_id)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token"
             )
 
-        new_access_token = create_access_token(data={"sub": str(user.id)})
+        new_access_token = create_access_token(data=access_token_claims(user))
         return {"access_token": new_access_token, "token_type": "bearer"}
-    except jwt.JWTError:
+    except (jwt.JWTError, TypeError, ValueError):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
         )
@@ -59,30 +75,42 @@ def refresh_token(token: str, db: Session = Depends(get_db)):
 @router.post(
     "/create-user", response_model=UserSchema, status_code=status.HTTP_201_CREATED
 )
-def create_user(
+async def create_user(
     user_create: UserCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     # current_user: User = Depends(
     #     get_current_admin_user
     # ),  # Ensures only admins can create users
 ):
     # Check if user with this username already exists
-    db_user = db.query(User).filter(User.username == user_create.username).first()
+    result = await db.execute(select(User).where(User.username == user_create.username))
+    db_user = result.scalars().first()
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered",
         )
 
+    try:
+        hashed_password = await password_hasher.hash(user_create.password)
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+
     # Create new user
     new_user = User(
         username=user_create.username,
-        hashed_password=get_password_hash(user_create.password),
+        hashed_password=hashed_password,
         role=user_create.role,
     )
 
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
 
     return new_user
+
+
+@router.get("/password-hasher/stats")
+def get_password_hasher_stats(current_user: User = Depends(get_current_admin_user)):
+    """Get queue and latency metrics for password hashing"""
+    return password_hasher.stats()
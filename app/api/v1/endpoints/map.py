@@ -0,0 +1,58 @@
+from typing import Optional
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from app.api.dependencies import get_current_active_user, get_current_admin_user
+from app.models.user import User
+from app.services.map_io import MapImportError, map_importer
+
+router = APIRouter()
+
+_MEDIA_TYPES = {"json": "application/json", "csv": "text/csv", "geojson": "application/geo+json"}
+
+def _format_of(request: Request):
+    content_type = request.headers.get("content-type", "")
+    for fmt, media_type in _MEDIA_TYPES.items():
+        if content_type.startswith(media_type):
+            return fmt
+    return "json"
+
+@router.post("/import")
+async def import_map(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(json|csv|geojson)$"),
+    replace: bool = False,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Upsert nodes and edges from a JSON, CSV or GeoJSON layout in one transaction"""
+    fmt = format or _format_of(request)
+    body = request.stream()
+
+    def chunks():
+        # Pull the upload from the event loop as the parser needs it
+        while True:
+            try:
+                yield anyio.from_thread.run(body.__anext__)
+            except StopAsyncIteration:
+                return
+
+    try:
+        return await run_in_threadpool(map_importer.import_layout, chunks(), fmt, replace)
+    except MapImportError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+@router.get("/export")
+def export_map(
+    format: str = Query("json", pattern="^(json|csv|geojson)$"),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Stream the whole warehouse layout as JSON, CSV or GeoJSON"""
+    return StreamingResponse(
+        map_importer.export_layout(format),
+        media_type=_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="warehouse-map.{format}"'},
+    )
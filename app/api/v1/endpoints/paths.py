@@ -0,0 +1,182 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from app.api.dependencies import get_current_active_user, get_current_admin_user
+from app.models.user import User
+from app.schemas.path import (
+    DistanceMatrixResult,
+    DistanceQuery,
+    NearestQuery,
+    NearestResult,
+    PathResult,
+    RobotReservations,
+    RouteBatch,
+    RouteBatchResult,
+)
+from app.services.distance_matrix import distance_matrix
+from app.services.graph import warehouse_graph
+from app.services.reservations import reservation_planner
+from app.services.spatial_index import spatial_index
+import math
+
+router = APIRouter()
+
+@router.get("", response_model=PathResult)
+def get_shortest_path(
+    source: int = Query(..., alias="from"),
+    target: int = Query(..., alias="to"),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get the shortest path between two nodes of the warehouse graph"""
+    try:
+        result = warehouse_graph.shortest_path(source, target)
+    except KeyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Node {e.args[0]} not found"
+        )
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No path from node {source} to node {target}"
+        )
+    nodes, distance = result
+    return {"source": source, "target": target, "nodes": nodes, "distance_cm": distance}
+
+@router.post("/distances", response_model=DistanceMatrixResult)
+def get_distances(
+    query: DistanceQuery,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get the distance from every source node to every target node in one call"""
+    try:
+        if distance_matrix is not None:
+            distances = distance_matrix.distances(query.sources, query.targets).tolist()
+        else:
+            distances = warehouse_graph.distances(query.sources, query.targets)
+    except KeyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Node {e.args[0]} not found"
+        )
+    return {
+        "sources": query.sources,
+        "targets": query.targets,
+        "distances": [
+            [None if math.isinf(distance) else distance for distance in row]
+            for row in distances
+        ],
+    }
+
+@router.post("/nearest", response_model=NearestResult)
+def get_nearest_nodes(
+    query: NearestQuery,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get the nodes nearest to each of a batch of coordinates"""
+    if query.k is None and query.radius is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Either k or radius is required"
+        )
+    if (query.k is not None and not 1 <= query.k <= 100) or (query.radius is not None and query.radius <= 0):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="k must be between 1 and 100 and radius positive"
+        )
+
+    if query.k is None:
+        matches = []
+        for point in query.points:
+            node_ids, distances = spatial_index.within(point.x, point.y, query.radius)
+            matches.append([
+                {"node_id": node_id, "distance": distance}
+                for node_id, distance in zip(node_ids, distances)
+            ])
+        return {"matches": matches}
+
+    node_ids, distances = spatial_index.nearest(
+        [point.x for point in query.points],
+        [point.y for point in query.points],
+        k=query.k,
+        max_distance=query.radius,
+    )
+    return {
+        "matches": [
+            [
+                {"node_id": node_id, "distance": distance}
+                for node_id, distance in zip(row_ids, row_distances)
+                if node_id >= 0
+            ]
+            for row_ids, row_distances in zip(node_ids.tolist(), distances.tolist())
+        ]
+    }
+
+@router.post("/reservations", response_model=RouteBatchResult)
+def plan_routes(
+    batch: RouteBatch,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Plan and reserve conflict-free routes for a batch of robots"""
+    try:
+        routes = reservation_planner.plan([request.model_dump() for request in batch.requests])
+    except ConnectionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+    return {
+        "planned": sum(route["status"] == "planned" for route in routes),
+        "routes": routes,
+    }
+
+@router.get("/reservations/stats")
+def get_reservation_stats(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Get reservation table sizes and planner counters"""
+    try:
+        return reservation_planner.stats()
+    except ConnectionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+
+@router.get("/reservations/{robot_id}", response_model=RobotReservations)
+def get_reservations(
+    robot_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get the remaining reserved route of a robot"""
+    try:
+        reservations = reservation_planner.reservations(robot_id)
+    except ConnectionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+    if reservations is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Robot {robot_id} has no reservations"
+        )
+    return {"robot_id": robot_id, "reservations": reservations}
+
+@router.delete("/reservations/{robot_id}")
+def release_reservations(
+    robot_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Release every reservation held by a robot"""
+    try:
+        released = reservation_planner.release(robot_id)
+    except ConnectionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+    if not released:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Robot {robot_id} has no reservations"
+        )
+    return {"status": "success", "detail": f"Reservations of robot {robot_id} released"}
@@ -1,8 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from app.api.dependencies import get_current_active_user
-from app.core.mqtt import mqtt_client
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.api.dependencies import (
+    get_async_db,
+    get_current_active_user,
+    get_current_admin_user,
+    get_stream_user,
+)
+from app.core.command_queue import CommandOutcome, CommandQueueFull, command_queue
+from app.core.mqtt import get_mqtt_client
+from app.core.telemetry import telemetry_store
+from app.models.telemetry import TelemetryRollup, TelemetrySample
 from app.models.user import User
-import json
+from app.schemas.robot import (
+    BulkCommand,
+    BulkCommandResult,
+    FleetStatus,
+    RobotHistory,
+    RobotStatus,
+    TelemetryPoint,
+)
+from app.services.fleet_stream import fleet_stream
+from app.services.telemetry_writer import telemetry_writer
+import fnmatch
 
 router = APIRouter()
 
@@ -12,29 +36,187 @@ def send_command(
     command: dict,
     current_user: User = Depends(get_current_active_user)
 ):
-    """Send a command to a specific robot"""
-    topic = f"robot/{robot_id}/commands"
-    success = mqtt_client.publish(topic, json.dumps(command), qos=1)
-    
-    if not success:
+    """Send a command to a specific robot, through its rate-limited command queue"""
+    try:
+        outcome = command_queue.submit(robot_id, command)
+    except CommandQueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e)
+        )
+
+    if outcome is CommandOutcome.FAILED:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to send command to robot"
         )
-    
-    return {"status": "success", "detail": f"Command sent to robot {robot_id}"}
 
-@router.get("/{robot_id}/status")
+    details = {
+        CommandOutcome.SENT: f"Command sent to robot {robot_id}",
+        CommandOutcome.QUEUED: f"Command queued for robot {robot_id}",
+        CommandOutcome.COALESCED: f"Command replaced a queued command for robot {robot_id}",
+        CommandOutcome.SUPERSEDED: f"Command dropped for a stop sent to robot {robot_id} meanwhile",
+    }
+    return {"status": "success", "delivery": outcome.value, "detail": details[outcome]}
+
+def _bulk_targets(bulk: BulkCommand):
+    targets = dict.fromkeys(bulk.robot_ids)
+    if bulk.topic_pattern is not None or bulk.zone is not None:
+        for robot in telemetry_store.snapshot():
+            robot_id = robot["robot_id"]
+            if bulk.topic_pattern is not None and fnmatch.fnmatchcase(
+                f"robot/{robot_id}/commands", bulk.topic_pattern
+            ):
+                targets[robot_id] = None
+            zone = bulk.zone
+            if zone is not None and (
+                zone.x_min <= robot["x"] <= zone.x_max and zone.y_min <= robot["y"] <= zone.y_max
+            ):
+                targets[robot_id] = None
+    return list(targets)
+
+@router.post("/commands/bulk", response_model=BulkCommandResult)
+async def send_bulk_command(
+    bulk: BulkCommand,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Send the same command to many robots at once"""
+    robot_ids = _bulk_targets(bulk)
+    if not robot_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No robots match the given ids, topic pattern or zone"
+        )
+
+    # Every command goes through its robot's queue, so nothing queued before
+    # it is published after it, and stops drop what is still queued
+    if bulk.wait_for_ack:
+        # Wait for all PUBACKs together, sharing one deadline
+        statuses = await run_in_threadpool(command_queue.deliver_many, robot_ids, bulk.command, bulk.timeout)
+    else:
+        outcomes = await run_in_threadpool(command_queue.submit_many, robot_ids, bulk.command)
+        statuses = ["rejected" if outcome is None else outcome.value for outcome in outcomes]
+    results = [{"robot_id": robot_id, "status": delivery} for robot_id, delivery in zip(robot_ids, statuses)]
+    delivered = sum(result["status"] in ("sent", "acked") for result in results)
+    return {"count": len(results), "delivered": delivered, "results": results}
+
+@router.get("/status", response_model=FleetStatus)
+def get_fleet_status(current_user: User = Depends(get_current_active_user)):
+    """Get the latest status of every robot that has reported telemetry"""
+    robots = telemetry_store.snapshot()
+    return {"count": len(robots), "robots": robots}
+
+@router.websocket("/stream")
+async def stream_fleet(
+    websocket: WebSocket,
+    max_fps: Optional[float] = Query(None, gt=0),
+    current_user: User = Depends(get_stream_user)
+):
+    """Push fleet updates: a snapshot first, then only the fields that changed"""
+    await websocket.accept()
+    frames = fleet_stream.subscribe(max_fps)
+    try:
+        async for frame in frames:
+            await websocket.send_text(frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await frames.aclose()
+
+@router.get("/stream/events")
+async def stream_fleet_events(
+    max_fps: Optional[float] = Query(None, gt=0),
+    current_user: User = Depends(get_stream_user)
+):
+    """Server-sent events version of the fleet stream"""
+    async def events():
+        async for frame in fleet_stream.subscribe(max_fps):
+            yield f"data: {frame}\n\n"
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+@router.get("/stream/stats")
+def get_stream_stats(current_user: User = Depends(get_current_admin_user)):
+    """Get viewer count and tick counters for the fleet stream"""
+    return fleet_stream.stats()
+
+@router.get("/commands/stats")
+def get_command_queue_stats(current_user: User = Depends(get_current_admin_user)):
+    """Get queue depth, coalescing and rate limit counters for robot commands"""
+    return command_queue.stats()
+
+@router.get("/ingest/stats")
+def get_ingest_stats(current_user: User = Depends(get_current_admin_user)):
+    """Get queue depth, drop and latency counters for each MQTT ingest lane"""
+    return get_mqtt_client().dispatcher.stats()
+
+@router.get("/telemetry/stats")
+def get_telemetry_writer_stats(current_user: User = Depends(get_current_admin_user)):
+    """Get buffer and flush counters for telemetry persistence"""
+    return telemetry_writer.stats()
+
+@router.get("/{robot_id}/status", response_model=RobotStatus)
 def get_robot_status(
     robot_id: str,
     current_user: User = Depends(get_current_active_user)
 ):
-    """
-    Get the latest status of a specific robot
-    Note: This is a placeholder. You'll need to implement a way to store
-    and retrieve the latest status from each robot.
-    """
-    # You could implement this using a database or in-memory cache
-    # that's updated whenever you receive messages on robot/{id}/position
-    
-    return {"status": "Robot status would be returned here"}
\ No newline at end of file
+    """Get the latest status of a specific robot"""
+    robot_status = telemetry_store.get(robot_id)
+    if robot_status is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No telemetry received from robot {robot_id}"
+        )
+    return robot_status
+
+_ROLLUP_RESOLUTIONS = {"1s": 1, "1m": 60}
+
+@router.get("/{robot_id}/history", response_model=RobotHistory)
+async def get_robot_history(
+    robot_id: str,
+    resolution: str = Query("1s", pattern="^(raw|1s|1m)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get the recorded positions of a robot, raw or downsampled to 1 s / 1 min buckets"""
+    if resolution == "raw":
+        query = select(TelemetrySample).where(TelemetrySample.robot_id == robot_id)
+        time_column = TelemetrySample.recorded_at
+    else:
+        query = select(TelemetryRollup).where(
+            TelemetryRollup.robot_id == robot_id,
+            TelemetryRollup.resolution == _ROLLUP_RESOLUTIONS[resolution],
+        )
+        time_column = TelemetryRollup.bucket_start
+    if since is not None:
+        query = query.where(time_column >= since)
+    if until is not None:
+        query = query.where(time_column < until)
+    rows = (await db.execute(query.order_by(time_column.desc()).limit(limit))).scalars().all()
+
+    if resolution == "raw":
+        points = [
+            TelemetryPoint(
+                recorded_at=row.recorded_at, x=row.x, y=row.y, battery=row.battery, node_id=row.node_id
+            )
+            for row in reversed(rows)
+        ]
+    else:
+        points = [
+            TelemetryPoint(
+                recorded_at=row.bucket_start,
+                x=row.x,
+                y=row.y,
+                battery=row.battery_sum / row.battery_samples if row.battery_samples else None,
+                node_id=row.node_id,
+                samples=row.samples,
+                battery_min=row.battery_min,
+            )
+            for row in reversed(rows)
+        ]
+    return {"robot_id": robot_id, "resolution": resolution, "count": len(points), "points": points}
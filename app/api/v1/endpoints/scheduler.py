@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Depends
+from app.api.dependencies import get_current_admin_user
+from app.models.user import User
+from app.services.scheduler import task_scheduler
+
+router = APIRouter()
+
+@router.post("/run")
+def run_scheduler(current_user: User = Depends(get_current_admin_user)):
+    """Assign pending tasks to idle robots now instead of waiting for the next batch"""
+    assignments = task_scheduler.run_once()
+    return {"count": len(assignments), "assignments": assignments}
@@ -0,0 +1,107 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.api.dependencies import get_async_db, get_current_active_user, get_current_admin_user
+from app.models.user import User
+from app.models.warhouse import Task, TaskEvent, TaskStatus
+from app.schemas.warhouse import Task as TaskSchema, TaskCreate, TaskHistory, TaskList
+from app.services.graph import warehouse_graph
+from app.services.task_engine import ACTIVE, TaskTransitionError, task_engine
+
+router = APIRouter()
+
+@router.post("", response_model=TaskSchema, status_code=status.HTTP_201_CREATED)
+def create_task(
+    task: TaskCreate,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Create a pending task between two nodes"""
+    known_nodes = warehouse_graph.snapshot().index
+    for node_id in (task.start_node_id, task.end_node_id):
+        if node_id not in known_nodes:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Node {node_id} not found"
+            )
+    try:
+        created = task_engine.create([(task.start_node_id, task.end_node_id)])
+    except ConnectionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+    return created[0]
+
+@router.get("", response_model=TaskList)
+async def list_tasks(
+    task_status: Optional[TaskStatus] = Query(None, alias="status"),
+    robot_id: Optional[int] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """List tasks by status and robot; active tasks are served from memory"""
+    if task_engine.authoritative and (task_status is None or task_status in ACTIVE):
+        tasks = task_engine.active(task_status, robot_id)[:limit]
+        return {"count": len(tasks), "tasks": tasks}
+
+    query = select(Task)
+    if task_status is not None:
+        query = query.where(Task.status == task_status)
+    else:
+        query = query.where(Task.status.in_(ACTIVE))
+    if robot_id is not None:
+        query = query.where(Task.robot_id == robot_id)
+    rows = (await db.execute(query.order_by(Task.id).limit(limit))).scalars().all()
+    return {"count": len(rows), "tasks": rows}
+
+@router.get("/stats")
+def get_task_stats(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Get active task counts and task engine counters"""
+    return task_engine.stats()
+
+@router.get("/{task_id}", response_model=TaskHistory)
+async def get_task(
+    task_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Get a task and its status history"""
+    task = task_engine.get(task_id) if task_engine.authoritative else None
+    if task is None:
+        task = await db.get(Task, task_id)
+        if task is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Task {task_id} not found"
+            )
+    events = (
+        await db.execute(
+            select(TaskEvent).where(TaskEvent.task_id == task_id).order_by(TaskEvent.recorded_at, TaskEvent.id)
+        )
+    ).scalars().all()
+    return {"task": task, "events": events}
+
+@router.post("/{task_id}/cancel", response_model=TaskSchema)
+async def cancel_task(
+    task_id: int,
+    reason: Optional[str] = None,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Fail a pending or in-progress task"""
+    try:
+        return await run_in_threadpool(task_engine.cancel, task_id, reason)
+    except TaskTransitionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
+    except ConnectionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
@@ -1,8 +1,12 @@
 from fastapi import APIRouter
-from app.api.v1.endpoints import auth, users, robots, led
+from app.api.v1.endpoints import auth, users, robots, led, paths, scheduler, tasks, map
 
 api_router = APIRouter()
 api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
 api_router.include_router(users.router, prefix="/users", tags=["users"])
 api_router.include_router(robots.router, prefix="/robots", tags=["robots"])
 api_router.include_router(led.router, prefix="/led", tags=["led"])
+api_router.include_router(paths.router, prefix="/paths", tags=["paths"])
+api_router.include_router(scheduler.router, prefix="/scheduler", tags=["scheduler"])
+api_router.include_router(tasks.router, prefix="/tasks", tags=["tasks"])
+api_router.include_router(map.router, prefix="/map", tags=["map"])
@@ -0,0 +1,407 @@
+import asyncio
+import base64
+import concurrent.futures
+import fcntl
+import itertools
+import json
+import logging
+import os
+
+from app.core.commands import CommandPublishError
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_payload(payload):
+    if isinstance(payload, str):
+        return {"payload": payload}
+    return {"payload": base64.b64encode(bytes(payload)).decode(), "binary": True}
+
+
+def _decode_payload(message):
+    if message.get("binary"):
+        return base64.b64decode(message["payload"])
+    return message["payload"]
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class Cluster:
+    """Leader election between the uvicorn workers of one host.
+
+    The leader is whichever worker holds an exclusive lock on
+    `<CLUSTER_DIR>/leader.lock`. The lock is held for the life of the process
+    and released by the kernel when it exits, so a follower that retries
+    takes over after a crash without any heartbeat protocol.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or settings.CLUSTER_DIR
+        self.is_leader = False
+        self._lock_file = None
+        # The LeaderServer on the leader, the LeaderLink on a connected follower
+        self.channel = None
+        self._invalidation_handlers = {}  # cache name -> [handler(key)]
+        self._request_handlers = {}  # op -> handler(message)
+
+    @property
+    def socket_path(self):
+        return os.path.join(self.directory, "leader.sock")
+
+    def try_lead(self):
+        """Become the leader if nobody else is; returns whether we are"""
+        if self.is_leader:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, "leader.lock"), "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._lock_file = lock_file
+        self.is_leader = True
+        logger.info(f"Worker {os.getpid()} is the cluster leader")
+        return True
+
+    def resign(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_leader = False
+        self.channel = None
+
+    def on_invalidate(self, cache, handler):
+        """Call `handler(key)` when another worker invalidates `cache`; a key
+        of None means the whole cache"""
+        self._invalidation_handlers.setdefault(cache, []).append(handler)
+
+    def invalidate(self, cache, key=None):
+        """Tell the other workers to drop (or update) their copy of `cache`.
+
+        `key` must be JSON serializable. Safe to call from any thread; does
+        nothing outside cluster mode or before this worker joined the cluster.
+        """
+        channel = self.channel
+        if channel is not None:
+            channel.send_invalidation(cache, key)
+
+    def invalidate_all_local(self):
+        """Drop every cache with an invalidation handler in this worker, e.g.
+        after (re)joining the cluster, when invalidations may have been missed"""
+        for cache in list(self._invalidation_handlers):
+            self.apply_invalidation({"cache": cache, "key": None})
+
+    def on_request(self, op, handler):
+        """Serve `op` requests from followers with `handler(message)` while
+        this worker leads. The handler runs in a thread and returns a JSON
+        serializable result; a ValueError it raises is passed back to the
+        follower as `RequestRejected`."""
+        self._request_handlers[op] = handler
+
+    def request(self, op, wait=0, **fields):
+        """Run `op` on the leader and return its result. Blocks, so call it
+        from worker threads. Raises ConnectionError if this worker is not a
+        connected follower or the leader does not answer in time; `wait`
+        adds seconds the handler itself may take on top of the timeout."""
+        channel = self.channel
+        if self.is_leader or not isinstance(channel, LeaderLink):
+            raise ConnectionError("Not connected to cluster leader")
+        return channel.request({"op": op, **fields}, wait)
+
+    def apply_invalidation(self, message):
+        for handler in self._invalidation_handlers.get(message.get("cache"), ()):
+            try:
+                handler(message.get("key"))
+            except Exception as e:
+                logger.exception(f"Error invalidating {message.get('cache')}: {e}")
+
+
+class RequestRejected(ValueError):
+    """The leader refused a request, e.g. one that does not fit its state"""
+
+
+class LeaderServer:
+    """Unix socket the leader serves so followers can publish through its
+    MQTT connection.
+
+    Requests and replies are newline-delimited JSON objects. Requests without
+    an `id` are fire-and-forget and get no reply. Cache invalidations travel
+    the same way: the leader sends its own to every follower and relays each
+    follower's to the others.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.loop = None
+        self._server = None
+        self._followers = set()  # stream writers
+
+    async def start(self, path):
+        self.loop = asyncio.get_running_loop()
+        # Only the lock holder gets here, so any socket file left is stale
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._serve, path=path)
+        logger.info(f"Cluster leader listening on {path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._followers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def send_invalidation(self, cache, key=None):
+        """Send an invalidation to every follower. Safe to call from any thread."""
+        if self.loop is not None:
+            message = {"op": "invalidate", "cache": cache, "key": key}
+            self.loop.call_soon_threadsafe(self._broadcast, message, None)
+
+    def _broadcast(self, message, origin):
+        line = json.dumps(message).encode() + b"\n"
+        for writer in list(self._followers):
+            if writer is not origin and not writer.is_closing():
+                writer.write(line)
+
+    async def _serve(self, reader, writer):
+        self._followers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    logger.warning("Invalid request from cluster follower")
+                    continue
+                if message.get("id") is None:
+                    self._handle_nowait(writer, message)
+                else:
+                    asyncio.create_task(self._reply(writer, message))
+        except ConnectionError:
+            pass
+        finally:
+            self._followers.discard(writer)
+            writer.close()
+
+    def _handle_nowait(self, writer, message):
+        op = message.get("op")
+        if op == "publish":
+            self.client.publish(
+                message["topic"], _decode_payload(message), message.get("qos", 1), message.get("retain", False)
+            )
+        elif op == "invalidate":
+            cluster.apply_invalidation(message)
+            self._broadcast(message, writer)
+
+    async def _reply(self, writer, message):
+        op = message.get("op")
+        reply = {"id": message["id"]}
+        try:
+            if op == "publish":
+                reply["result"] = self.client.publish(
+                    message["topic"], _decode_payload(message), message.get("qos", 1), message.get("retain", False)
+                )
+            elif op == "publish_async":
+                reply["result"] = await self.client.publish_async(
+                    message["topic"], _decode_payload(message), message.get("qos", 1), message.get("retain", False)
+                )
+            elif op == "command":
+                reply["result"] = await self.client.commands.send(
+                    message["robot_id"], message["command"], message.get("timeout"), message.get("qos", 1)
+                )
+            elif op in cluster._request_handlers:
+                handler = cluster._request_handlers[op]
+                reply["result"] = await asyncio.get_running_loop().run_in_executor(None, handler, message)
+            else:
+                reply["error"] = f"unknown operation {op}"
+        except asyncio.TimeoutError:
+            reply["error"] = "timeout"
+        except CommandPublishError as e:
+            reply["error"] = "publish"
+            reply["detail"] = str(e)
+        except ValueError as e:
+            reply["error"] = "rejected"
+            reply["detail"] = str(e)
+        except Exception as e:
+            logger.exception(f"Error handling cluster request {op}: {e}")
+            reply["error"] = str(e)
+        if not writer.is_closing():
+            writer.write(json.dumps(reply).encode() + b"\n")
+
+
+class LeaderLink:
+    """A follower's connection to the leader, with the publishing interface of
+    `MQTTClient` (`publish`, `publish_async` and `commands.send` as `command`).
+
+    `publish` waits for the leader's reply and returns whether the leader's
+    client accepted the message; `publish_forward` is the same as a future
+    for callers on the event loop, and the others return futures resolved by
+    the leader's reply. Invalidations the leader sends are applied here.
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout or settings.CLUSTER_REQUEST_TIMEOUT
+        self.loop = None
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}  # request id -> future
+        self._ids = itertools.count(1)
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._reader_task = self.loop.create_task(self._read(reader))
+        logger.info(f"Connected to cluster leader at {self.path}")
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            await self._reader_task
+            self._reader_task = None
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = json.loads(line)
+                if reply.get("op") == "invalidate":
+                    cluster.apply_invalidation(reply)
+                    continue
+                future = self._pending.pop(reply.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Lost connection to cluster leader: {e}")
+        finally:
+            self._writer = None
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Cluster leader connection lost"))
+
+    def _write(self, message):
+        if self.connected:
+            self._writer.write(json.dumps(message).encode() + b"\n")
+
+    def send_invalidation(self, cache, key=None):
+        """Send an invalidation to the leader, which passes it on to the other
+        followers. Safe to call from any thread."""
+        if self.connected:
+            message = {"op": "invalidate", "cache": cache, "key": key}
+            self.loop.call_soon_threadsafe(self._write, message)
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        """Publish through the leader and return whether its client accepted
+        the message. Safe to call from any thread; blocks until the leader
+        replies, or `CLUSTER_REQUEST_TIMEOUT`. On the link's own event loop
+        it cannot wait, so there it only enqueues the message and returns
+        whether the link is up; use `publish_forward` instead."""
+        if not self.connected:
+            logger.warning(f"Cannot publish to {topic}: Not connected to cluster leader")
+            return False
+        message = {"op": "publish", "topic": topic, "qos": qos, "retain": retain, **_encode_payload(payload)}
+        if _running_loop() is self.loop:
+            self._write(message)
+            return True
+        future = asyncio.run_coroutine_threadsafe(self._deliver(message), self.loop)
+        try:
+            return future.result(self.timeout + 1)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return False
+
+    def publish_forward(self, topic, payload, qos=1, retain=False):
+        """Future for whether the leader's client accepted the message. Must be
+        called from the link's event loop."""
+        message = {"op": "publish", "topic": topic, "qos": qos, "retain": retain, **_encode_payload(payload)}
+        return asyncio.ensure_future(self._deliver(message))
+
+    def request(self, message, wait=0):
+        """Send a request to the leader from a worker thread and return the
+        result of its handler; see `Cluster.request`"""
+        if not self.connected:
+            raise ConnectionError("Not connected to cluster leader")
+        timeout = self.timeout + wait
+        future = asyncio.run_coroutine_threadsafe(self._request(message, timeout), self.loop)
+        try:
+            reply = future.result(timeout + 1)
+        except (concurrent.futures.TimeoutError, asyncio.TimeoutError):
+            future.cancel()
+            raise ConnectionError(f"Cluster leader did not answer {message['op']} in time")
+        error = reply.get("error")
+        if error == "rejected":
+            raise RequestRejected(reply.get("detail") or error)
+        if error is not None:
+            raise RuntimeError(f"Cluster leader failed {message['op']}: {reply.get('detail') or error}")
+        return reply.get("result")
+
+    async def _deliver(self, message):
+        try:
+            reply = await self._request(message, self.timeout)
+        except (ConnectionError, asyncio.TimeoutError):
+            return False
+        return bool(reply.get("result"))
+
+    async def _request(self, message, timeout):
+        if not self.connected:
+            raise ConnectionError("Not connected to cluster leader")
+        request_id = next(self._ids)
+        future = self.loop.create_future()
+        self._pending[request_id] = future
+        self._write({**message, "id": request_id})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def publish_async(self, topic, payload, qos=1, retain=False):
+        message = {"op": "publish_async", "topic": topic, "qos": qos, "retain": retain, **_encode_payload(payload)}
+        return asyncio.ensure_future(self._deliver(message))
+
+    def command(self, robot_id, command, timeout=None, qos=1):
+        if timeout is None:
+            timeout = settings.MQTT_COMMAND_TIMEOUT
+        message = {"op": "command", "robot_id": robot_id, "command": command, "timeout": timeout, "qos": qos}
+
+        async def send():
+            try:
+                # Leave the leader room to report its own timeout first
+                reply = await self._request(message, timeout + self.timeout)
+            except ConnectionError as e:
+                raise CommandPublishError(f"Failed to publish command to robot {robot_id}: {e}")
+            error = reply.get("error")
+            if error == "timeout":
+                raise asyncio.TimeoutError()
+            if error is not None:
+                raise CommandPublishError(reply.get("detail") or error)
+            return reply["result"]
+
+        return asyncio.ensure_future(send())
+
+
+# Create a global cluster instance
+cluster = Cluster()
@@ -0,0 +1,284 @@
+import json
+import logging
+import math
+import struct
+import uuid
+
+import numpy as np
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Binary frames start with a byte that has the high bit set, which no JSON
+# document can, so the format is recognised from the first byte alone. The
+# low bits carry the schema version.
+BINARY_FLAG = 0x80
+VERSION = 1
+HEADER_BYTE = BINARY_FLAG | VERSION
+
+# Message types
+POSITION = 1
+STATE = 2
+COMMAND = 3
+
+# Every frame: header byte, message type, flags (little-endian)
+_HEADER = struct.Struct("<BBH")
+
+# Position: x, y, battery, node_id. Flags say which optional fields are set.
+POSITION_FRAME = struct.Struct("<BBHfffi")
+POSITION_HAS_BATTERY = 0x01
+POSITION_HAS_NODE = 0x02
+# Same layout for vectorized batch decoding
+POSITION_DTYPE = np.dtype(
+    [
+        ("header", "u1"),
+        ("type", "u1"),
+        ("flags", "<u2"),
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("battery", "<f4"),
+        ("node_id", "<i4"),
+    ]
+)
+
+# State reply: correlation id as 16 raw bytes
+STATE_FRAME = struct.Struct("<BBH16s")
+STATE_CHANGED = 0x01
+STATE_ON = 0x02
+STATE_SUCCESS = 0x04
+STATE_HAS_CID = 0x08
+
+# Command: correlation id, command code and up to three integer arguments
+COMMAND_FRAME = struct.Struct("<BBH16sB3xiii")
+COMMAND_HAS_CID = 0x01
+# Command name -> (code, argument names)
+COMMANDS = {
+    "on": (1, ()),
+    "off": (2, ()),
+    "stop": (3, ()),
+    "emergency_stop": (4, ()),
+    "assign_task": (5, ("task_id", "start_node_id", "end_node_id")),
+}
+_COMMAND_NAMES = {code: (name, args) for name, (code, args) in COMMANDS.items()}
+
+
+class DecodeError(ValueError):
+    """Raised for payloads that are neither valid JSON nor a valid binary frame"""
+
+
+def is_binary(payload):
+    return (
+        isinstance(payload, (bytes, bytearray, memoryview))
+        and len(payload) > 0
+        and payload[0] & BINARY_FLAG != 0
+    )
+
+
+def _check_header(payload, message_type, frame):
+    if len(payload) < frame.size or len(payload) % frame.size:
+        raise DecodeError(f"Binary frame has {len(payload)} bytes, expected a multiple of {frame.size}")
+    header, kind, _ = _HEADER.unpack_from(payload)
+    if header != HEADER_BYTE:
+        raise DecodeError(f"Unsupported binary schema version {header & ~BINARY_FLAG}")
+    if kind != message_type:
+        raise DecodeError(f"Expected message type {message_type}, got {kind}")
+
+
+def _json_object(payload):
+    try:
+        data = json.loads(payload)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise DecodeError(f"Invalid JSON payload: {e}")
+    if not isinstance(data, dict):
+        raise DecodeError("JSON payload is not an object")
+    return data
+
+
+def _optional(cast, value):
+    return None if value is None else cast(value)
+
+
+def iter_positions(payload):
+    """Yield (x, y, battery, node_id) for every position in a payload.
+
+    A binary payload may hold several frames back to back (oldest first);
+    they are unpacked straight from the buffer without slicing. Missing
+    optional fields are None.
+    """
+    if not is_binary(payload):
+        data = _json_object(payload)
+        try:
+            position = (
+                _optional(float, data.get("x")),
+                _optional(float, data.get("y")),
+                _optional(float, data.get("battery")),
+                _optional(int, data.get("node_id")),
+            )
+        except (TypeError, ValueError) as e:
+            raise DecodeError(f"Invalid position values: {e}")
+        yield position
+        return
+
+    _check_header(payload, POSITION, POSITION_FRAME)
+    for header, kind, flags, x, y, battery, node_id in POSITION_FRAME.iter_unpack(memoryview(payload)):
+        if header != HEADER_BYTE or kind != POSITION:
+            raise DecodeError("Mixed frame types in one position payload")
+        yield (
+            x,
+            y,
+            battery if flags & POSITION_HAS_BATTERY else None,
+            node_id if flags & POSITION_HAS_NODE else None,
+        )
+
+
+def decode_positions(payloads):
+    """Decode many binary position frames in one call.
+
+    Returns a structured NumPy array with the fields of `POSITION_DTYPE`
+    (check the flags for optional fields). Each payload may itself hold
+    several frames; all of them are viewed through a single joined buffer.
+    """
+    buffer = b"".join(payloads)
+    if len(buffer) % POSITION_FRAME.size:
+        raise DecodeError("Truncated binary position frame")
+    frames = np.frombuffer(buffer, dtype=POSITION_DTYPE)
+    if len(frames) and ((frames["header"] != HEADER_BYTE) | (frames["type"] != POSITION)).any():
+        raise DecodeError("Not all frames are version 1 position frames")
+    return frames
+
+
+def encode_position(x, y, battery=None, node_id=None):
+    flags = 0
+    if battery is not None:
+        flags |= POSITION_HAS_BATTERY
+    if node_id is not None:
+        flags |= POSITION_HAS_NODE
+    return POSITION_FRAME.pack(
+        HEADER_BYTE,
+        POSITION,
+        flags,
+        x,
+        y,
+        math.nan if battery is None else battery,
+        -1 if node_id is None else node_id,
+    )
+
+
+def decode_state(payload):
+    """Decode a state reply into the same dict the JSON firmware sends"""
+    if not is_binary(payload):
+        return _json_object(payload)
+    if len(payload) != STATE_FRAME.size:
+        raise DecodeError(f"State frame has {len(payload)} bytes, expected {STATE_FRAME.size}")
+    _check_header(payload, STATE, STATE_FRAME)
+    _, _, flags, cid = STATE_FRAME.unpack(payload)
+    state = {
+        "state": "on" if flags & STATE_ON else "off",
+        "status": "success" if flags & STATE_SUCCESS else "error",
+        "changed": bool(flags & STATE_CHANGED),
+    }
+    if flags & STATE_HAS_CID:
+        state["cid"] = cid.hex()
+    return state
+
+
+def encode_state(state, changed, cid=None, success=True):
+    flags = (STATE_ON if state == "on" else 0) | (STATE_CHANGED if changed else 0)
+    flags |= STATE_SUCCESS if success else 0
+    flags |= STATE_HAS_CID if cid is not None else 0
+    return STATE_FRAME.pack(
+        HEADER_BYTE, STATE, flags, uuid.UUID(hex=cid).bytes if cid is not None else bytes(16)
+    )
+
+
+def encode_command_binary(command):
+    """Binary frame for `command`, or None if it does not fit the schema"""
+    spec = COMMANDS.get(command.get("command"))
+    if spec is None:
+        return None
+    code, arg_names = spec
+    cid = command.get("cid")
+    if set(command) - {"command", "cid", *arg_names}:
+        return None
+    try:
+        args = [int(command[name]) for name in arg_names]
+        cid_bytes = uuid.UUID(hex=cid).bytes if cid is not None else bytes(16)
+    except (KeyError, TypeError, ValueError):
+        return None
+    args += [0] * (3 - len(args))
+    try:
+        return COMMAND_FRAME.pack(
+            HEADER_BYTE, COMMAND, COMMAND_HAS_CID if cid is not None else 0, cid_bytes, code, *args
+        )
+    except struct.error:
+        # An argument outside the frame's int32 range; JSON carries it as is
+        return None
+
+
+def decode_command(payload):
+    if not is_binary(payload):
+        return _json_object(payload)
+    if len(payload) != COMMAND_FRAME.size:
+        raise DecodeError(f"Command frame has {len(payload)} bytes, expected {COMMAND_FRAME.size}")
+    _check_header(payload, COMMAND, COMMAND_FRAME)
+    _, _, flags, cid, code, *args = COMMAND_FRAME.unpack(payload)
+    if code not in _COMMAND_NAMES:
+        raise DecodeError(f"Unknown command code {code}")
+    name, arg_names = _COMMAND_NAMES[code]
+    command = {"command": name, **dict(zip(arg_names, args))}
+    if flags & COMMAND_HAS_CID:
+        command["cid"] = cid.hex()
+    return command
+
+
+class PayloadCodec:
+    """Chooses the wire format of outgoing commands per robot.
+
+    Robots are assumed to speak JSON until they send a binary frame, after
+    which commands that fit the binary schema are sent to them in binary
+    (`MQTT_PAYLOAD_FORMAT=auto`). `json` and `binary` force one format for
+    everyone; commands the binary schema cannot express always go as JSON.
+    """
+
+    def __init__(self, payload_format=None):
+        self.payload_format = payload_format or settings.MQTT_PAYLOAD_FORMAT
+        self._binary_robots = set()
+
+    def observe(self, robot_id, payload):
+        """Note the format a robot used, from any payload it sent"""
+        if is_binary(payload):
+            self._binary_robots.add(robot_id)
+        else:
+            # Possibly reflashed with older firmware
+            self._binary_robots.discard(robot_id)
+
+    def speaks_binary(self, robot_id):
+        if self.payload_format == "binary":
+            return True
+        if self.payload_format == "json":
+            return False
+        return robot_id in self._binary_robots
+
+    def encode_command(self, robot_id, command):
+        if self.speaks_binary(robot_id):
+            frame = encode_command_binary(command)
+            if frame is not None:
+                return frame
+        return json.dumps(command)
+
+    def encode_many(self, robot_ids, command):
+        """Payloads of one command for many robots, encoding it once per format"""
+        encoded = {}
+        payloads = []
+        for robot_id in robot_ids:
+            binary = self.speaks_binary(robot_id)
+            payload = encoded.get(binary)
+            if payload is None:
+                payload = encoded[binary] = self.encode_command(robot_id, command)
+            payloads.append(payload)
+        return payloads
+
+
+# Create a global payload codec instance
+payload_codec = PayloadCodec()
@@ -0,0 +1,473 @@
+import concurrent.futures
+import enum
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.core.cluster import RequestRejected, cluster
+from app.core.codec import payload_codec
+from app.core.config import settings
+from app.core.metrics import command_outcomes
+from app.core.mqtt import get_mqtt_client
+
+logger = logging.getLogger(__name__)
+
+
+class CommandOutcome(str, enum.Enum):
+    SENT = "sent"  # published right away
+    QUEUED = "queued"  # waiting for the robot's rate limit
+    COALESCED = "coalesced"  # replaced a queued command of the same type
+    SUPERSEDED = "superseded"  # dropped for a priority command that overtook it
+    FAILED = "failed"  # the publish was rejected
+
+
+class CommandQueueFull(Exception):
+    """Raised when a robot already has `COMMAND_QUEUE_SIZE` commands waiting"""
+
+
+def _command_types(value):
+    return {kind.strip() for kind in value.split(",") if kind.strip()}
+
+
+def _resolve(delivery, result):
+    try:
+        if delivery is not None and not delivery.done():
+            delivery.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        # Settled or cancelled by another thread meanwhile
+        pass
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average and bursts of `burst`"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self, now):
+        """Seconds until `take` would succeed"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _RobotQueue:
+    __slots__ = ("bucket", "pending", "generation", "tickets", "serving", "turn")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.pending = OrderedDict()  # coalesce key -> (command, delivery), oldest first
+        # Bumped by every priority command; a command taken under an older
+        # generation is dropped instead of published
+        self.generation = 0
+        # Publishes go out in ticket order: tickets are handed out under the
+        # queue's lock, `serving` is the one whose turn it is
+        self.tickets = 0
+        self.serving = 0
+        self.turn = threading.Condition()
+
+    def ticket(self):
+        ticket = self.tickets
+        self.tickets += 1
+        return ticket
+
+    @property
+    def idle(self):
+        return not self.pending and self.serving == self.tickets
+
+
+class CommandQueue:
+    """Per-robot outbound queue in front of `MQTTClient.publish`.
+
+    Each robot gets a token bucket. A command is published at once while the
+    robot has tokens and nothing queued; otherwise it waits in the robot's
+    queue, where a newer command of the same type (its `command` field)
+    replaces the queued one in place, so a robot only ever receives the
+    latest of a burst of superseding commands. Priority commands (stop and
+    emergency stop by default) skip the queue and drop everything still
+    queued for that robot, since those commands were issued before the stop.
+    A background thread publishes queued commands as tokens become available.
+
+    Commands leave the queue under the lock but are published outside it, so
+    each one takes a per-robot ticket on the way out and waits for its turn
+    to publish: a robot's commands go out in the order they left the queue.
+    Priority commands also bump the robot's generation counter, and a
+    command taken under an older generation is dropped when its turn comes,
+    so nothing a stop superseded reaches the robot after it.
+
+    Every command to a robot goes through here, including bulk commands,
+    task assignments and LED control, so none of them can overtake one
+    still waiting in the queue. `deliver_many` also waits for the broker to
+    acknowledge each command.
+
+    With `CLUSTER_ENABLED=true` the queues live on the leader, and other
+    workers forward their commands to it, so the limits hold per robot
+    rather than per worker.
+    """
+
+    SWEEP_EVERY = 1000
+
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        max_depth=None,
+        coalesce_types=None,
+        priority_types=None,
+    ):
+        self.rate = settings.COMMAND_RATE_PER_SECOND if rate is None else rate
+        self.burst = settings.COMMAND_BURST if burst is None else burst
+        self.max_depth = max_depth or settings.COMMAND_QUEUE_SIZE
+        self.coalesce_types = _command_types(
+            settings.COMMAND_COALESCE_TYPES if coalesce_types is None else coalesce_types
+        )
+        self.priority_types = _command_types(
+            settings.COMMAND_PRIORITY_TYPES if priority_types is None else priority_types
+        )
+        self._queues = {}  # robot_id -> _RobotQueue
+        self._backlog = {}  # robot_id -> None, robots with queued commands
+        self._sequence = itertools.count()  # keys for commands that never coalesce
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._running = False
+
+        # Counters
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self.rejected = 0
+        self.failed = 0
+        self.priority = 0
+        self.depth = 0
+        self.max_depth_seen = 0
+
+    @property
+    def limited(self):
+        """Whether commands are rate limited; a rate or burst of 0 turns it off"""
+        return self.rate > 0 and self.burst >= 1
+
+    @property
+    def forwarding(self):
+        """Whether commands go to the cluster leader's queue instead of ours"""
+        return settings.CLUSTER_ENABLED and not cluster.is_leader
+
+    def _coalesces(self, kind):
+        return kind is not None and ("*" in self.coalesce_types or kind in self.coalesce_types)
+
+    def submit(self, robot_id, command):
+        """Publish `command` to a robot now, or queue it behind the robot's rate limit.
+
+        Returns a `CommandOutcome`; raises `CommandQueueFull` when the robot's
+        queue is full.
+        """
+        if self.forwarding:
+            try:
+                return CommandOutcome(cluster.request("submit_command", robot_id=robot_id, command=command))
+            except RequestRejected as e:
+                raise CommandQueueFull(str(e))
+            except ConnectionError as e:
+                logger.warning(f"Cannot send command to robot {robot_id}: {e}")
+                return CommandOutcome.FAILED
+        return self._submit(robot_id, command)
+
+    def _submit(self, robot_id, command, delivery=None):
+        """`submit` to this worker's queues. `delivery`, a
+        `concurrent.futures.Future`, resolves to True once the broker
+        acknowledged the command and to False if it failed or was dropped."""
+        kind = command.get("command") if isinstance(command, dict) else None
+        if isinstance(kind, (dict, list)):
+            kind = None
+        now = time.monotonic()
+        with self._lock:
+            self.submitted += 1
+            if self.submitted % self.SWEEP_EVERY == 0:
+                self._sweep(now)
+            queue = self._queues.get(robot_id)
+            if queue is None:
+                queue = self._queues[robot_id] = _RobotQueue(TokenBucket(self.rate, self.burst, now))
+
+            generation = None
+            if kind in self.priority_types:
+                self.priority += 1
+                queue.generation += 1
+                if queue.pending:
+                    self.superseded += len(queue.pending)
+                    self.depth -= len(queue.pending)
+                    for _, dropped in queue.pending.values():
+                        _resolve(dropped, False)
+                    queue.pending.clear()
+                    self._backlog.pop(robot_id, None)
+                if self.limited:
+                    queue.bucket.take(now)
+                outcome = CommandOutcome.SENT
+            elif not queue.pending and (not self.limited or queue.bucket.take(now)):
+                generation = queue.generation
+                outcome = CommandOutcome.SENT
+            else:
+                key = kind if self._coalesces(kind) else next(self._sequence)
+                if key in queue.pending:
+                    _resolve(queue.pending[key][1], False)
+                    queue.pending[key] = (command, delivery)
+                    self.coalesced += 1
+                    outcome = CommandOutcome.COALESCED
+                elif len(queue.pending) >= self.max_depth:
+                    self.rejected += 1
+                    command_outcomes.labels("rejected").inc()
+                    _resolve(delivery, False)
+                    raise CommandQueueFull(
+                        f"Robot {robot_id} already has {len(queue.pending)} commands queued"
+                    )
+                else:
+                    queue.pending[key] = (command, delivery)
+                    self.depth += 1
+                    self.max_depth_seen = max(self.max_depth_seen, len(queue.pending))
+                    self._backlog[robot_id] = None
+                    outcome = CommandOutcome.QUEUED
+                    self._ensure_running()
+                    self._wakeup.notify()
+            if outcome is CommandOutcome.SENT:
+                ticket = queue.ticket()
+
+        if outcome is CommandOutcome.SENT:
+            published = self._publish(robot_id, queue, ticket, command, generation, delivery)
+            if published is None:
+                outcome = CommandOutcome.SUPERSEDED
+            elif not published:
+                outcome = CommandOutcome.FAILED
+        command_outcomes.labels(outcome.value).inc()
+        return outcome
+
+    def submit_many(self, robot_ids, command):
+        """`submit` the same command to many robots; returns one outcome per
+        robot, None for those whose queue is full"""
+        if self.forwarding:
+            try:
+                outcomes = cluster.request("submit_commands", robot_ids=robot_ids, command=command)
+            except ConnectionError as e:
+                logger.warning(f"Cannot send command to {len(robot_ids)} robots: {e}")
+                return [CommandOutcome.FAILED] * len(robot_ids)
+            return [None if outcome is None else CommandOutcome(outcome) for outcome in outcomes]
+        outcomes = []
+        for robot_id in robot_ids:
+            try:
+                outcomes.append(self.submit(robot_id, command))
+            except CommandQueueFull:
+                outcomes.append(None)
+        return outcomes
+
+    def deliver_many(self, robot_ids, command, timeout):
+        """`submit_many` and wait up to `timeout` seconds in all for the broker
+        to acknowledge each command. Returns one status per robot: "acked",
+        "failed", "superseded", "timeout" (still queued or unacknowledged)
+        or "rejected" (queue full). Blocks, so call it from worker threads."""
+        if self.forwarding:
+            try:
+                return cluster.request(
+                    "deliver_commands", wait=timeout, robot_ids=robot_ids, command=command, timeout=timeout
+                )
+            except ConnectionError as e:
+                logger.warning(f"Cannot send command to {len(robot_ids)} robots: {e}")
+                return ["failed"] * len(robot_ids)
+        deadline = time.monotonic() + timeout
+        outcomes = []
+        deliveries = []
+        for robot_id in robot_ids:
+            delivery = concurrent.futures.Future()
+            try:
+                outcomes.append(self._submit(robot_id, command, delivery))
+            except CommandQueueFull:
+                outcomes.append(None)
+            deliveries.append(delivery)
+        concurrent.futures.wait(deliveries, timeout=max(0.0, deadline - time.monotonic()))
+
+        statuses = []
+        for outcome, delivery in zip(outcomes, deliveries):
+            if outcome is None:
+                statuses.append("rejected")
+            elif outcome is CommandOutcome.SUPERSEDED:
+                statuses.append("superseded")
+            elif not delivery.done():
+                # Nobody waits for it any more; a queued command still goes out
+                delivery.cancel()
+                statuses.append("timeout")
+            else:
+                statuses.append("acked" if delivery.result() else "failed")
+        return statuses
+
+    def _submit_request(self, message):
+        """Cluster handler for commands submitted in other workers"""
+        try:
+            return self.submit(message["robot_id"], message["command"]).value
+        except CommandQueueFull as e:
+            raise RequestRejected(str(e))
+
+    def _submit_many_request(self, message):
+        outcomes = self.submit_many(message["robot_ids"], message["command"])
+        return [None if outcome is None else outcome.value for outcome in outcomes]
+
+    def _deliver_many_request(self, message):
+        return self.deliver_many(message["robot_ids"], message["command"], message["timeout"])
+
+    def _publish(self, robot_id, queue, ticket, command, generation=None, delivery=None):
+        """Publish a command once `ticket` is served. Returns whether the client
+        accepted it, or None if a priority command superseded it since it was
+        taken under `generation`."""
+        published = False
+        try:
+            with queue.turn:
+                while queue.serving != ticket:
+                    queue.turn.wait()
+                try:
+                    if generation is not None and generation != queue.generation:
+                        published = None
+                    else:
+                        published = get_mqtt_client().publish(
+                            f"robot/{robot_id}/commands",
+                            payload_codec.encode_command(robot_id, command),
+                            qos=1,
+                            future=delivery,
+                        )
+                finally:
+                    queue.serving += 1
+                    queue.turn.notify_all()
+        finally:
+            if not published:
+                _resolve(delivery, False)
+            with self._lock:
+                if published is None:
+                    self.superseded += 1
+                elif published:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+        return published
+
+    def _sweep(self, now):
+        # A robot with nothing queued and a full bucket is indistinguishable
+        # from one never seen, so ids from one-off requests do not pile up
+        idle = [
+            robot_id
+            for robot_id, queue in self._queues.items()
+            if queue.idle and queue.bucket.full(now)
+        ]
+        for robot_id in idle:
+            del self._queues[robot_id]
+
+    def _ensure_running(self):
+        # Called with the lock held; the thread only exists once something waits
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="command-queue", daemon=True)
+            self._thread.start()
+
+    def _next_ready(self):
+        """Pop one command from every backlogged robot that has a token, or
+        return the seconds until the first one will. Called with the lock held."""
+        now = time.monotonic()
+        ready = []
+        wait = None
+        for robot_id in list(self._backlog):
+            queue = self._queues[robot_id]
+            if queue.bucket.take(now):
+                _, (command, delivery) = queue.pending.popitem(last=False)
+                self.depth -= 1
+                ready.append((robot_id, queue, queue.ticket(), queue.generation, command, delivery))
+                if not queue.pending:
+                    del self._backlog[robot_id]
+            else:
+                robot_wait = queue.bucket.wait(now)
+                wait = robot_wait if wait is None else min(wait, robot_wait)
+        return ready, wait
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    if not self._running:
+                        return
+                    ready, wait = self._next_ready()
+                    if ready:
+                        break
+                    self._wakeup.wait(wait)
+            for robot_id, queue, ticket, generation, command, delivery in ready:
+                try:
+                    if self._publish(robot_id, queue, ticket, command, generation, delivery) is False:
+                        logger.warning(f"Failed to publish queued command to robot {robot_id}")
+                except Exception as e:
+                    logger.exception(f"Error publishing queued command to robot {robot_id}: {e}")
+
+    def stop(self):
+        """Stop the publishing thread; commands still queued are dropped"""
+        if self._thread is not None:
+            with self._lock:
+                self._running = False
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self.depth:
+                logger.warning(f"Dropped {self.depth} queued robot commands on shutdown")
+            for robot_id in self._backlog:
+                pending = self._queues[robot_id].pending
+                for _, delivery in pending.values():
+                    _resolve(delivery, False)
+                pending.clear()
+            self._backlog = {}
+            self.depth = 0
+
+    def queued(self, robot_id):
+        with self._lock:
+            queue = self._queues.get(robot_id)
+            return [command for command, _ in queue.pending.values()] if queue is not None else []
+
+    def stats(self):
+        with self._lock:
+            by_robot = {
+                robot_id: len(self._queues[robot_id].pending) for robot_id in self._backlog
+            }
+            return {
+                "rate_per_second": self.rate,
+                "burst": self.burst,
+                "max_queue_size": self.max_depth,
+                "robots": len(self._queues),
+                "depth": self.depth,
+                "max_depth": self.max_depth_seen,
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "superseded": self.superseded,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "priority": self.priority,
+                "queued_by_robot": by_robot,
+            }
+
+
+# Create a global command queue instance
+command_queue = CommandQueue()
+cluster.on_request("submit_command", command_queue._submit_request)
+cluster.on_request("submit_commands", command_queue._submit_many_request)
+cluster.on_request("deliver_commands", command_queue._deliver_many_request)
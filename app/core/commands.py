@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import uuid
+from collections import deque
+
+from app.core.codec import DecodeError, decode_state, payload_codec
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CommandPublishError(Exception):
+    """Raised when a command could not be handed to the MQTT broker"""
+
+
+class _PendingCommand:
+    __slots__ = ("loop", "future", "robot_id", "timer")
+
+    def __init__(self, loop, future, robot_id):
+        self.loop = loop
+        self.future = future
+        self.robot_id = robot_id
+        self.timer = None
+
+
+class CommandCorrelator:
+    """Match `robot/<id>/state` replies to the commands that triggered them.
+
+    Every command is published with a `cid` correlation id and the caller gets
+    an asyncio future that resolves with the reply payload, or fails with
+    `asyncio.TimeoutError` once the timeout expires. Waiting costs one timer
+    handle per command, so nothing polls and no thread is blocked. Replies
+    without a `cid` (older firmware) resolve the oldest outstanding command
+    for that robot.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._pending = {}  # correlation id -> _PendingCommand
+        self._by_robot = {}  # robot_id -> deque of correlation ids, oldest first
+
+    def __len__(self):
+        return len(self._pending)
+
+    def send(self, robot_id, command, timeout=None, qos=1):
+        """Publish `command` to a robot and return a future for its reply.
+
+        The command goes through the robot's command queue (which publishes
+        with QoS 1), so the timeout also covers time spent waiting there.
+        Must be called from the event loop the future should resolve on.
+        """
+        if self.client.remote is not None:
+            return self.client.remote.command(robot_id, command, timeout, qos)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        cid = uuid.uuid4().hex
+        entry = _PendingCommand(loop, future, robot_id)
+
+        self._pending[cid] = entry
+        self._by_robot.setdefault(robot_id, deque()).append(cid)
+
+        # Imported here, since the command queue publishes through the client
+        # that owns this correlator
+        from app.core.command_queue import CommandOutcome, CommandQueueFull, command_queue
+
+        try:
+            outcome = command_queue.submit(robot_id, {**command, "cid": cid})
+        except CommandQueueFull:
+            outcome = CommandOutcome.FAILED
+        if outcome in (CommandOutcome.FAILED, CommandOutcome.SUPERSEDED):
+            self._discard(cid)
+            future.set_exception(
+                CommandPublishError(f"Failed to publish command to robot {robot_id}")
+            )
+            return future
+
+        if timeout is None:
+            timeout = settings.MQTT_COMMAND_TIMEOUT
+        entry.timer = loop.call_later(timeout, self._expire, cid)
+        return future
+
+    def handle_state(self, robot_id, payload):
+        """Resolve the command a state reply belongs to. Called from the MQTT thread."""
+        payload_codec.observe(robot_id, payload)
+        try:
+            data = decode_state(payload)
+        except DecodeError:
+            logger.warning(f"Invalid state payload from robot {robot_id}")
+            return
+
+        cid = data.get("cid") if isinstance(data, dict) else None
+        if cid is not None:
+            entry = self._discard(cid)
+        else:
+            entry = self._pop_oldest(robot_id)
+
+        if entry is None:
+            logger.debug(f"No pending command for state reply from robot {robot_id}")
+            return
+        entry.loop.call_soon_threadsafe(self._resolve, entry, data)
+
+    def _discard(self, cid):
+        entry = self._pending.pop(cid, None)
+        if entry is not None:
+            queue = self._by_robot.get(entry.robot_id)
+            if queue is not None:
+                try:
+                    queue.remove(cid)
+                except ValueError:
+                    pass
+        return entry
+
+    def _pop_oldest(self, robot_id):
+        queue = self._by_robot.get(robot_id)
+        while queue:
+            try:
+                cid = queue.popleft()
+            except IndexError:
+                return None
+            entry = self._pending.pop(cid, None)
+            if entry is not None:
+                return entry
+        return None
+
+    def _resolve(self, entry, data):
+        if entry.timer is not None:
+            entry.timer.cancel()
+        if not entry.future.done():
+            entry.future.set_result(data)
+
+    def _expire(self, cid):
+        entry = self._discard(cid)
+        if entry is not None and not entry.future.done():
+            entry.future.set_exception(asyncio.TimeoutError())
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 
@@ -11,13 +12,129 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     REFRESH_TOKEN_EXPIRE_DAYS: int = 7
+    # bcrypt runs on a process pool; extra requests get 503 instead of queueing
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+    PASSWORD_HASH_MAX_PENDING: int = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32))
+    # Authenticated users are cached for this long, and dropped early when
+    # their role changes or they are deleted
+    AUTH_CACHE_TTL_SECONDS: float = float(os.getenv("AUTH_CACHE_TTL_SECONDS", 60))
+    AUTH_CACHE_MAX_SIZE: int = int(os.getenv("AUTH_CACHE_MAX_SIZE", 10000))
+    # Trust the role embedded in access tokens and skip the user lookup entirely.
+    # Role changes and deletions then take effect only when the token expires.
+    AUTH_TRUST_TOKEN_CLAIMS: bool = os.getenv("AUTH_TRUST_TOKEN_CLAIMS", "false").lower() == "true"
     DATABASE_URL: str = os.getenv("DATABASE_URL")
+    # Defaults to DATABASE_URL with the asyncpg driver
+    ASYNC_DATABASE_URL: Optional[str] = os.getenv("ASYNC_DATABASE_URL")
+
+    # Connection pool Settings (applied to both the sync and async engines)
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", 20))
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
     
      # MQTT Settings
     MQTT_BROKER: str = os.getenv("MQTT_BROKER", "mosquitto")
     MQTT_PORT: int = int(os.getenv("MQTT_PORT", 1883))
     MQTT_USERNAME: str = os.getenv("MQTT_USERNAME", "admin")
     MQTT_PASSWORD: str = os.getenv("MQTT_PASSWORD", "1107")
+    # "paho" runs the network loop in a background thread, "asyncio" on the
+    # app's event loop, "embedded" hosts the broker in-process
+    MQTT_TRANSPORT: str = os.getenv("MQTT_TRANSPORT", "paho")
+    # "embedded" runs a broker inside the app instead of connecting to one
+    MQTT_EMBEDDED_HOST: str = os.getenv("MQTT_EMBEDDED_HOST", "0.0.0.0")
+    MQTT_EMBEDDED_MAX_BUFFER: int = int(os.getenv("MQTT_EMBEDDED_MAX_BUFFER", 1024 * 1024))
+    MQTT_ALLOW_ANONYMOUS: bool = os.getenv("MQTT_ALLOW_ANONYMOUS", "false").lower() == "true"
+    MQTT_AUTH_CACHE_TTL_SECONDS: float = float(os.getenv("MQTT_AUTH_CACHE_TTL_SECONDS", 300))
+    # The embedded broker only accepts MQTT_USERNAME/MQTT_PASSWORD when both
+    # were set explicitly, never the built-in defaults above
+    MQTT_CREDENTIALS_SET: bool = bool(os.getenv("MQTT_USERNAME") and os.getenv("MQTT_PASSWORD"))
+    # Failed CONNECTs allowed per client address and minute before the broker
+    # refuses that address without checking credentials
+    MQTT_AUTH_FAILURES_PER_MINUTE: int = int(os.getenv("MQTT_AUTH_FAILURES_PER_MINUTE", 10))
+    # CONNECTs checking a password at once; the rest of the hash pool is left
+    # to HTTP logins
+    MQTT_AUTH_MAX_PENDING: int = int(os.getenv("MQTT_AUTH_MAX_PENDING", 16))
+    # Command wire format: "auto" answers each robot in the format it sends,
+    # "json" or "binary" force one format for all robots
+    MQTT_PAYLOAD_FORMAT: str = os.getenv("MQTT_PAYLOAD_FORMAT", "auto")
+    MQTT_CONNECT_TIMEOUT: float = float(os.getenv("MQTT_CONNECT_TIMEOUT", 10))
+    MQTT_RECONNECT_MIN_DELAY: float = float(os.getenv("MQTT_RECONNECT_MIN_DELAY", 1))
+    MQTT_RECONNECT_MAX_DELAY: float = float(os.getenv("MQTT_RECONNECT_MAX_DELAY", 60))
+    MQTT_COMMAND_TIMEOUT: float = float(os.getenv("MQTT_COMMAND_TIMEOUT", 3))
+    MQTT_DISPATCH_WORKERS: int = int(os.getenv("MQTT_DISPATCH_WORKERS", 4))
+    MQTT_DISPATCH_QUEUE_SIZE: int = int(os.getenv("MQTT_DISPATCH_QUEUE_SIZE", 10000))
+    # Ingest policy per lane: "coalesce", "drop_oldest" or "block"
+    MQTT_TELEMETRY_POLICY: str = os.getenv("MQTT_TELEMETRY_POLICY", "coalesce")
+    MQTT_ACK_POLICY: str = os.getenv("MQTT_ACK_POLICY", "block")
+
+    # Command queue Settings
+    # Token bucket per robot for POST /robots/{robot_id}/command (0 disables limiting)
+    COMMAND_RATE_PER_SECOND: float = float(os.getenv("COMMAND_RATE_PER_SECOND", 5))
+    COMMAND_BURST: int = int(os.getenv("COMMAND_BURST", 5))
+    # Commands waiting per robot beyond which new ones are rejected
+    COMMAND_QUEUE_SIZE: int = int(os.getenv("COMMAND_QUEUE_SIZE", 32))
+    # Comma-separated `command` values; a newer queued command of one of these
+    # types replaces the older one ("*" for every type, empty for none)
+    COMMAND_COALESCE_TYPES: str = os.getenv("COMMAND_COALESCE_TYPES", "*")
+    # Sent at once, bypassing the rate limit and dropping the robot's queue
+    COMMAND_PRIORITY_TYPES: str = os.getenv("COMMAND_PRIORITY_TYPES", "stop,emergency_stop,estop")
+
+    # Path planning Settings
+    # Centimeters per node coordinate unit, used to scale the A* heuristic
+    GRAPH_COORDINATE_SCALE: float = float(os.getenv("GRAPH_COORDINATE_SCALE", 1.0))
+    # Precomputed all-pairs distances, memory-mapped and shared by all workers
+    DISTANCE_MATRIX_ENABLED: bool = os.getenv("DISTANCE_MATRIX_ENABLED", "false").lower() == "true"
+    DISTANCE_MATRIX_PATH: str = os.getenv("DISTANCE_MATRIX_PATH", "/tmp/nest/distance-matrix")
+    # Multi-robot reservations: time step, travel speed, and search limits
+    # that bound planning time per request
+    RESERVATION_STEP_SECONDS: float = float(os.getenv("RESERVATION_STEP_SECONDS", 1.0))
+    ROBOT_SPEED_CM_S: float = float(os.getenv("ROBOT_SPEED_CM_S", 50))
+    RESERVATION_HORIZON_STEPS: int = int(os.getenv("RESERVATION_HORIZON_STEPS", 600))
+    RESERVATION_MAX_EXPANSIONS: int = int(os.getenv("RESERVATION_MAX_EXPANSIONS", 20000))
+    # Grid cell size of the nearest-node index, in coordinate units (0 = automatic)
+    SPATIAL_CELL_SIZE: float = float(os.getenv("SPATIAL_CELL_SIZE", 0))
+    # Positions further than this from every node are not snapped to one (0 = no limit)
+    SPATIAL_SNAP_DISTANCE: float = float(os.getenv("SPATIAL_SNAP_DISTANCE", 0))
+
+    # Task scheduler Settings
+    SCHEDULER_ENABLED: bool = os.getenv("SCHEDULER_ENABLED", "false").lower() == "true"
+    SCHEDULER_INTERVAL_SECONDS: float = float(os.getenv("SCHEDULER_INTERVAL_SECONDS", 5))
+    SCHEDULER_BATCH_SIZE: int = int(os.getenv("SCHEDULER_BATCH_SIZE", 500))
+    SCHEDULER_MIN_BATTERY: float = float(os.getenv("SCHEDULER_MIN_BATTERY", 20))
+    # Extra cost, in cm of travel, per missing battery percentage point
+    SCHEDULER_BATTERY_PENALTY: float = float(os.getenv("SCHEDULER_BATTERY_PENALTY", 10))
+
+    # Task engine Settings
+    # In-progress tasks with no robot event for this long are failed
+    TASK_STALL_TIMEOUT_SECONDS: float = float(os.getenv("TASK_STALL_TIMEOUT_SECONDS", 300))
+    TASK_FLUSH_SIZE: int = int(os.getenv("TASK_FLUSH_SIZE", 1000))
+    TASK_FLUSH_INTERVAL_SECONDS: float = float(os.getenv("TASK_FLUSH_INTERVAL_SECONDS", 0.5))
+
+    # Telemetry Settings
+    TELEMETRY_MAX_ROBOTS: int = int(os.getenv("TELEMETRY_MAX_ROBOTS", 1024))
+    TELEMETRY_PERSIST_ENABLED: bool = os.getenv("TELEMETRY_PERSIST_ENABLED", "true").lower() == "true"
+    TELEMETRY_FLUSH_SIZE: int = int(os.getenv("TELEMETRY_FLUSH_SIZE", 5000))
+    TELEMETRY_FLUSH_INTERVAL_SECONDS: float = float(os.getenv("TELEMETRY_FLUSH_INTERVAL_SECONDS", 1.0))
+    TELEMETRY_BUFFER_MAX: int = int(os.getenv("TELEMETRY_BUFFER_MAX", 100000))
+
+    # Cluster Settings
+    # Run several uvicorn workers: one leader owns MQTT and the telemetry
+    # state, the others read shared state and forward commands to it
+    CLUSTER_ENABLED: bool = os.getenv("CLUSTER_ENABLED", "false").lower() == "true"
+    CLUSTER_DIR: str = os.getenv("CLUSTER_DIR", "/tmp/nest/cluster")
+    CLUSTER_FAILOVER_SECONDS: float = float(os.getenv("CLUSTER_FAILOVER_SECONDS", 2))
+    CLUSTER_REQUEST_TIMEOUT: float = float(os.getenv("CLUSTER_REQUEST_TIMEOUT", 10))
+
+    # Metrics Settings
+    # Serve Prometheus metrics on /metrics and time HTTP requests and queries
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+    # Fleet stream Settings
+    # Server tick rate, and the highest frame rate a viewer can ask for
+    STREAM_MAX_FPS: float = float(os.getenv("STREAM_MAX_FPS", 10))
+    # Viewers further behind than this get a full snapshot instead of a delta
+    STREAM_HISTORY_SECONDS: float = float(os.getenv("STREAM_HISTORY_SECONDS", 10))
 
 
 settings = Settings()
\ No newline at end of file
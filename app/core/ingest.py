@@ -0,0 +1,137 @@
+import enum
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class IngestPolicy(str, enum.Enum):
+    COALESCE = "coalesce"  # keep only the newest queued message per key
+    DROP_OLDEST = "drop_oldest"  # make room by discarding the oldest message
+    BLOCK = "block"  # never drop, wait for room instead
+
+
+class IngestQueue:
+    """Bounded ring buffer between the MQTT network thread and message handlers.
+
+    What happens when a message arrives depends on the policy: `COALESCE`
+    overwrites a still-queued message with the same key in place (and falls
+    back to dropping the oldest message when full), `DROP_OLDEST` discards the
+    head of the queue, and `BLOCK` makes the producer wait for room.
+    """
+
+    def __init__(self, maxsize, policy=IngestPolicy.BLOCK):
+        self.maxsize = maxsize
+        self.policy = IngestPolicy(policy)
+        self._buffer = [None] * maxsize  # (key, enqueued_at, item)
+        self._head = 0
+        self._count = 0
+        self._keys = {}  # coalesce key -> buffer index
+        self._closed = False
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        # Counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.handled = 0
+        self.max_depth = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, key, item, block=True):
+        """Queue `item`; returns False if it was rejected because the queue is
+        closed or, with `block=False`, because a `BLOCK` queue is full"""
+        with self._lock:
+            if self._closed:
+                return False
+
+            if self.policy is IngestPolicy.COALESCE:
+                index = self._keys.get(key)
+                if index is not None:
+                    # Replace the payload but keep the original enqueue time,
+                    # so latency reflects how long this slot has been waiting
+                    _, enqueued_at, _ = self._buffer[index]
+                    self._buffer[index] = (key, enqueued_at, item)
+                    self.coalesced += 1
+                    return True
+
+            while self._count == self.maxsize:
+                if self.policy is IngestPolicy.BLOCK:
+                    if not block:
+                        return False
+                    self._not_full.wait()
+                    if self._closed:
+                        return False
+                else:
+                    self._pop()
+                    self.dropped += 1
+
+            index = (self._head + self._count) % self.maxsize
+            self._buffer[index] = (key, time.monotonic(), item)
+            self._count += 1
+            if self.policy is IngestPolicy.COALESCE:
+                self._keys[key] = index
+
+            self.enqueued += 1
+            if self._count > self.max_depth:
+                self.max_depth = self._count
+            self._not_empty.notify()
+            return True
+
+    def get(self):
+        """Wait for the next item; returns None once the queue is closed and drained"""
+        with self._lock:
+            while not self._count:
+                if self._closed:
+                    return None
+                self._not_empty.wait()
+
+            enqueued_at, item = self._pop()
+            latency = time.monotonic() - enqueued_at
+            self.handled += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+            self._not_full.notify()
+            return item
+
+    def _pop(self):
+        key, enqueued_at, item = self._buffer[self._head]
+        if self._keys.get(key) == self._head:
+            del self._keys[key]
+        self._buffer[self._head] = None
+        self._head = (self._head + 1) % self.maxsize
+        self._count -= 1
+        return enqueued_at, item
+
+    def open(self):
+        with self._lock:
+            self._closed = False
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def stats(self):
+        return {
+            "policy": self.policy.value,
+            "capacity": self.maxsize,
+            "depth": self._count,
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "handled": self.handled,
+            "latency_avg_ms": (self.latency_total / self.handled * 1000) if self.handled else 0.0,
+            "latency_max_ms": self.latency_max * 1000,
+        }
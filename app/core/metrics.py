@@ -0,0 +1,317 @@
+import bisect
+import math
+import threading
+import time
+
+# Upper bounds in seconds; wide enough for both a socket write and a slow query
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+OVERFLOW_LABEL = "other"
+
+
+def topic_pattern(topic):
+    """Label for a topic no subscription describes, such as one the server
+    publishes to: the robot id level of `robot/<id>/...` becomes `+`
+    whatever the id looks like, so `robot/17/commands` and
+    `robot/alpha/commands` share `robot/+/commands`. Inbound messages are
+    labelled with the subscription pattern they matched instead."""
+    levels = topic.split("/", 2)
+    if len(levels) > 1 and levels[0] == "robot":
+        levels[1] = "+"
+    return "/".join(levels)
+
+
+class _Series:
+    """One label set of a metric.
+
+    Every thread that records a sample gets its own cell, so recording never
+    takes a lock and never races another thread; the cells are only summed
+    when the metrics are scraped.
+    """
+
+    __slots__ = ("_local", "_cells", "_size")
+
+    def __init__(self, size):
+        self._local = threading.local()
+        self._cells = []
+        self._size = size
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self._size
+            self._cells.append(cell)
+            return cell
+
+    def totals(self):
+        totals = [0] * self._size
+        for cell in list(self._cells):
+            for index, value in enumerate(cell):
+                totals[index] += value
+        return totals
+
+
+class _CounterSeries(_Series):
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+
+class _HistogramSeries(_Series):
+    __slots__ = ("_bounds",)
+
+    def __init__(self, bounds):
+        # One slot per bucket, one for +Inf and one for the sum
+        super().__init__(len(bounds) + 2)
+        self._bounds = bounds
+
+    def observe(self, value):
+        cell = self._cell()
+        cell[bisect.bisect_left(self._bounds, value)] += 1
+        cell[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("_series", "_start")
+
+    def __init__(self, series):
+        self._series = series
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._series.observe(time.perf_counter() - self._start)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), max_series=1000):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._series = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        series = self._series.get(values)
+        if series is None:
+            # Only the first sample of a label set gets here
+            with self._lock:
+                series = self._series.get(values)
+                if series is None:
+                    if len(self._series) >= self.max_series:
+                        values = (OVERFLOW_LABEL,) * len(self.labelnames)
+                        series = self._series.get(values)
+                    if series is None:
+                        series = self._new_series()
+                        self._series[values] = series
+        return series
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, series in sorted(list(self._series.items()), key=lambda item: item[0]):
+            lines.extend(self._render_series(values, series))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _render_series(self, values, series):
+        yield f"{self.name}{self._label_text(values)} {_format(series.totals()[0])}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, max_series=1000):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, max_series)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _render_series(self, values, series):
+        totals = series.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), totals):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else _format(bound)
+            yield f"{self.name}_bucket{self._label_text(values, [('le', le)])} {cumulative}"
+        yield f"{self.name}_sum{self._label_text(values)} {_format(totals[-1])}"
+        yield f"{self.name}_count{self._label_text(values)} {cumulative}"
+
+
+class Gauge(_Metric):
+    """Value read from `callback()` at scrape time; the callback returns a
+    number, or a dict of label value tuples to numbers"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        self.callback = callback
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return None
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.callback()
+        except Exception:
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{self._label_text(labels)} {_format(value)}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value):
+    if isinstance(value, float):
+        if value == math.inf:
+            return "+Inf"
+        return repr(value)
+    return str(int(value))
+
+
+class MetricsRegistry:
+    """Process-wide set of metrics rendered in the Prometheus text format"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), max_series=1000):
+        return self._register(Counter(name, documentation, labelnames, max_series))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, max_series=1000):
+        return self._register(Histogram(name, documentation, labelnames, buckets, max_series))
+
+    def gauge(self, name, documentation, callback, labelnames=()):
+        return self._register(Gauge(name, documentation, callback, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by method, route template
+    and status code"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_request_seconds.labels(
+                scope["method"], route_template(scope), str(status_code)
+            ).observe(time.perf_counter() - start)
+
+
+def route_template(scope):
+    """The path template of the matched route, e.g.
+    `/api/v1/tasks/{task_id}`, so ids in the URL stay out of labels"""
+    route = scope.get("route")
+    if route is None:
+        return "unmatched"
+    return route.path
+
+
+# Create a global metrics registry and the metrics recorded on hot paths
+metrics = MetricsRegistry()
+
+mqtt_publish_seconds = metrics.histogram(
+    "nest_mqtt_publish_seconds", "Time to hand a message to the MQTT client", ["topic"]
+)
+mqtt_publish_failures = metrics.counter(
+    "nest_mqtt_publish_failures_total", "Publishes rejected or not connected", ["topic"]
+)
+mqtt_messages_received = metrics.counter(
+    "nest_mqtt_messages_received_total", "Inbound MQTT messages", ["topic"]
+)
+mqtt_handler_seconds = metrics.histogram(
+    "nest_mqtt_handler_seconds", "Time spent in MQTT message handlers", ["lane", "topic"]
+)
+mqtt_disconnects = metrics.counter(
+    "nest_mqtt_disconnects_total", "Disconnections from the MQTT broker", ["reason"]
+)
+db_checkout_seconds = metrics.histogram(
+    "nest_db_checkout_seconds", "Time waiting for a pooled database connection", ["engine"]
+)
+db_query_seconds = metrics.histogram(
+    "nest_db_query_seconds", "Database statement execution time", ["engine", "statement"]
+)
+command_outcomes = metrics.counter(
+    "nest_commands_total", "Robot commands submitted, by what happened to them", ["outcome"]
+)
+http_request_seconds = metrics.histogram(
+    "nest_http_request_seconds", "HTTP request latency", ["method", "route", "status"]
+)
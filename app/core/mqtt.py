@@ -1,12 +1,243 @@
+import asyncio
+import concurrent.futures
 import paho.mqtt.client as mqtt
+from app.core.commands import CommandCorrelator
 from app.core.config import settings
+from app.core.ingest import IngestPolicy, IngestQueue
+from app.core.metrics import (
+    mqtt_disconnects,
+    mqtt_handler_seconds,
+    mqtt_messages_received,
+    mqtt_publish_failures,
+    mqtt_publish_seconds,
+    topic_pattern,
+)
+from app.core.telemetry import telemetry_store
 import logging
+import threading
 import time
 import uuid
 
 logger = logging.getLogger(__name__)
 
 
+class TopicTrie:
+    """MQTT topic filters compiled into a trie keyed by topic level.
+
+    Matching walks the levels of the incoming topic once, following the exact,
+    `+` and `#` branches, so its cost depends on the topic depth rather than
+    on how many filters are registered.
+    """
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, topic_filter, value):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.setdefault(level, {})
+        node.setdefault(None, []).append(value)
+
+    def remove(self, topic_filter, value):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.get(level)
+            if node is None:
+                return False
+        values = node.get(None)
+        if not values or value not in values:
+            return False
+        values.remove(value)
+        return True
+
+    def match(self, topic):
+        levels = topic.split("/")
+        matches = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            # "#" also matches the parent level ("robot/#" matches "robot")
+            wildcard = node.get("#")
+            if wildcard is not None:
+                matches.extend(wildcard.get(None, ()))
+            if depth == len(levels):
+                matches.extend(node.get(None, ()))
+                continue
+            child = node.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            child = node.get("+")
+            if child is not None:
+                stack.append((child, depth + 1))
+        return matches
+
+
+class _Lane:
+    """Worker threads fed by topic-sharded ingest queues sharing one policy"""
+
+    def __init__(self, name, policy, workers, queue_size):
+        self.name = name
+        self.queues = [IngestQueue(queue_size, policy) for _ in range(workers)]
+        self.threads = []
+
+    def put(self, topic, item, block=True):
+        return self.queues[hash(topic) % len(self.queues)].put(topic, item, block)
+
+    def stats(self):
+        shards = [work_queue.stats() for work_queue in self.queues]
+        handled = sum(shard["handled"] for shard in shards)
+        return {
+            "policy": shards[0]["policy"],
+            "workers": len(shards),
+            "capacity": sum(shard["capacity"] for shard in shards),
+            "depth": sum(shard["depth"] for shard in shards),
+            "max_depth": max(shard["max_depth"] for shard in shards),
+            "enqueued": sum(shard["enqueued"] for shard in shards),
+            "dropped": sum(shard["dropped"] for shard in shards),
+            "coalesced": sum(shard["coalesced"] for shard in shards),
+            "handled": handled,
+            "latency_avg_ms": (
+                sum(shard["latency_avg_ms"] * shard["handled"] for shard in shards) / handled
+                if handled else 0.0
+            ),
+            "latency_max_ms": max(shard["latency_max_ms"] for shard in shards),
+        }
+
+
+class MessageDispatcher:
+    """Route inbound messages to registered handlers on bounded worker lanes.
+
+    Each lane owns a set of worker threads and an ingest queue per worker with
+    the lane's drop/coalesce policy. Within a lane, messages are sharded by
+    topic, so messages from one robot are handled in order and by a single
+    thread, while the paho network thread only does the trie lookup and a
+    queue put.
+    """
+
+    DEFAULT_LANE = "default"
+    MATCH_CACHE_SIZE = 10000
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers or settings.MQTT_DISPATCH_WORKERS
+        self.queue_size = queue_size or settings.MQTT_DISPATCH_QUEUE_SIZE
+        self._trie = TopicTrie()
+        self._match_cache = {}  # topic -> (pattern, tuple of (lane, handlers))
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._running = False
+        self.add_lane(self.DEFAULT_LANE, IngestPolicy.BLOCK)
+
+    def add_lane(self, name, policy, workers=None, queue_size=None):
+        if name in self._lanes:
+            raise ValueError(f"Dispatch lane {name} already exists")
+        lane = _Lane(name, policy, workers or self.workers, queue_size or self.queue_size)
+        self._lanes[name] = lane
+        if self._running:
+            self._start_lane(lane)
+        return lane
+
+    def register(self, topic_filter, handler, lane=DEFAULT_LANE):
+        if lane not in self._lanes:
+            raise ValueError(f"Unknown dispatch lane {lane}")
+        with self._lock:
+            self._trie.add(topic_filter, (lane, handler, topic_filter))
+            self._match_cache = {}
+
+    def unregister(self, topic_filter, handler, lane=DEFAULT_LANE):
+        with self._lock:
+            removed = self._trie.remove(topic_filter, (lane, handler, topic_filter))
+            self._match_cache = {}
+        return removed
+
+    def match(self, topic):
+        """(pattern, routes) for a topic: the most specific registered filter
+        it matched, used as its metrics label, and (lane, handlers) pairs"""
+        matched = self._match_cache.get(topic)
+        if matched is None:
+            by_lane = {}
+            filters = set()
+            for lane, handler, topic_filter in self._trie.match(topic):
+                by_lane.setdefault(lane, []).append(handler)
+                filters.add(topic_filter)
+            routes = tuple(
+                (self._lanes[lane], tuple(handlers)) for lane, handlers in by_lane.items()
+            )
+            if filters:
+                pattern = min(filters, key=lambda f: (f.count("#"), f.count("+"), f))
+            else:
+                pattern = topic_pattern(topic)
+            matched = (pattern, routes)
+            cache = self._match_cache
+            if len(cache) >= self.MATCH_CACHE_SIZE:
+                cache.clear()
+            cache[topic] = matched
+        return matched
+
+    def route(self, topic, payload):
+        """(lane, item) pairs to `put` for a message, which is counted as received"""
+        pattern, routes = self.match(topic)
+        mqtt_messages_received.labels(pattern).inc()
+        return [(lane, (topic, payload, pattern, handlers)) for lane, handlers in routes]
+
+    def dispatch(self, topic, payload):
+        """Queue a message for its handlers, waiting for room in `BLOCK` lanes;
+        returns False if no handler matched"""
+        deliveries = self.route(topic, payload)
+        for lane, item in deliveries:
+            lane.put(topic, item)
+        return bool(deliveries)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        for lane in self._lanes.values():
+            self._start_lane(lane)
+
+    def _start_lane(self, lane):
+        for index, work_queue in enumerate(lane.queues):
+            work_queue.open()
+            thread = threading.Thread(
+                target=self._run,
+                args=(lane.name, work_queue),
+                name=f"mqtt-{lane.name}-{index}",
+                daemon=True,
+            )
+            thread.start()
+            lane.threads.append(thread)
+
+    def stop(self):
+        self._running = False
+        for lane in self._lanes.values():
+            for work_queue in lane.queues:
+                work_queue.close()
+        for lane in self._lanes.values():
+            for thread in lane.threads:
+                thread.join(timeout=5)
+            lane.threads = []
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self._lanes.items()}
+
+    def _run(self, lane_name, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            topic, payload, pattern, handlers = item
+            _call_handlers(lane_name, pattern, topic, payload, handlers)
+
+
+def _call_handlers(lane_name, pattern, topic, payload, handlers):
+    start = time.perf_counter()
+    for handler in handlers:
+        try:
+            handler(topic, payload)
+        except Exception as e:
+            logger.exception(f"Error in MQTT handler for {topic}: {e}")
+    mqtt_handler_seconds.labels(lane_name, pattern).observe(time.perf_counter() - start)
+
+
 class MQTTClient:
     def __init__(self):
         client_id = f"{settings.PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
@@ -21,9 +252,33 @@ class MQTTClient:
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
         self.connected = False
+        # mid -> future waiting for the PUBACK (None for fire-and-forget publishes)
+        self._inflight = {}
+        # mids acknowledged before publish() had registered them
+        self._early_acks = set()
+        self._subscriptions = {}  # topic filter -> qos, replayed on every connect
+        self.dispatcher = MessageDispatcher()
+        self.commands = CommandCorrelator(self)
+        # Set on cluster followers: publishes go to the leader instead
+        self.remote = None
+        self._connect_thread = None
+
+        # Latest position wins for telemetry, acknowledgements are never dropped
+        self.dispatcher.add_lane("telemetry", settings.MQTT_TELEMETRY_POLICY)
+        self.dispatcher.add_lane("acks", settings.MQTT_ACK_POLICY)
+        self.register_handler("robot/+/position", self._on_position, lane="telemetry")
+        self.register_handler("robot/+/state", self._on_state, lane="acks")
 
     def connect(self):
+        """Start the dispatcher and connect on a background thread, so startup
+        does not wait for DNS and the broker handshake"""
+        self.dispatcher.start()
+        self._connect_thread = threading.Thread(target=self._connect, name="mqtt-connect", daemon=True)
+        self._connect_thread.start()
+
+    def _connect(self):
         try:
             logger.info(
                 f"Connecting to MQTT broker at {settings.MQTT_BROKER}:{settings.MQTT_PORT}"
@@ -47,6 +302,9 @@ class MQTTClient:
                     logger.error(f"Failed to connect to localhost: {e2}")
 
     def disconnect(self):
+        if self._connect_thread is not None:
+            self._connect_thread.join(timeout=5)
+            self._connect_thread = None
         if hasattr(self, "client"):
             try:
                 self.client.loop_stop()
@@ -54,12 +312,34 @@ class MQTTClient:
                 logger.info("Disconnected from MQTT broker")
             except Exception as e:
                 logger.error(f"Error disconnecting from MQTT: {e}")
+        self.dispatcher.stop()
+
+    def forward_to(self, remote):
+        """Hand publishes and commands to `remote` (a cluster leader link), or
+        handle them locally again with `remote=None`"""
+        self.remote = remote
+
+    def subscribe(self, topic_filter, qos=1):
+        """Subscribe now if connected, and again after every reconnect"""
+        self._subscriptions[topic_filter] = qos
+        if self.connected:
+            self.client.subscribe(topic_filter, qos=qos)
+
+    def register_handler(self, topic_filter, handler, qos=1, lane=MessageDispatcher.DEFAULT_LANE):
+        """Call `handler(topic, payload)` for every message matching `topic_filter`"""
+        self.dispatcher.register(topic_filter, handler, lane=lane)
+        self.subscribe(topic_filter, qos=qos)
+
+    def unregister_handler(self, topic_filter, handler, lane=MessageDispatcher.DEFAULT_LANE):
+        return self.dispatcher.unregister(topic_filter, handler, lane=lane)
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             self.connected = True
+            self._early_acks.clear()
             logger.info("Successfully connected to MQTT broker")
-            client.subscribe("robot/+/position", qos=1)
+            if self._subscriptions:
+                client.subscribe(list(self._subscriptions.items()))
         else:
             conn_codes = {
                 1: "incorrect protocol version",
@@ -76,14 +356,87 @@ class MQTTClient:
 
     def on_disconnect(self, client, userdata, rc):
         self.connected = False
+        mqtt_disconnects.labels("unexpected" if rc != 0 else "requested").inc()
         if rc != 0:
             logger.warning(f"Unexpected disconnection from MQTT broker: {rc}")
+        # With a clean session the broker forgets in-flight messages, so
+        # nobody should keep waiting for their PUBACK
+        inflight, self._inflight = self._inflight, {}
+        self._early_acks.clear()
+        for future in inflight.values():
+            if future is not None:
+                self._settle(future, False)
+
+    def on_publish(self, client, userdata, mid):
+        if mid in self._inflight:
+            self._complete(mid)
+            return
+        self._early_acks.add(mid)
+        # publish() may have registered the mid in the meantime
+        if mid in self._inflight:
+            self._early_acks.discard(mid)
+            self._complete(mid)
+
+    def _complete(self, mid):
+        future = self._inflight.pop(mid, _MISSING)
+        if future is not _MISSING and future is not None:
+            self._settle(future, True)
+
+    def _settle(self, future, result):
+        if isinstance(future, concurrent.futures.Future):
+            _resolve_future(future, result)
+            return
+        # Called from the network thread, so hand over to the future's loop
+        future.get_loop().call_soon_threadsafe(_resolve_future, future, result)
 
     def on_message(self, client, userdata, msg):
-        logger.debug(f"Received message on topic {msg.topic}: {msg.payload.decode()}")
-        # Process messages here or dispatch to handlers
+        if not self.dispatcher.dispatch(msg.topic, msg.payload):
+            logger.debug(f"No handler for message on topic {msg.topic}")
+
+    def _on_position(self, topic, payload):
+        telemetry_store.ingest_position(topic.split("/")[1], payload)
+
+    def _on_state(self, topic, payload):
+        self.commands.handle_state(topic.split("/")[1], payload)
+
+    def publish(self, topic, payload, qos=1, retain=False, future=None):
+        """Publish from any thread; returns whether the client accepted the message.
+
+        A `concurrent.futures.Future` passed as `future` resolves like the one
+        from `publish_async`; on a cluster follower, once the leader's client
+        accepted the message.
+        """
+        if self.remote is not None:
+            published = self.remote.publish(topic, payload, qos, retain)
+            if future is not None:
+                _resolve_future(future, published)
+            return published
+        start = time.perf_counter()
+        published = self._publish(topic, payload, qos, retain, future)
+        _record_publish(topic, start, published)
+        if not published and future is not None:
+            self._settle(future, False)
+        return published
+
+    def publish_async(self, topic, payload, qos=1, retain=False):
+        """Publish without blocking and return a future for the delivery.
 
-    def publish(self, topic, payload, qos=1, retain=False):
+        The future resolves to True once the broker acknowledged the message
+        (PUBACK for QoS 1, socket write for QoS 0) and to False if the publish
+        failed or the connection dropped first. Must be called from the event
+        loop the future should resolve on.
+        """
+        if self.remote is not None:
+            return self.remote.publish_async(topic, payload, qos, retain)
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        published = self._publish(topic, payload, qos, retain, future)
+        _record_publish(topic, start, published)
+        if not published:
+            future.set_result(False)
+        return future
+
+    def _publish(self, topic, payload, qos, retain, future=None):
         if not self.connected:
             logger.warning(f"Cannot publish to {topic}: Not connected to MQTT broker")
             return False
@@ -93,11 +446,67 @@ class MQTTClient:
             if result.rc != mqtt.MQTT_ERR_SUCCESS:
                 logger.error(f"Failed to publish to {topic}: {result.rc}")
                 return False
-            return True
         except Exception as e:
             logger.error(f"Error publishing to {topic}: {e}")
             return False
 
+        self._inflight[result.mid] = future
+        # The acknowledgement may have beaten us here
+        if result.mid in self._early_acks:
+            self._early_acks.discard(result.mid)
+            self._complete(result.mid)
+        return True
+
+
+_MISSING = object()
+
+
+def _record_publish(topic, start, published):
+    pattern = topic_pattern(topic)
+    mqtt_publish_seconds.labels(pattern).observe(time.perf_counter() - start)
+    if not published:
+        mqtt_publish_failures.labels(pattern).inc()
+
+
+def _resolve_future(future, result):
+    try:
+        if not future.done():
+            future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        # A thread-safe future settled or cancelled by another thread meanwhile
+        pass
+
+
+def _create_client():
+    if settings.MQTT_TRANSPORT == "asyncio":
+        from app.mqtt.client import AsyncioMQTTClient
+
+        return AsyncioMQTTClient()
+    if settings.MQTT_TRANSPORT == "embedded":
+        from app.mqtt.client import EmbeddedMQTTClient
+
+        return EmbeddedMQTTClient()
+    return MQTTClient()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_mqtt_client():
+    """The process-wide MQTT client, created on first use with the transport
+    chosen in settings"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
 
-# Create a global MQTT client instance
-mqtt_client = MQTTClient()
+def __getattr__(name):
+    # `from app.core.mqtt import mqtt_client` keeps working, but importing
+    # this module no longer builds a client
+    if name == "mqtt_client":
+        return get_mqtt_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
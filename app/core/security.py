@@ -1,3 +1,7 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from jose import jwt
 from passlib.context import CryptContext
@@ -11,6 +15,114 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def _timed_call(func, *args):
+    # Runs in the worker process; CLOCK_MONOTONIC is shared across processes
+    started = time.monotonic()
+    result = func(*args)
+    return result, started, time.monotonic()
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hash operations are already waiting"""
+
+
+class PasswordHasher:
+    """Async bcrypt on a bounded process pool.
+
+    bcrypt takes hundreds of milliseconds of CPU and holds the GIL, so it runs
+    in worker processes instead of the API worker. At most `max_pending`
+    operations may be queued or running; beyond that callers get
+    `PasswordHasherBusy` right away instead of piling up behind a burst.
+    Only call it from the event loop.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or settings.PASSWORD_HASH_WORKERS
+        self.max_pending = max_pending or settings.PASSWORD_HASH_MAX_PENDING
+        self._executor = None
+        self.pending = 0
+
+        # Metrics
+        self.completed = 0
+        self.rejected = 0
+        self.hash_seconds_total = 0.0
+        self.hash_seconds_max = 0.0
+        self.queue_wait_seconds_total = 0.0
+        self.queue_wait_seconds_max = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn rather than fork: the API process has MQTT and dispatcher threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def start(self):
+        """Start the worker processes now so the first login does not pay for it"""
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(time.monotonic)
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy(f"{self.pending} password hash operations already pending")
+
+        self.pending += 1
+        submitted = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started, finished = await loop.run_in_executor(
+                self._get_executor(), _timed_call, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+        queue_wait = max(started - submitted, 0.0)
+        hash_time = finished - started
+        self.completed += 1
+        self.queue_wait_seconds_total += queue_wait
+        self.queue_wait_seconds_max = max(self.queue_wait_seconds_max, queue_wait)
+        self.hash_seconds_total += hash_time
+        self.hash_seconds_max = max(self.hash_seconds_max, hash_time)
+        return result
+
+    async def verify(self, plain_password, hashed_password):
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password):
+        return await self._run(get_password_hash, password)
+
+    def stats(self):
+        completed = self.completed or 1
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "hash_ms_avg": self.hash_seconds_total / completed * 1000,
+            "hash_ms_max": self.hash_seconds_max * 1000,
+            "queue_wait_ms_avg": self.queue_wait_seconds_total / completed * 1000,
+            "queue_wait_ms_max": self.queue_wait_seconds_max * 1000,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Create a global password hasher instance
+password_hasher = PasswordHasher()
+
+def access_token_claims(user):
+    # Role and username let get_current_user skip the database when
+    # AUTH_TRUST_TOKEN_CLAIMS is enabled
+    return {"sub": str(user.id), "username": user.username, "role": user.role}
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -21,4 +133,4 @@ def create_refresh_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
\ No newline at end of file
+    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
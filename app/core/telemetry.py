@@ -0,0 +1,222 @@
+import fcntl
+import logging
+import math
+import mmap
+import os
+import threading
+import time
+
+from app.core.codec import DecodeError, iter_positions, payload_codec
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+_MAGIC = 0x314C45544E545345  # b"ESTNTEL1"
+_HEADER = ("magic", "size", "count")
+# Column name and array typecode, laid out in this order after the header
+_COLUMNS = (("seq", "Q"), ("x", "d"), ("y", "d"), ("battery", "d"), ("node_id", "q"), ("updated_at", "d"))
+# Robot ids are stored as fixed-width UTF-8, NUL padded
+ID_BYTES = 64
+
+
+def _open_shared(path, size):
+    """Map the file at `path`, (re)initializing it if it has the wrong layout"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+        buffer = mmap.mmap(fd, size)
+        header = memoryview(buffer)[: 8 * len(_HEADER)].cast("Q")
+        if header[1] != size or header[0] != _MAGIC:
+            buffer[:] = bytes(size)
+            header[1] = size
+            header[0] = _MAGIC
+        header.release()
+        return buffer
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class TelemetryStore:
+    """Latest position, battery and timestamp for every robot in the fleet.
+
+    Each robot id is given a fixed slot the first time it reports, and its
+    values live in preallocated columns indexed by that slot. A slot is only
+    ever written by the MQTT thread, so updates take no lock; readers use the
+    per-slot sequence counter (odd while a write is in progress) to get a
+    consistent record without blocking the writer.
+
+    With a `path`, the columns and robot ids live in a memory-mapped file
+    instead of private memory, so other worker processes on the host can
+    read the fleet state written by the one that owns the MQTT connection.
+    """
+
+    def __init__(self, capacity=None, path=None):
+        self.capacity = capacity or settings.TELEMETRY_MAX_ROBOTS
+        self.path = path
+        self._slots = {}  # robot_id -> slot index
+        self._ids = []  # slot index -> robot_id
+        # Only taken the first time a robot reports, never on the update path
+        self._register_lock = threading.Lock()
+        self._listeners = []
+
+        size = 8 * len(_HEADER) + self.capacity * (8 * len(_COLUMNS) + ID_BYTES)
+        self._buffer = bytearray(size) if path is None else _open_shared(path, size)
+        view = memoryview(self._buffer)
+        offset = 8 * len(_HEADER)
+        self._header = view[:offset].cast("Q")
+        for name, typecode in _COLUMNS:
+            setattr(self, name, view[offset : offset + 8 * self.capacity].cast(typecode))
+            offset += 8 * self.capacity
+        self._id_bytes = view[offset:]
+
+    def __len__(self):
+        return self._header[2]
+
+    def _sync(self):
+        """Pick up robots registered by another process"""
+        if len(self._ids) < self._header[2]:
+            with self._register_lock:
+                self._sync_locked()
+
+    def _sync_locked(self):
+        count = self._header[2]
+        while len(self._ids) < count:
+            slot = len(self._ids)
+            raw = bytes(self._id_bytes[slot * ID_BYTES : (slot + 1) * ID_BYTES])
+            robot_id = raw.rstrip(b"\0").decode()
+            self._ids.append(robot_id)
+            self._slots[robot_id] = slot
+
+    def _register(self, robot_id):
+        encoded = robot_id.encode()
+        if len(encoded) > ID_BYTES:
+            logger.warning(f"Robot id longer than {ID_BYTES} bytes, ignoring robot {robot_id}")
+            return None
+        with self._register_lock:
+            self._sync_locked()
+            slot = self._slots.get(robot_id)
+            if slot is not None:
+                return slot
+            slot = self._header[2]
+            if slot >= self.capacity:
+                logger.warning(
+                    f"Telemetry store full ({self.capacity} robots), ignoring robot {robot_id}"
+                )
+                return None
+            self._id_bytes[slot * ID_BYTES : (slot + 1) * ID_BYTES] = encoded.ljust(ID_BYTES, b"\0")
+            self.battery[slot] = math.nan
+            self.node_id[slot] = -1
+            # Publish the slot only after its id and initial values are in
+            # place so readers never see a half-registered robot
+            self._header[2] = slot + 1
+            self._sync_locked()
+            return slot
+
+    def add_listener(self, callback):
+        """Call `callback(robot_id, record)` after every update, on the writer's thread"""
+        self._listeners.append(callback)
+
+    def update(self, robot_id, x=None, y=None, battery=None, node_id=None, timestamp=None):
+        slot = self._slots.get(robot_id)
+        if slot is None:
+            slot = self._register(robot_id)
+            if slot is None:
+                return False
+
+        seq = self.seq[slot]
+        self.seq[slot] = seq + 1
+        if x is not None:
+            self.x[slot] = x
+        if y is not None:
+            self.y[slot] = y
+        if battery is not None:
+            self.battery[slot] = battery
+        if node_id is not None:
+            self.node_id[slot] = node_id
+        self.updated_at[slot] = timestamp or time.time()
+        self.seq[slot] = seq + 2
+
+        if self._listeners:
+            record = self._read(slot)
+            for callback in self._listeners:
+                try:
+                    callback(robot_id, record)
+                except Exception as e:
+                    logger.exception(f"Error in telemetry listener: {e}")
+        return True
+
+    def ingest_position(self, robot_id, payload):
+        """Update a robot from a raw `robot/<id>/position` payload (JSON or binary)"""
+        payload_codec.observe(robot_id, payload)
+        try:
+            updated = False
+            for x, y, battery, node_id in iter_positions(payload):
+                updated = self.update(robot_id, x=x, y=y, battery=battery, node_id=node_id)
+            return updated
+        except DecodeError as e:
+            logger.warning(f"Invalid position payload from robot {robot_id}: {e}")
+            return False
+
+    def _read(self, slot):
+        while True:
+            seq = self.seq[slot]
+            if seq & 1:
+                # A write is in flight; let the writer finish
+                time.sleep(0)
+                continue
+            battery = self.battery[slot]
+            node_id = self.node_id[slot]
+            record = {
+                "robot_id": self._ids[slot],
+                "x": self.x[slot],
+                "y": self.y[slot],
+                "battery": None if math.isnan(battery) else battery,
+                "node_id": None if node_id < 0 else node_id,
+                "updated_at": self.updated_at[slot],
+            }
+            if self.seq[slot] == seq:
+                return record
+
+    def get(self, robot_id):
+        slot = self._slots.get(robot_id)
+        if slot is None:
+            self._sync()
+            slot = self._slots.get(robot_id)
+            if slot is None:
+                return None
+        return self._read(slot)
+
+    def snapshot(self):
+        self._sync()
+        return [self._read(slot) for slot in range(len(self._ids))]
+
+    def changes_since(self, seen):
+        """Records of the robots updated since the sequence numbers in `seen`.
+
+        `seen` is a list of per-slot sequence numbers owned by the caller; it
+        is updated in place, so passing the same list again only returns
+        newer changes. Works the same whether or not this process is the writer.
+        """
+        self._sync()
+        seen.extend([0] * (len(self._ids) - len(seen)))
+        changed = []
+        seq = self.seq
+        for slot in range(len(self._ids)):
+            current = seq[slot]
+            if current != seen[slot] and not current & 1:
+                record = self._read(slot)
+                seen[slot] = current
+                changed.append(record)
+        return changed
+
+
+# Create a global telemetry store instance, shared between workers in cluster mode
+telemetry_store = TelemetryStore(
+    path=os.path.join(settings.CLUSTER_DIR, "telemetry") if settings.CLUSTER_ENABLED else None
+)
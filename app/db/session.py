@@ -1,9 +1,145 @@
-from sqlalchemy import create_engine
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from app.core.config import settings
+from app.core.metrics import db_checkout_seconds, db_query_seconds
 
-engine = create_engine(settings.DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def _async_database_url(url):
+    """Use the asyncpg driver for the async engine unless one is configured"""
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    for prefix in ("postgresql://", "postgres://", "postgresql+psycopg2://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+class _TimedQueuePool(QueuePool):
+    """Queue pool that records how long each checkout waited for a connection"""
+
+    engine_label = "sync"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_checkout_seconds.labels(self.engine_label).observe(time.perf_counter() - start)
+
+
+class _TimedAsyncQueuePool(_TimedQueuePool, AsyncAdaptedQueuePool):
+    engine_label = "async"
+
+
+def _pool_options(url, poolclass):
+    # SQLite (used for local experiments) does not take pool sizing options
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "poolclass": poolclass,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+
+_STATEMENT_KINDS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+
+def _time_queries(sync_engine, label):
+    """Record statement execution time, labelled by statement type"""
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        kind = statement.lstrip()[:6].upper()
+        if kind not in _STATEMENT_KINDS:
+            kind = "OTHER"
+        db_query_seconds.labels(label, kind).observe(elapsed)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(context):
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _get_or_create(name, factory):
+    engine = _engines.get(name)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = _engines[name] = factory()
+    return engine
+
+
+def _create_engine():
+    engine = create_engine(settings.DATABASE_URL, **_pool_options(settings.DATABASE_URL, _TimedQueuePool))
+    if settings.METRICS_ENABLED:
+        _time_queries(engine, "sync")
+    return engine
+
+
+def _create_async_engine():
+    url = _async_database_url(settings.DATABASE_URL)
+    engine = create_async_engine(url, **_pool_options(url, _TimedAsyncQueuePool))
+    if settings.METRICS_ENABLED:
+        _time_queries(engine.sync_engine, "async")
+    return engine
+
+
+def get_engine():
+    """The sync engine, created on first use"""
+    return _get_or_create("sync", _create_engine)
+
+
+def get_async_engine():
+    """The async engine, created on first use"""
+    return _get_or_create("async", _create_async_engine)
+
+
+def __getattr__(name):
+    # `from app.db.session import engine` keeps working, but importing this
+    # module no longer creates engines or loads database drivers
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _LazySessionmaker(sessionmaker):
+    """sessionmaker that binds to its engine when the first session is made"""
+
+    def __init__(self, engine_factory, **kw):
+        super().__init__(**kw)
+        self._engine_factory = engine_factory
+
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None:
+            self.configure(bind=self._engine_factory())
+        return super().__call__(**local_kw)
+
+
+SessionLocal = _LazySessionmaker(get_engine, autocommit=False, autoflush=False)
+AsyncSessionLocal = _LazySessionmaker(
+    get_async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
 
 # Dependency to get DB session
 def get_db():
@@ -11,4 +147,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Dependency to get an async DB session, for endpoints that run on the event loop
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
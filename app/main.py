@@ -1,34 +1,155 @@
-from fastapi import FastAPI
+import time
+
+# Taken before the heavy imports below, so startup time includes them
+_import_started = time.perf_counter()
+
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
 from app.api.v1.router import api_router
+from app.core.cluster import LeaderLink, LeaderServer, cluster
+from app.core.command_queue import command_queue
 from app.core.config import settings
-from app.db.base import Base
-from app.db.session import engine
-from app.core.mqtt import mqtt_client
-import json
+from app.core.metrics import MetricsMiddleware, metrics
+from app.core.mqtt import get_mqtt_client
+from app.core.security import password_hasher
+from app.db.session import get_engine
+from app.services.scheduler import task_scheduler
+from app.services.task_engine import task_engine
+from app.services.telemetry_writer import telemetry_writer
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+leader_server = None
+leader_link = LeaderLink(cluster.socket_path)
+_failover_task = None
+# Seconds spent importing the application and running the startup half of the lifespan
+startup_seconds = {}
+
+async def start_leader():
+    """Everything that must run in exactly one worker: the MQTT connection
+    and everything fed by it"""
+    global leader_server
+    if settings.TELEMETRY_PERSIST_ENABLED:
+        telemetry_writer.start()
+    task_engine.start()
+    mqtt_client = get_mqtt_client()
+    mqtt_client.connect()
+    if settings.CLUSTER_ENABLED:
+        leader_server = LeaderServer(mqtt_client)
+        await leader_server.start(cluster.socket_path)
+        cluster.channel = leader_server
+    if settings.SCHEDULER_ENABLED:
+        task_scheduler.start()
+
+async def follow_leader():
+    """Forward commands to the leader, and take over if it goes away"""
+    while True:
+        if cluster.try_lead():
+            cluster.channel = None
+            await leader_link.close()
+            get_mqtt_client().forward_to(None)
+            cluster.invalidate_all_local()
+            await start_leader()
+            return
+        if not leader_link.connected:
+            try:
+                await leader_link.connect()
+                get_mqtt_client().forward_to(leader_link)
+                cluster.channel = leader_link
+                # Nothing reached us while disconnected
+                cluster.invalidate_all_local()
+            except OSError as e:
+                logger.warning(f"Cannot reach cluster leader yet: {e}")
+        await asyncio.sleep(settings.CLUSTER_FAILOVER_SECONDS)
 
-# Create tables in database
-Base.metadata.create_all(bind=engine)
+async def startup():
+    global _failover_task
+    started = time.perf_counter()
+    password_hasher.start()
+    if not settings.CLUSTER_ENABLED or cluster.try_lead():
+        await start_leader()
+    else:
+        _failover_task = asyncio.create_task(follow_leader())
+    startup_seconds["lifespan"] = time.perf_counter() - started
+    logger.info(
+        f"Started in {sum(startup_seconds.values()) * 1000:.0f} ms "
+        f"(import {startup_seconds['import'] * 1000:.0f} ms, "
+        f"startup {startup_seconds['lifespan'] * 1000:.0f} ms)"
+    )
 
-app = FastAPI(title=settings.PROJECT_NAME)
+async def shutdown():
+    if _failover_task is not None:
+        _failover_task.cancel()
+    await leader_link.close()
+    if leader_server is not None:
+        await leader_server.stop()
+    await task_scheduler.stop()
+    command_queue.stop()
+    get_mqtt_client().disconnect()
+    task_engine.stop()
+    telemetry_writer.stop()
+    password_hasher.shutdown()
+    cluster.resign()
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start background work when the worker starts serving and stop it on exit.
+
+    Nothing here touches the database schema; create it once per deployment
+    with `python -m app.db.init_db` before starting the workers.
+    """
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+app = FastAPI(title=settings.PROJECT_NAME, lifespan=lifespan)
 
 # Include API router
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 @app.get("/")
 def root():
     return {"message": "Welcome to Nest API"}
 
-@app.on_event("startup")    
-async def startup_event():
-    routes = [{"path": route.path, "name": route.name} for route in app.routes]
-    print("Available routes:", routes)
-    
-    # Save routes to a JSON file
-    with open("routes.json", "w") as f:
-        json.dump(routes, f, indent=4)
-    mqtt_client.connect()
+if settings.METRICS_ENABLED:
+    metrics.gauge(
+        "nest_mqtt_connected", "Whether this worker is connected to the MQTT broker",
+        lambda: int(get_mqtt_client().connected),
+    )
+    metrics.gauge(
+        "nest_mqtt_dispatch_depth", "Messages queued for MQTT handlers",
+        lambda: {(name,): lane["depth"] for name, lane in get_mqtt_client().dispatcher.stats().items()},
+        ["lane"],
+    )
+    metrics.gauge(
+        "nest_mqtt_dispatch_dropped", "Messages dropped by full MQTT handler queues",
+        lambda: {(name,): lane["dropped"] for name, lane in get_mqtt_client().dispatcher.stats().items()},
+        ["lane"],
+    )
+    metrics.gauge(
+        "nest_command_queue_depth", "Robot commands waiting for their rate limit",
+        lambda: command_queue.depth,
+    )
+    metrics.gauge(
+        "nest_db_connections_checked_out", "Pooled database connections in use",
+        lambda: get_engine().pool.checkedout(),
+    )
+    metrics.gauge(
+        "nest_startup_seconds", "Time to import the application and run its startup",
+        lambda: {(phase,): seconds for phase, seconds in startup_seconds.items()},
+        ["phase"],
+    )
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        """Prometheus metrics for this worker"""
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    
-    mqtt_client.disconnect()
\ No newline at end of file
+startup_seconds["import"] = time.perf_counter() - _import_started
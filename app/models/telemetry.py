@@ -0,0 +1,36 @@
+from sqlalchemy import BigInteger, Column, DateTime, Float, Index, Integer, String
+from app.db.base import Base
+
+class TelemetrySample(Base):
+    """Append-only log of position reports"""
+    __tablename__ = "telemetry_samples"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    robot_id = Column(String, nullable=False)
+    recorded_at = Column(DateTime(timezone=True), nullable=False)
+    x = Column(Float, nullable=False)
+    y = Column(Float, nullable=False)
+    battery = Column(Float, nullable=True)
+    node_id = Column(Integer, nullable=True)
+
+    # History queries are always per robot over a time range
+    __table_args__ = (
+        Index('idx_telemetry_robot_time', 'robot_id', 'recorded_at'),
+    )
+
+class TelemetryRollup(Base):
+    """Per-robot aggregates over fixed time buckets (1 s and 1 min)"""
+    __tablename__ = "telemetry_rollups"
+
+    robot_id = Column(String, primary_key=True)
+    resolution = Column(Integer, primary_key=True)  # Bucket width in seconds
+    bucket_start = Column(DateTime(timezone=True), primary_key=True)
+    samples = Column(Integer, nullable=False)
+    # Last reported position in the bucket
+    x = Column(Float, nullable=False)
+    y = Column(Float, nullable=False)
+    node_id = Column(Integer, nullable=True)
+    # Sums rather than averages so partial buckets can be merged on upsert
+    battery_sum = Column(Float, nullable=False, default=0)
+    battery_samples = Column(Integer, nullable=False, default=0)
+    battery_min = Column(Float, nullable=True)
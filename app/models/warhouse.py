@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Enum, Index
+from sqlalchemy import Column, DateTime, Integer, String, Float, ForeignKey, Enum, Index
 from sqlalchemy.orm import relationship
 from app.db.base import Base
 import enum
@@ -26,7 +26,8 @@ class Node(Base):
     starting_tasks = relationship("Task", foreign_keys="Task.start_node_id", back_populates="start_node")
     ending_tasks = relationship("Task", foreign_keys="Task.end_node_id", back_populates="end_node")
     
-    # Index for spatial queries (will help with finding nearest nodes)
+    # Range filters on coordinates; nearest-node queries use the in-memory
+    # grid in app.services.spatial_index instead
     __table_args__ = (
         Index('idx_node_position', 'x_pos', 'y_pos'),
     )
@@ -83,4 +84,20 @@ class Task(Base):
         Index('idx_task_status', 'status'),
         Index('idx_task_robot', 'robot_id'),
         Index('idx_task_nodes', 'start_node_id', 'end_node_id'),
-    )
\ No newline at end of file
+    )
+
+class TaskEvent(Base):
+    """Append-only history of task status changes"""
+    __tablename__ = "task_events"
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey("tasks.id", ondelete="CASCADE"), nullable=False)
+    robot_id = Column(Integer, nullable=True)
+    status = Column(Enum(TaskStatus), nullable=False)
+    event = Column(String, nullable=False)  # "created", "assigned", "started", "completed", "failed", ...
+    detail = Column(String, nullable=True)
+    recorded_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('idx_task_event_task', 'task_id', 'recorded_at'),
+    )
@@ -1,52 +1,631 @@
 import asyncio
+import hashlib
+import hmac
 import logging
-from gmqtt import Server
+import struct
+import time
+import uuid
+
+from sqlalchemy import event, select
+
+from app.core.cache import TTLCache
+from app.core.cluster import cluster
 from app.core.config import settings
+from app.core.mqtt import TopicTrie
+from app.core.security import PasswordHasherBusy, password_hasher
+from app.db.session import AsyncSessionLocal
+from app.models.user import User
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# MQTT Authentication handler
-async def authenticate(client_id, username, password, **kwargs):
-    # In production, you should validate against your database
-    if username == settings.MQTT_USERNAME and password == settings.MQTT_PASSWORD:
-        return True
+# MQTT 3.1.1 control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+# CONNACK return codes
+ACCEPTED = 0
+UNACCEPTABLE_PROTOCOL = 1
+IDENTIFIER_REJECTED = 2
+SERVER_UNAVAILABLE = 3
+BAD_CREDENTIALS = 4
+NOT_AUTHORIZED = 5
+
+# Highest QoS delivered to subscribers; QoS 2 publishes are accepted but
+# forwarded at QoS 1
+MAX_QOS = 1
+
+
+class ProtocolError(Exception):
+    """Raised for malformed packets; the connection is dropped"""
+
+
+# Username -> (HMAC of the accepted password, stored bcrypt hash, role), so
+# reconnecting devices skip the bcrypt check
+credential_cache = TTLCache(settings.AUTH_CACHE_MAX_SIZE, settings.MQTT_AUTH_CACHE_TTL_SECONDS)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_changed_credentials(mapper, connection, target):
+    credential_cache.invalidate(target.username)
+
+
+def _invalidate_remote_user(key):
+    # Users changed through another worker
+    if key is None:
+        credential_cache.clear()
+    else:
+        credential_cache.invalidate(key["username"])
+
+
+cluster.on_invalidate("user", _invalidate_remote_user)
+
+
+def _password_digest(password):
+    return hmac.new(settings.SECRET_KEY.encode(), password, hashlib.sha256).digest()
+
+
+async def authenticate(client_id, username, password):
+    """Check MQTT credentials against the users table; returns the account's
+    role, or None if they are refused"""
+    if username is None or password is None:
+        return None
+    digest = _password_digest(password)
+    cached = credential_cache.get(username)
+    if cached is not None and hmac.compare_digest(cached[0], digest):
+        return cached[2]
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(User.hashed_password, User.role).where(User.username == username)
+        )
+        row = result.first()
+    if row is not None and row.hashed_password is not None and await password_hasher.verify(
+        password.decode("utf-8", "replace"), row.hashed_password
+    ):
+        credential_cache.set(username, (digest, row.hashed_password, row.role))
+        return row.role
+
+    # The account the bundled firmware and Node-RED flows connect with, only
+    # if it was configured rather than left at the built-in default
+    if (
+        settings.MQTT_CREDENTIALS_SET
+        and username == settings.MQTT_USERNAME
+        and hmac.compare_digest(password, settings.MQTT_PASSWORD.encode())
+    ):
+        return "admin"
     logger.warning(f"Failed authentication attempt: {client_id}, {username}")
-    return False
+    return None
+
+
+def _filter_covers(allowed, requested):
+    """Whether every topic matching filter `requested` also matches `allowed`"""
+    allowed_levels = allowed.split("/")
+    requested_levels = requested.split("/")
+    for i, level in enumerate(allowed_levels):
+        if level == "#":
+            return True
+        if i == len(requested_levels):
+            return False
+        if requested_levels[i] == "#" or (requested_levels[i] == "+" and level != "+"):
+            return False
+        if level not in ("+", requested_levels[i]):
+            return False
+    return len(requested_levels) == len(allowed_levels)
 
-# Message handler
-async def on_message(client_id, topic, payload, qos, **kwargs):
-    logger.info(f"Message received from {client_id} on topic {topic}: {payload.decode()}")
-    return 0
 
-# Create and configure MQTT server
-server = Server()
+class TopicAcl:
+    """Topic filters a client may publish to and subscribe to"""
 
-# Setup broker events
-server.on_connect = authenticate
-server.on_message = on_message
+    __slots__ = ("publish", "deny_publish", "subscribe")
 
-async def start_broker():
-    await server.start(host=settings.MQTT_BROKER_HOST, port=settings.MQTT_BROKER_PORT)
-    logger.info(f"MQTT broker started on {settings.MQTT_BROKER_HOST}:{settings.MQTT_BROKER_PORT}")
-    
-    # Keep the broker running
+    def __init__(self, publish=(), subscribe=(), deny_publish=()):
+        self.publish = tuple(publish)
+        self.deny_publish = tuple(deny_publish)
+        self.subscribe = tuple(subscribe)
+
+    def can_publish(self, topic):
+        return any(_filter_covers(f, topic) for f in self.publish) and not any(
+            _filter_covers(f, topic) for f in self.deny_publish
+        )
+
+    def can_subscribe(self, topic_filter):
+        return any(_filter_covers(f, topic_filter) for f in self.subscribe)
+
+
+NO_ACCESS = TopicAcl()
+
+
+def topic_acl(role, username):
+    """Access for an authenticated role, following mosquitto/config/acl.conf:
+    admins may do anything, operators command robots and read their
+    positions, and robots (whose username is their robot id) read their own
+    commands and report on their own topics. Anonymous clients, when
+    allowed, are robots that may use any robot id."""
+    if role == "admin":
+        return TopicAcl(publish=["#"], subscribe=["#"])
+    if role == "operator":
+        return TopicAcl(publish=["robot/+/commands"], subscribe=["robot/+/position"])
+    if role == "robot":
+        if not username or any(char in username for char in "/+#"):
+            return NO_ACCESS
+        return TopicAcl(
+            publish=[f"robot/{username}/#"],
+            deny_publish=[f"robot/{username}/commands"],
+            subscribe=[f"robot/{username}/commands"],
+        )
+    if role is None and username is None:
+        return TopicAcl(publish=["robot/+/#"], deny_publish=["robot/+/commands"], subscribe=["robot/+/commands"])
+    return NO_ACCESS
+
+
+class _AuthThrottle:
+    """Failed CONNECTs per client address in fixed one-minute windows"""
+
+    WINDOW = 60.0
+    MAX_TRACKED = 10000
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._failures = {}  # address -> (window start, count)
+
+    def allowed(self, address, now):
+        entry = self._failures.get(address)
+        if entry is None:
+            return True
+        if now - entry[0] >= self.WINDOW:
+            del self._failures[address]
+            return True
+        return entry[1] < self.limit
+
+    def failed(self, address, now):
+        entry = self._failures.get(address)
+        if entry is None or now - entry[0] >= self.WINDOW:
+            if len(self._failures) >= self.MAX_TRACKED:
+                self._failures = {
+                    key: value for key, value in self._failures.items() if now - value[0] < self.WINDOW
+                }
+            entry = (now, 0)
+        self._failures[address] = (entry[0], entry[1] + 1)
+
+
+def _encode_length(length):
+    encoded = bytearray()
     while True:
-        await asyncio.sleep(1)
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _string(value):
+    return struct.pack("!H", len(value)) + value
+
+
+def _packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+class _Reader:
+    """Cursor over the variable header and payload of one packet"""
+
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def u8(self):
+        if self.pos >= len(self.data):
+            raise ProtocolError("Packet too short")
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def u16(self):
+        if self.pos + 2 > len(self.data):
+            raise ProtocolError("Packet too short")
+        self.pos += 2
+        return struct.unpack_from("!H", self.data, self.pos - 2)[0]
+
+    def binary(self):
+        length = self.u16()
+        if self.pos + length > len(self.data):
+            raise ProtocolError("Packet too short")
+        self.pos += length
+        return bytes(self.data[self.pos - length : self.pos])
+
+    def string(self):
+        try:
+            return self.binary().decode("utf-8")
+        except UnicodeDecodeError:
+            raise ProtocolError("Invalid UTF-8 string")
+
+    def rest(self):
+        rest = bytes(self.data[self.pos :])
+        self.pos = len(self.data)
+        return rest
+
+    def more(self):
+        return self.pos < len(self.data)
+
+
+def _valid_filter(topic_filter):
+    if not topic_filter:
+        return False
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if "#" in level and (level != "#" or i != len(levels) - 1):
+            return False
+        if "+" in level and level != "+":
+            return False
+    return True
+
+
+class _Session:
+    __slots__ = ("client_id", "writer", "keepalive", "acl", "subscriptions", "will", "next_id", "qos2_received")
+
+    def __init__(self, client_id, writer, keepalive, acl, will):
+        self.client_id = client_id
+        self.writer = writer
+        self.keepalive = keepalive
+        self.acl = acl
+        self.subscriptions = {}  # topic filter -> granted qos
+        self.will = will  # (topic, payload, qos, retain) or None
+        self.next_id = 0
+        self.qos2_received = set()  # QoS 2 packet ids awaiting PUBREL
+
+    def packet_id(self):
+        self.next_id = self.next_id % 65535 + 1
+        return self.next_id
+
+    def send(self, data):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > settings.MQTT_EMBEDDED_MAX_BUFFER:
+            # Deliveries are never queued in the broker, so a client that stops
+            # reading is dropped instead of buffering without bound
+            logger.warning(f"MQTT client {self.client_id} is not reading, disconnecting")
+            self.writer.close()
+            return
+        self.writer.write(data)
+
+
+class Broker:
+    """Minimal MQTT 3.1.1 broker running on the application's event loop.
+
+    Supports clean sessions with QoS 0 and 1 delivery (QoS 2 publishes are
+    accepted and forwarded at QoS 1), retained messages, wills and
+    keepalives. Every routed message is also handed to `on_message`
+    in-process, so the backend's own handlers see device traffic without a
+    client connection of their own, and `publish` lets the backend inject
+    messages without a network round trip. `on_message` runs on the loop and
+    must not block; it can `pause_reading` from clients instead.
+
+    Clients may only publish and subscribe to the topics their role allows
+    (`topic_acl`); denied publishes are acknowledged and dropped, denied
+    subscriptions get a failure return code. Packets are capped at
+    `MQTT_EMBEDDED_MAX_BUFFER` bytes, addresses with too many failed
+    CONNECTs are refused without a credential check, and at most
+    `MQTT_AUTH_MAX_PENDING` CONNECTs check a password at once.
+    """
+
+    def __init__(self, on_message=None, authenticator=authenticate):
+        self.on_message = on_message
+        self.authenticator = authenticator
+        self._throttle = _AuthThrottle(settings.MQTT_AUTH_FAILURES_PER_MINUTE)
+        self._authenticating = 0
+        self._server = None
+        self._sessions = {}  # client_id -> _Session
+        self._trie = TopicTrie()  # topic filter -> (session, topic filter)
+        self._retained = {}  # topic -> (payload, qos)
+        self._flowing = asyncio.Event()  # cleared to stop reading from clients
+        self._flowing.set()
+
+        # Counters
+        self.connections = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.denied = 0
+        self.received = 0
+        self.delivered = 0
+
+    @property
+    def running(self):
+        return self._server is not None
+
+    async def start(self, host=None, port=None):
+        host = host or settings.MQTT_EMBEDDED_HOST
+        port = port or settings.MQTT_PORT
+        self._server = await asyncio.start_server(self._serve, host, port)
+        logger.info(f"Embedded MQTT broker listening on {host}:{port}")
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for session in list(self._sessions.values()):
+            session.writer.close()
+        await self._server.wait_closed()
+        self._server = None
+        logger.info("Embedded MQTT broker stopped")
+
+    def pause_reading(self):
+        """Stop reading packets from clients, e.g. while `on_message` has no room"""
+        self._flowing.clear()
+
+    def resume_reading(self):
+        self._flowing.set()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Route a message from inside the backend. Must run on the broker's loop."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._route(topic, bytes(payload), qos, retain)
+
+    def _route(self, topic, payload, qos, retain):
+        if retain:
+            if payload:
+                self._retained[topic] = (payload, qos)
+            else:
+                self._retained.pop(topic, None)
+
+        # A client with several matching filters gets one copy at the highest QoS
+        targets = {}
+        for session, topic_filter in self._trie.match(topic):
+            granted = min(qos, session.subscriptions.get(topic_filter, 0))
+            if targets.get(session, -1) < granted:
+                targets[session] = granted
+        encoded_topic = _string(topic.encode())
+        for session, granted in targets.items():
+            self._deliver(session, encoded_topic, payload, granted, False)
+
+        if self.on_message is not None:
+            try:
+                self.on_message(topic, payload)
+            except Exception as e:
+                logger.exception(f"Error dispatching {topic} in-process: {e}")
+
+    def _deliver(self, session, encoded_topic, payload, qos, retain):
+        if qos:
+            body = encoded_topic + struct.pack("!H", session.packet_id()) + payload
+        else:
+            body = encoded_topic + payload
+        session.send(_packet(PUBLISH, qos << 1 | int(retain), body))
+        self.delivered += 1
+
+    async def _read_packet(self, reader, timeout=None):
+        header = await asyncio.wait_for(reader.readexactly(1), timeout)
+        length, multiplier = 0, 1
+        for _ in range(4):
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        else:
+            raise ProtocolError("Malformed remaining length")
+        # Checked before reading, so a peer cannot make us buffer up to 256 MB
+        if length > settings.MQTT_EMBEDDED_MAX_BUFFER:
+            raise ProtocolError(f"Packet of {length} bytes exceeds MQTT_EMBEDDED_MAX_BUFFER")
+        body = await reader.readexactly(length) if length else b""
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def _serve(self, reader, writer):
+        session = None
+        clean_exit = False
+        try:
+            # The whole CONNECT, not just its first byte, must arrive in time
+            packet_type, _, body = await asyncio.wait_for(
+                self._read_packet(reader), settings.MQTT_CONNECT_TIMEOUT
+            )
+            if packet_type != CONNECT:
+                raise ProtocolError("First packet must be CONNECT")
+            session = await self._connect(writer, _Reader(body))
+            if session is None:
+                return
+
+            # Keepalive of 0 disables the timeout; otherwise allow 1.5x (spec)
+            timeout = session.keepalive * 1.5 if session.keepalive else None
+            while True:
+                if not self._flowing.is_set():
+                    await self._flowing.wait()
+                packet_type, flags, body = await self._read_packet(reader, timeout)
+                if packet_type == DISCONNECT:
+                    clean_exit = True
+                    return
+                self._handle(session, packet_type, flags, _Reader(body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except ProtocolError as e:
+            logger.warning(f"MQTT protocol error from {session.client_id if session else 'client'}: {e}")
+        finally:
+            if session is not None and self._sessions.get(session.client_id) is session:
+                self._disconnect(session, clean_exit)
+            writer.close()
+
+    async def _connect(self, writer, data):
+        protocol = data.string()
+        level = data.u8()
+        if (protocol, level) not in (("MQTT", 4), ("MQIsdp", 3)):
+            writer.write(_packet(CONNACK, 0, bytes([0, UNACCEPTABLE_PROTOCOL])))
+            return None
+        flags = data.u8()
+        keepalive = data.u16()
+        client_id = data.string()
+        will = None
+        if flags & 0x04:
+            will_topic = data.string()
+            will = (will_topic, data.binary(), min((flags >> 3) & 0x03, MAX_QOS), bool(flags & 0x20))
+        username = data.string() if flags & 0x80 else None
+        password = data.binary() if flags & 0x40 else None
+
+        if not client_id:
+            if not flags & 0x02:
+                writer.write(_packet(CONNACK, 0, bytes([0, IDENTIFIER_REJECTED])))
+                return None
+            client_id = f"auto-{uuid.uuid4().hex}"
+
+        role = None
+        if not settings.MQTT_ALLOW_ANONYMOUS or username is not None:
+            address = (writer.get_extra_info("peername") or ("local",))[0]
+            now = time.monotonic()
+            if not self._throttle.allowed(address, now):
+                writer.write(_packet(CONNACK, 0, bytes([0, NOT_AUTHORIZED])))
+                self.throttled += 1
+                return None
+            if self._authenticating >= settings.MQTT_AUTH_MAX_PENDING:
+                writer.write(_packet(CONNACK, 0, bytes([0, SERVER_UNAVAILABLE])))
+                self.rejected += 1
+                return None
+            self._authenticating += 1
+            try:
+                role = await self.authenticator(client_id, username, password)
+            except PasswordHasherBusy:
+                writer.write(_packet(CONNACK, 0, bytes([0, SERVER_UNAVAILABLE])))
+                self.rejected += 1
+                return None
+            finally:
+                self._authenticating -= 1
+            if not role:
+                self._throttle.failed(address, time.monotonic())
+                writer.write(_packet(CONNACK, 0, bytes([0, BAD_CREDENTIALS])))
+                self.rejected += 1
+                return None
+        acl = topic_acl(role, username)
+
+        if will is not None and not acl.can_publish(will[0]):
+            writer.write(_packet(CONNACK, 0, bytes([0, NOT_AUTHORIZED])))
+            self.denied += 1
+            return None
+
+        # A second connection with the same id takes over (MQTT-3.1.4-2)
+        previous = self._sessions.get(client_id)
+        if previous is not None:
+            self._disconnect(previous, clean=False)
+            previous.writer.close()
+
+        session = _Session(client_id, writer, keepalive, acl, will)
+        self._sessions[client_id] = session
+        self.connections += 1
+        writer.write(_packet(CONNACK, 0, bytes([0, ACCEPTED])))
+        logger.debug(f"MQTT client {client_id} connected")
+        return session
+
+    def _disconnect(self, session, clean):
+        self._sessions.pop(session.client_id, None)
+        for topic_filter in session.subscriptions:
+            self._trie.remove(topic_filter, (session, topic_filter))
+        session.subscriptions = {}
+        if not clean and session.will is not None:
+            self._route(*session.will)
+        logger.debug(f"MQTT client {session.client_id} disconnected")
+
+    def _handle(self, session, packet_type, flags, data):
+        if packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            if qos > 2:
+                raise ProtocolError("Invalid QoS")
+            topic = data.string()
+            if not topic or "+" in topic or "#" in topic:
+                raise ProtocolError(f"Invalid topic name {topic!r}")
+            packet_id = data.u16() if qos else None
+            payload = data.rest()
+            self.received += 1
+            # MQTT 3.1.1 cannot refuse a publish, so denied ones are
+            # acknowledged as usual and dropped
+            allowed = session.acl.can_publish(topic)
+            if not allowed:
+                self.denied += 1
+                logger.debug(f"MQTT client {session.client_id} may not publish to {topic}")
+            if qos == 2:
+                # Deliver on first receipt, ignore retransmissions until PUBREL
+                if allowed and packet_id not in session.qos2_received:
+                    session.qos2_received.add(packet_id)
+                    self._route(topic, payload, MAX_QOS, bool(flags & 0x01))
+                session.send(_packet(PUBREC, 0, struct.pack("!H", packet_id)))
+                return
+            if allowed:
+                self._route(topic, payload, qos, bool(flags & 0x01))
+            if qos == 1:
+                session.send(_packet(PUBACK, 0, struct.pack("!H", packet_id)))
+        elif packet_type == PUBREL:
+            packet_id = data.u16()
+            session.qos2_received.discard(packet_id)
+            session.send(_packet(PUBCOMP, 0, struct.pack("!H", packet_id)))
+        elif packet_type in (PUBACK, PUBREC, PUBCOMP):
+            # Deliveries are not retried, so acknowledgements need no bookkeeping
+            if packet_type == PUBREC:
+                session.send(_packet(PUBREL, 0x02, struct.pack("!H", data.u16())))
+        elif packet_type == SUBSCRIBE:
+            self._subscribe(session, data)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = data.u16()
+            while data.more():
+                topic_filter = data.string()
+                if session.subscriptions.pop(topic_filter, None) is not None:
+                    self._trie.remove(topic_filter, (session, topic_filter))
+            session.send(_packet(UNSUBACK, 0, struct.pack("!H", packet_id)))
+        elif packet_type == PINGREQ:
+            session.send(_packet(PINGRESP, 0, b""))
+        else:
+            raise ProtocolError(f"Unexpected packet type {packet_type}")
+
+    def _subscribe(self, session, data):
+        packet_id = data.u16()
+        granted = bytearray()
+        filters = []
+        while data.more():
+            topic_filter = data.string()
+            requested = data.u8() & 0x03
+            if not _valid_filter(topic_filter) or requested > 2:
+                granted.append(0x80)
+                continue
+            if not session.acl.can_subscribe(topic_filter):
+                self.denied += 1
+                granted.append(0x80)
+                continue
+            qos = min(requested, MAX_QOS)
+            if topic_filter not in session.subscriptions:
+                self._trie.add(topic_filter, (session, topic_filter))
+            session.subscriptions[topic_filter] = qos
+            granted.append(qos)
+            filters.append((topic_filter, qos))
+        session.send(_packet(SUBACK, 0, struct.pack("!H", packet_id) + bytes(granted)))
+
+        # Retained messages are sent after the SUBACK (MQTT-3.8.4-4)
+        if not self._retained or not filters:
+            return
+        matcher = TopicTrie()
+        for topic_filter, qos in filters:
+            matcher.add(topic_filter, qos)
+        for topic, (payload, retained_qos) in self._retained.items():
+            qos = max(matcher.match(topic), default=None)
+            if qos is not None:
+                self._deliver(session, _string(topic.encode()), payload, min(qos, retained_qos), True)
+
+    def stats(self):
+        return {
+            "clients": len(self._sessions),
+            "subscriptions": sum(len(session.subscriptions) for session in self._sessions.values()),
+            "retained": len(self._retained),
+            "connections": self.connections,
+            "rejected": self.rejected,
+            "throttled": self.throttled,
+            "denied": self.denied,
+            "received": self.received,
+            "delivered": self.delivered,
+        }
 
-async def stop_broker():
-    await server.stop()
-    logger.info("MQTT broker stopped")
 
 def run_broker():
-    """Run the MQTT broker in a separate thread"""
+    """Run a standalone broker on its own event loop, e.g. in a thread for tests"""
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    
+    broker = Broker()
     try:
-        loop.run_until_complete(start_broker())
-    except KeyboardInterrupt:
-        loop.run_until_complete(stop_broker())
+        loop.run_until_complete(broker.start())
+        loop.run_forever()
     finally:
+        loop.run_until_complete(broker.stop())
         loop.close()
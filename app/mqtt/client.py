@@ -1,85 +1,296 @@
 import asyncio
-import json
+import collections
 import logging
-from asyncio_mqtt import Client, MqttError
+import random
+import threading
+
+import paho.mqtt.client as mqtt
+
 from app.core.config import settings
+from app.core.mqtt import MQTTClient, _resolve_future
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global MQTT client
-mqtt_client = None
-
-async def connect_mqtt():
-    """Connect to MQTT broker"""
-    global mqtt_client
-    
-    try:
-        mqtt_client = Client(
-            hostname=settings.MQTT_BROKER_HOST,
-            port=settings.MQTT_BROKER_PORT,
-            username=settings.MQTT_USERNAME,
-            password=settings.MQTT_PASSWORD,
-            client_id=settings.MQTT_CLIENT_ID
-        )
-        await mqtt_client.connect()
-        logger.info(f"Connected to MQTT broker at {settings.MQTT_BROKER_HOST}:{settings.MQTT_BROKER_PORT}")
-        return True
-    except MqttError as e:
-        logger.error(f"Failed to connect to MQTT broker: {e}")
-        return False
-
-async def disconnect_mqtt():
-    """Disconnect from MQTT broker"""
-    global mqtt_client
-    if mqtt_client:
-        await mqtt_client.disconnect()
-        logger.info("Disconnected from MQTT broker")
-
-async def publish_message(topic, message):
-    """Publish a message to an MQTT topic"""
-    global mqtt_client
-    
-    if not mqtt_client:
-        success = await connect_mqtt()
-        if not success:
-            return False
-    
-    try:
-        if isinstance(message, dict):
-            message = json.dumps(message)
-        
-        await mqtt_client.publish(topic, message)
-        logger.info(f"Published message to {topic}: {message}")
-        return True
-    except MqttError as e:
-        logger.error(f"Failed to publish message: {e}")
-        return False
-
-async def subscribe(topic, callback):
-    """Subscribe to an MQTT topic with a callback function"""
-    global mqtt_client
-    
-    if not mqtt_client:
-        success = await connect_mqtt()
-        if not success:
+
+class _LoopIngress:
+    """Feeds messages received on the event loop into the dispatcher without
+    ever blocking the loop.
+
+    A message goes into its lanes with non-blocking puts. If a `BLOCK` lane
+    is full, that message and every later one wait in a backlog, which a
+    thread puts with blocking puts; `pause` stops reading from the network
+    meanwhile, and `resume` restarts it once the backlog is empty.
+    """
+
+    def __init__(self, dispatcher, pause, resume):
+        self.dispatcher = dispatcher
+        self._pause = pause
+        self._resume = resume
+        self._backlog = collections.deque()  # (topic, [(lane, item)])
+        self._draining = False
+        self.pauses = 0
+
+    def __call__(self, topic, payload):
+        deliveries = self.dispatcher.route(topic, payload)
+        if not self._backlog:
+            deliveries = [(lane, item) for lane, item in deliveries if not lane.put(topic, item, block=False)]
+            if not deliveries:
+                return
+        self._backlog.append((topic, deliveries))
+        if not self._draining:
+            self._draining = True
+            self.pauses += 1
+            self._pause()
+            self._start_drain()
+
+    def _start_drain(self):
+        future = asyncio.get_running_loop().run_in_executor(None, self._drain)
+        future.add_done_callback(self._drained)
+
+    def _drain(self):
+        # Only the loop appends, so the head stays put until we pop it
+        while self._backlog:
+            topic, deliveries = self._backlog[0]
+            for lane, item in deliveries:
+                lane.put(topic, item)
+            self._backlog.popleft()
+
+    def _drained(self, future):
+        if future.exception() is not None:
+            logger.error(f"Error queueing MQTT messages: {future.exception()}")
+        if self._backlog:
+            # Arrived after the thread saw the backlog empty
+            self._start_drain()
+            return
+        self._draining = False
+        self._resume()
+
+
+class AsyncioMQTTClient(MQTTClient):
+    """`MQTTClient` driven by the application's event loop instead of paho's
+    background thread.
+
+    The paho protocol engine is kept, but its socket is registered with the
+    event loop (`add_reader`/`add_writer`) and keepalives run as a task, so
+    PUBACKs resolve `publish_async` futures without a thread switch. Incoming
+    messages go through the dispatcher's lanes as with paho, so handlers run
+    on its worker threads and may block; while a `BLOCK` lane is full the
+    socket is not read, rather than the loop waiting for room. A dropped connection is retried
+    with exponential backoff between `MQTT_RECONNECT_MIN_DELAY` and
+    `MQTT_RECONNECT_MAX_DELAY`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self._loop_thread = None
+        self._misc_task = None
+        self._reconnect_task = None
+        self._stopping = False
+        self._fd = None
+        self._reading = True
+        self._ingress = _LoopIngress(self.dispatcher, self._pause_reading, self._resume_reading)
+        self.reconnects = 0
+
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def connect(self):
+        """Start connecting in the background; must be called from the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopping = False
+        self.dispatcher.start()
+        logger.info(f"Connecting to MQTT broker at {settings.MQTT_BROKER}:{settings.MQTT_PORT}")
+        self.client.connect_async(settings.MQTT_BROKER, settings.MQTT_PORT, 60)
+        self._schedule_reconnect(immediately=True)
+
+    def disconnect(self):
+        self._stopping = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        try:
+            self.client.disconnect()
+            # Flush the DISCONNECT packet before the socket goes away
+            self.client.loop_write()
+            logger.info("Disconnected from MQTT broker")
+        except Exception as e:
+            logger.error(f"Error disconnecting from MQTT: {e}")
+        self.connected = False
+        self.dispatcher.stop()
+
+    def _schedule_reconnect(self, immediately=False):
+        if self._stopping or (self._reconnect_task is not None and not self._reconnect_task.done()):
+            return
+        if not immediately:
+            self.reconnects += 1
+        self._reconnect_task = self.loop.create_task(self._reconnect(immediately))
+
+    async def _reconnect(self, immediately):
+        delay = settings.MQTT_RECONNECT_MIN_DELAY
+        while not self._stopping:
+            if not immediately:
+                # Full jitter, so several backends do not reconnect in lockstep
+                await asyncio.sleep(random.uniform(0, delay))
+                delay = min(delay * 2, settings.MQTT_RECONNECT_MAX_DELAY)
+            immediately = False
+            try:
+                # Name resolution and the TCP handshake block; everything
+                # after them runs on the loop
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                return
+            except OSError as e:
+                logger.warning(f"Failed to connect to MQTT broker: {e}")
+
+    def on_disconnect(self, client, userdata, rc):
+        super().on_disconnect(client, userdata, rc)
+        if rc != 0 and not self._stopping:
+            self._call_in_loop(self._schedule_reconnect)
+
+    def _settle(self, future, result):
+        if (
+            isinstance(future, asyncio.Future)
+            and threading.get_ident() == self._loop_thread
+            and future.get_loop() is self.loop
+        ):
+            _resolve_future(future, result)
+        else:
+            super()._settle(future, result)
+
+    def on_message(self, client, userdata, msg):
+        # Runs on the loop, inside loop_read
+        self._ingress(msg.topic, msg.payload)
+
+    def _pause_reading(self):
+        self._reading = False
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+
+    def _resume_reading(self):
+        self._reading = True
+        if self._fd is not None:
+            self.loop.add_reader(self._fd, self.client.loop_read)
+
+    # Socket callbacks. paho calls these from whichever thread touched the
+    # socket (the executor during connect, request threads when publishing),
+    # but the loop's reader/writer registry may only be changed on the loop.
+
+    def _call_in_loop(self, callback, *args):
+        if threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    # File descriptors are taken while paho still holds the socket open,
+    # since it may be closed by the time the loop runs the callback.
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call_in_loop(self._attach, sock.fileno())
+
+    def _attach(self, fd):
+        self._fd = fd
+        if self._reading:
+            self.loop.add_reader(fd, self.client.loop_read)
+        if self._misc_task is None:
+            self._misc_task = self.loop.create_task(self._misc())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call_in_loop(self._detach, sock.fileno())
+
+    def _detach(self, fd):
+        if self._fd == fd:
+            self._fd = None
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call_in_loop(self.loop.add_writer, sock.fileno(), self.client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call_in_loop(self.loop.remove_writer, sock.fileno())
+
+    async def _misc(self):
+        # Keepalive pings and retries of unacknowledged QoS 1 messages
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class EmbeddedMQTTClient(MQTTClient):
+    """`MQTTClient` that hosts the broker itself (`app.mqtt.broker.Broker`).
+
+    Devices connect straight to the backend on `MQTT_PORT`. Their messages
+    go straight into the dispatcher's lanes and commands published by the
+    backend go directly into the broker's routing, so no message makes an
+    extra trip through a loopback client connection. While a `BLOCK` lane is
+    full the broker stops reading from its clients, rather than the loop
+    waiting for room.
+    """
+
+    def __init__(self):
+        super().__init__()
+        from app.mqtt.broker import Broker
+
+        self._ingress = _LoopIngress(self.dispatcher, self._pause_reading, self._resume_reading)
+        self.broker = Broker(on_message=self._ingress)
+        self.loop = None
+        self._loop_thread = None
+        self._start_task = None
+
+    def connect(self):
+        """Start the broker; must be called from the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.dispatcher.start()
+        self._start_task = self.loop.create_task(self._start())
+
+    async def _start(self):
+        try:
+            await self.broker.start()
+            self.connected = True
+        except OSError as e:
+            logger.error(f"Failed to start embedded MQTT broker: {e}")
+
+    def disconnect(self):
+        self.connected = False
+        if self.loop is not None and self.broker.running:
+            self.loop.create_task(self.broker.stop())
+        self.dispatcher.stop()
+
+    def _pause_reading(self):
+        self.broker.pause_reading()
+
+    def _resume_reading(self):
+        self.broker.resume_reading()
+
+    def subscribe(self, topic_filter, qos=1):
+        # Every routed message already reaches the dispatcher
+        self._subscriptions[topic_filter] = qos
+
+    def _publish(self, topic, payload, qos, retain, future=None):
+        if not self.connected:
+            logger.warning(f"Cannot publish to {topic}: Embedded MQTT broker is not running")
             return False
-    
-    try:
-        await mqtt_client.subscribe(topic)
-        logger.info(f"Subscribed to topic: {topic}")
-        
-        async with mqtt_client.filtered_messages(topic) as messages:
-            async for message in messages:
-                try:
-                    payload = message.payload.decode()
-                    logger.info(f"Received message on {topic}: {payload}")
-                    await callback(topic, payload)
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
-        
+        if threading.get_ident() == self._loop_thread:
+            self.broker.publish(topic, payload, qos, retain)
+        else:
+            self.loop.call_soon_threadsafe(self.broker.publish, topic, payload, qos, retain)
+        if future is not None:
+            # Accepted by the broker, which is what a PUBACK means
+            self._settle(future, True)
         return True
-    except MqttError as e:
-        logger.error(f"Failed to subscribe to topic: {e}")
-        return False
+
+    def _settle(self, future, result):
+        if (
+            isinstance(future, asyncio.Future)
+            and threading.get_ident() == self._loop_thread
+            and future.get_loop() is self.loop
+        ):
+            _resolve_future(future, result)
+        else:
+            super()._settle(future, result)
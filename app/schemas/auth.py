@@ -6,4 +6,13 @@ class Token(BaseModel):
     refresh_token: str = None
 
 class TokenPayload(BaseModel):
-    sub: str = None
\ No newline at end of file
+    sub: str = None
+
+class Principal(BaseModel):
+    """The authenticated user as seen by request handlers"""
+    id: int
+    username: str
+    role: str
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,66 @@
+from typing import List, Optional
+from pydantic import BaseModel
+
+class PathResult(BaseModel):
+    source: int
+    target: int
+    nodes: List[int]  # Node ids from source to target, inclusive
+    distance_cm: float
+
+class DistanceQuery(BaseModel):
+    sources: List[int]
+    targets: List[int]
+
+class DistanceMatrixResult(BaseModel):
+    sources: List[int]
+    targets: List[int]
+    distances: List[List[Optional[float]]]  # distances[i][j] in cm, null if unreachable
+
+class Point(BaseModel):
+    x: float
+    y: float
+
+class NearestQuery(BaseModel):
+    points: List[Point]
+    # Nearest k nodes per point, at most `radius` away if given; with k null
+    # every node within the radius is returned
+    k: Optional[int] = 1
+    radius: Optional[float] = None
+
+class NodeMatch(BaseModel):
+    node_id: int
+    distance: float  # in coordinate units
+
+class NearestResult(BaseModel):
+    matches: List[List[NodeMatch]]  # matches[i] for points[i], closest first
+
+class RouteRequest(BaseModel):
+    robot_id: str
+    source: int
+    target: int
+    priority: int = 0  # Higher priorities are planned first
+
+class RouteBatch(BaseModel):
+    requests: List[RouteRequest]
+
+class Waypoint(BaseModel):
+    node_id: int
+    arrive_at: float  # Unix timestamps
+    depart_at: Optional[float] = None  # null at the goal, where the robot stays
+
+class RoutePlan(BaseModel):
+    robot_id: str
+    status: str  # "planned", "no_route" or "unknown_node"
+    waypoints: List[Waypoint]
+
+class RouteBatchResult(BaseModel):
+    planned: int
+    routes: List[RoutePlan]
+
+class Reservation(BaseModel):
+    node_id: int
+    at: float
+
+class RobotReservations(BaseModel):
+    robot_id: str
+    reservations: List[Reservation]  # Remaining reserved node visits, in time order
@@ -0,0 +1,60 @@
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel
+
+class RobotStatus(BaseModel):
+    robot_id: str
+    x: float
+    y: float
+    battery: Optional[float] = None
+    node_id: Optional[int] = None
+    updated_at: float  # Unix timestamp of the last position report
+
+class FleetStatus(BaseModel):
+    count: int
+    robots: List[RobotStatus]
+
+class Zone(BaseModel):
+    """Axis-aligned area of the warehouse, in node coordinates"""
+    x_min: float
+    y_min: float
+    x_max: float
+    y_max: float
+
+class BulkCommand(BaseModel):
+    command: dict
+    # Targets, combined: explicit ids, a glob over command topics such as
+    # "robot/aisle3-*/commands", and robots last reported inside a zone
+    robot_ids: List[str] = []
+    topic_pattern: Optional[str] = None
+    zone: Optional[Zone] = None
+    # Wait for every QoS 1 PUBACK, sharing a single deadline
+    wait_for_ack: bool = False
+    timeout: float = 1.0
+
+class CommandDelivery(BaseModel):
+    robot_id: str
+    # The command queue outcome ("sent", "queued", "coalesced", "superseded",
+    # "failed" or "rejected"), or with wait_for_ack "acked", "timeout",
+    # "superseded", "failed" or "rejected"
+    status: str
+
+class BulkCommandResult(BaseModel):
+    count: int
+    delivered: int
+    results: List[CommandDelivery]
+
+class TelemetryPoint(BaseModel):
+    recorded_at: datetime  # Sample time, or bucket start for rollups
+    x: float
+    y: float
+    battery: Optional[float] = None  # Average over the bucket for rollups
+    node_id: Optional[int] = None
+    samples: int = 1
+    battery_min: Optional[float] = None
+
+class RobotHistory(BaseModel):
+    robot_id: str
+    resolution: str  # "raw", "1s" or "1m"
+    count: int
+    points: List[TelemetryPoint]
@@ -1,86 +1,69 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Enum, Index
-from sqlalchemy.orm import relationship
-from app.db.base import Base
-import enum
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel
+from app.models.warhouse import TaskStatus
 
-class TaskStatus(enum.Enum):
-    PENDING = "pending"
-    IN_PROGRESS = "in_progress"
-    COMPLETED = "completed"
-    FAILED = "failed"
+class NodeBase(BaseModel):
+    name: Optional[str] = None
+    x_pos: float
+    y_pos: float
 
-class Node(Base):
-    __tablename__ = "nodes"
+class Node(NodeBase):
+    id: int
 
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, index=True)
-    x_pos = Column(Float, nullable=False)
-    y_pos = Column(Float, nullable=False)
+    class Config:
+        from_attributes = True
 
-    # Relationships
-    outgoing_edges = relationship("Edge", foreign_keys="Edge.source_id", back_populates="source_node")
-    incoming_edges = relationship("Edge", foreign_keys="Edge.target_id", back_populates="target_node")
-    robots = relationship("Robot", back_populates="current_node")
-    
-    # Tasks starting or ending at this node
-    starting_tasks = relationship("Task", foreign_keys="Task.start_node_id", back_populates="start_node")
-    ending_tasks = relationship("Task", foreign_keys="Task.end_node_id", back_populates="end_node")
-    
-    # Index for spatial queries (will help with finding nearest nodes)
-    __table_args__ = (
-        Index('idx_node_position', 'x_pos', 'y_pos'),
-    )
+class EdgeBase(BaseModel):
+    source_id: int
+    target_id: int
+    weight_cm: int  # Distance in centimeters
 
-class Edge(Base):
-    __tablename__ = "edges"
+class Edge(EdgeBase):
+    id: int
 
-    id = Column(Integer, primary_key=True, index=True)
-    source_id = Column(Integer, ForeignKey("nodes.id", ondelete="CASCADE"), nullable=False)
-    target_id = Column(Integer, ForeignKey("nodes.id", ondelete="CASCADE"), nullable=False)
-    weight_cm = Column(Integer, nullable=False)  # Distance in centimeters
+    class Config:
+        from_attributes = True
 
-    # Relationships
-    source_node = relationship("Node", foreign_keys=[source_id], back_populates="outgoing_edges")
-    target_node = relationship("Node", foreign_keys=[target_id], back_populates="incoming_edges")
-    
-    # Composite index for quickly finding paths between nodes
-    __table_args__ = (
-        Index('idx_edge_source_target', 'source_id', 'target_id', unique=True),
-    )
+class Robot(BaseModel):
+    id: int
+    current_node_id: int
+    battery: float
 
-class Robot(Base):
-    __tablename__ = "robots"
+    class Config:
+        from_attributes = True
 
-    id = Column(Integer, primary_key=True, index=True)
-    current_node_id = Column(Integer, ForeignKey("nodes.id"), nullable=False)
-    battery = Column(Float, nullable=False)  # Battery percentage (0-100)
+class TaskCreate(BaseModel):
+    start_node_id: int
+    end_node_id: int
 
-    # Relationships
-    current_node = relationship("Node", back_populates="robots")
-    tasks = relationship("Task", back_populates="robot")
-    
-    # Index for finding robots by battery level (useful for scheduling)
-    __table_args__ = (
-        Index('idx_robot_battery', 'battery'),
-    )
+class Task(BaseModel):
+    id: int
+    start_node_id: int
+    end_node_id: int
+    robot_id: Optional[int] = None
+    status: TaskStatus
+    # Unix timestamp of the last event, only known for active tasks
+    updated_at: Optional[float] = None
 
-class Task(Base):
-    __tablename__ = "tasks"
+    class Config:
+        from_attributes = True
 
-    id = Column(Integer, primary_key=True, index=True)
-    start_node_id = Column(Integer, ForeignKey("nodes.id"), nullable=False)
-    end_node_id = Column(Integer, ForeignKey("nodes.id"), nullable=False)
-    robot_id = Column(Integer, ForeignKey("robots.id"), nullable=True)  # Nullable for unassigned tasks
-    status = Column(Enum(TaskStatus), nullable=False, default=TaskStatus.PENDING, index=True)
-    
-    # Relationships
-    start_node = relationship("Node", foreign_keys=[start_node_id], back_populates="starting_tasks")
-    end_node = relationship("Node", foreign_keys=[end_node_id], back_populates="ending_tasks")
-    robot = relationship("Robot", back_populates="tasks")
-    
-    # Indexes for common queries
-    __table_args__ = (
-        Index('idx_task_status', 'status'),
-        Index('idx_task_robot', 'robot_id'),
-        Index('idx_task_nodes', 'start_node_id', 'end_node_id'),
-    )
\ No newline at end of file
+class TaskList(BaseModel):
+    count: int
+    tasks: List[Task]
+
+class TaskEvent(BaseModel):
+    task_id: int
+    robot_id: Optional[int] = None
+    status: TaskStatus
+    event: str
+    detail: Optional[str] = None
+    recorded_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class TaskHistory(BaseModel):
+    task: Task
+    events: List[TaskEvent]
@@ -0,0 +1,248 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from app.core.cluster import cluster
+from app.core.config import settings
+from app.services.graph import warehouse_graph
+
+logger = logging.getLogger(__name__)
+
+
+def _fingerprint(csr):
+    digest = hashlib.blake2b(digest_size=16)
+    for values in (csr.node_ids, csr.indptr, csr.indices, csr.weights):
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+class DistanceMatrix:
+    """Precomputed all-pairs distance and next-hop tables for the warehouse graph.
+
+    The tables are NumPy arrays persisted as `.npy` files and opened as shared
+    memory maps, so every uvicorn worker on the host reads the same copy.
+    They are built one row at a time with a Dijkstra search per source over
+    the graph's CSR arrays, written straight into the files. A single edge
+    change is applied incrementally: a cheaper edge relaxes every
+    pair through it in one vectorized pass, and a dearer or removed edge only
+    recomputes the rows whose shortest paths used it. Node additions and
+    removals trigger a full rebuild.
+
+    With `CLUSTER_ENABLED=true` only the leader builds and updates the
+    tables. The other workers map them read-only and trust the leader's
+    fingerprint, since their own copy of the graph may lag behind; until the
+    leader has written the tables they answer from the graph. The leader
+    holds `<base>.lock` exclusively while it builds or patches the tables,
+    and followers hold it shared while they read them.
+    """
+
+    # Above this share of affected rows a full rebuild is cheaper
+    REBUILD_FRACTION = 0.25
+
+    def __init__(self, graph=warehouse_graph, base_path=None):
+        self.graph = graph
+        self.base_path = base_path or settings.DISTANCE_MATRIX_PATH
+        self._lock = threading.Lock()
+        self.node_ids = None
+        self.index = None
+        self.dist = None
+        self.next_hop = None
+        self._meta_mtime = None
+        self._stale = True
+        self._writable = False
+        graph.add_listener(self._on_graph_changes)
+
+    def _file(self, name):
+        return f"{self.base_path}.{name}.npy"
+
+    @property
+    def _meta_file(self):
+        return f"{self.base_path}.meta.json"
+
+    def _meta_changed(self):
+        try:
+            return os.stat(self._meta_file).st_mtime_ns != self._meta_mtime
+        except FileNotFoundError:
+            return True
+
+    @property
+    def builder(self):
+        """Whether this worker builds the tables, rather than only reading them"""
+        return not settings.CLUSTER_ENABLED or cluster.is_leader
+
+    def ensure_ready(self):
+        """Open the current tables; returns False if there are none to read yet"""
+        builder = self.builder
+        if self._stale or self._writable != builder or self._meta_changed():
+            with self._lock:
+                if self._stale or self._writable != builder or self._meta_changed():
+                    if builder:
+                        self._load_or_build()
+                    elif not self._load_shared():
+                        return False
+        return True
+
+    def _load_or_build(self):
+        csr = self.graph.snapshot()
+        fingerprint = _fingerprint(csr)
+        os.makedirs(os.path.dirname(self.base_path) or ".", exist_ok=True)
+
+        # Serialize builds across workers; whoever comes second just opens the files
+        with open(f"{self.base_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self._meta_file) as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                meta = None
+            if meta is None or meta.get("fingerprint") != fingerprint:
+                self._build(csr, fingerprint)
+            self._open(writable=True)
+        self._stale = False
+
+    def _load_shared(self):
+        # Take the lock so we never map a half-replaced set of files
+        try:
+            with open(f"{self.base_path}.lock") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                self._open(writable=False)
+        except FileNotFoundError:
+            return False
+        self._stale = False
+        return True
+
+    def _build(self, csr, fingerprint):
+        n = len(csr.node_ids)
+        tables = {
+            name: np.lib.format.open_memmap(f"{self._file(name)}.tmp", mode="w+", dtype=dtype, shape=shape)
+            for name, dtype, shape in (("nodes", np.int64, (n,)), ("dist", np.float32, (n, n)), ("next", np.int32, (n, n)))
+        }
+        tables["nodes"][:] = np.frombuffer(csr.node_ids, dtype=np.int64)
+        dist, next_hop = tables["dist"], tables["next"]
+        for row in range(n):
+            dist[row], next_hop[row] = csr.dijkstra(row)
+        logger.info(f"Built all-pairs distance matrix for {n} nodes")
+
+        for name, out in tables.items():
+            out.flush()
+            os.replace(f"{self._file(name)}.tmp", self._file(name))
+        self._write_meta(fingerprint)
+
+    def _write_meta(self, fingerprint):
+        tmp = f"{self._meta_file}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"fingerprint": fingerprint}, f)
+        os.replace(tmp, self._meta_file)
+
+    def _open(self, writable):
+        mode = "r+" if writable else "r"
+        meta_mtime = os.stat(self._meta_file).st_mtime_ns
+        self.node_ids = np.load(self._file("nodes"))
+        self.index = {int(node_id): i for i, node_id in enumerate(self.node_ids)}
+        self.dist = np.load(self._file("dist"), mmap_mode=mode)
+        self.next_hop = np.load(self._file("next"), mmap_mode=mode)
+        self._meta_mtime = meta_mtime
+        self._writable = writable
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Keep the leader from patching the tables while we read them"""
+        if self._writable:
+            with self._lock:
+                yield
+            return
+        with open(f"{self.base_path}.lock") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            yield
+
+    def distances(self, source_ids, target_ids):
+        """Distance matrix (inf where unreachable) between two lists of node ids.
+
+        Raises KeyError for unknown nodes.
+        """
+        if not self.ensure_ready():
+            return np.array(self.graph.distances(source_ids, target_ids), dtype=np.float64)
+        with self._reading():
+            rows = [self.index[node_id] for node_id in source_ids]
+            cols = [self.index[node_id] for node_id in target_ids]
+            return self.dist[np.ix_(rows, cols)]
+
+    def path(self, source_id, target_id):
+        """Node ids along the shortest path, or None if unreachable"""
+        if not self.ensure_ready():
+            result = self.graph.shortest_path(source_id, target_id)
+            return None if result is None else result[0]
+        with self._reading():
+            i = self.index[source_id]
+            j = self.index[target_id]
+            if self.next_hop[i, j] < 0:
+                return None
+            path = [i]
+            while i != j:
+                i = int(self.next_hop[i, j])
+                path.append(i)
+            return [int(self.node_ids[k]) for k in path]
+
+    def _on_graph_changes(self, changes):
+        if self._stale or self.dist is None or not self._writable:
+            return  # Followers pick up the leader's updates through the files
+        with self._lock, open(f"{self.base_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            for kind, key, old, new in changes:
+                if kind in ("edge", "edge_deleted"):
+                    if not self._update_edge(key, old, new):
+                        self._stale = True
+                elif kind == "node" and old is not None:
+                    continue  # Coordinates do not affect distances
+                else:
+                    self._stale = True
+                if self._stale:
+                    return
+            self.dist.flush()
+            self.next_hop.flush()
+            self._write_meta(_fingerprint(self.graph.snapshot()))
+            self._meta_mtime = os.stat(self._meta_file).st_mtime_ns
+
+    def _update_edge(self, key, old, new):
+        u = self.index.get(key[0])
+        v = self.index.get(key[1])
+        if u is None or v is None:
+            return False
+        old = np.inf if old is None else old
+        new = np.inf if new is None else new
+        dist, next_hop = self.dist, self.next_hop
+
+        if new < old:
+            # Every pair can only get shorter by going through the new edge
+            via = dist[:, u, None] + np.float32(new) + dist[None, v, :]
+            better = via < dist
+            hops = next_hop[:, u].copy()
+            hops[u] = v
+            np.copyto(dist, via, where=better)
+            np.copyto(next_hop, hops[:, None], where=better)
+            return True
+
+        if new > old:
+            # Only pairs whose shortest path ran through the edge can change
+            candidates = np.flatnonzero(np.isfinite(dist[:, u]))
+            via = dist[candidates, u, None] + np.float32(old) + dist[None, v, :]
+            through = np.isfinite(via) & np.isclose(via, dist[candidates])
+            rows = candidates[through.any(axis=1)]
+            if len(rows) > self.REBUILD_FRACTION * len(dist):
+                return False
+            csr = self.graph.snapshot()
+            for row in rows:
+                row_dist, row_first = csr.dijkstra(int(row))
+                dist[row] = row_dist
+                next_hop[row] = row_first
+        return True
+
+
+# Only available when DISTANCE_MATRIX_ENABLED is set; the tables are built on first use
+distance_matrix = DistanceMatrix() if settings.DISTANCE_MATRIX_ENABLED else None
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import logging
+from collections import deque
+
+from app.core.config import settings
+from app.core.telemetry import telemetry_store
+
+logger = logging.getLogger(__name__)
+
+# Record fields streamed to clients
+FIELDS = ("x", "y", "battery", "node_id", "updated_at")
+
+
+class FleetStream:
+    """Fan-out of telemetry changes to WebSocket and SSE viewers.
+
+    A single tick task on the event loop polls the telemetry store for
+    robots updated since the previous tick (which also works on workers that
+    only read the shared store) and turns them into a per-tick log of
+    changed fields, at most `max_fps` times a second. A viewer only remembers
+    the last tick it was sent; its next frame is the merge of every tick
+    since then, so a slow consumer always receives the current state in one
+    frame instead of a backlog. Viewers at the same tick share one encoded frame, which keeps
+    the per-viewer cost of a busy tick to a dictionary lookup. A viewer that
+    falls further behind than the retained history gets a full snapshot.
+    """
+
+    def __init__(self, store=telemetry_store, max_fps=None, history_seconds=None):
+        self.store = store
+        self.max_fps = max_fps or settings.STREAM_MAX_FPS
+        history_ticks = int((history_seconds or settings.STREAM_HISTORY_SECONDS) * self.max_fps)
+        self._seen = []  # per-slot sequence numbers already turned into ticks
+        self._state = {}  # robot_id -> tuple of FIELDS, as of the latest tick
+        self._ticks = deque(maxlen=max(history_ticks, 1))  # (seq, {robot_id: changed fields})
+        self.seq = 0
+        self._frames = {}  # since seq -> encoded frame for the current seq
+        self._next_tick = None
+        self._task = None
+        self.viewers = 0
+
+    def _tick(self):
+        changes = {}
+        for record in self.store.changes_since(self._seen):
+            robot_id = record["robot_id"]
+            values = tuple(record[field] for field in FIELDS)
+            previous = self._state.get(robot_id)
+            if previous == values:
+                continue
+            self._state[robot_id] = values
+            changes[robot_id] = {
+                field: value
+                for field, value, old in zip(FIELDS, values, previous or (None,) * len(FIELDS))
+                if previous is None or value != old
+            }
+        if not changes:
+            return False
+        self.seq += 1
+        self._ticks.append((self.seq, changes))
+        self._frames = {}
+        return True
+
+    async def _run(self):
+        interval = 1.0 / self.max_fps
+        loop = asyncio.get_running_loop()
+        while self.viewers:
+            started = loop.time()
+            try:
+                if self._tick():
+                    waiting, self._next_tick = self._next_tick, loop.create_future()
+                    waiting.set_result(self.seq)
+            except Exception as e:
+                logger.exception(f"Fleet stream tick failed: {e}")
+            await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
+        self._task = None
+
+    def frame(self, since):
+        """Encoded frame bringing a viewer at tick `since` up to date, or None.
+
+        `since=None` (a new viewer) or a tick older than the retained history
+        returns a full snapshot.
+        """
+        if since == self.seq:
+            return None
+        frame = self._frames.get(since)
+        if frame is not None:
+            return frame
+
+        oldest = self._ticks[0][0] if self._ticks else self.seq + 1
+        if since is None or since < oldest - 1:
+            robots = {
+                robot_id: dict(zip(FIELDS, values)) for robot_id, values in self._state.items()
+            }
+            kind = "snapshot"
+        else:
+            robots = {}
+            for seq, changes in self._ticks:
+                if seq <= since:
+                    continue
+                for robot_id, fields in changes.items():
+                    merged = robots.get(robot_id)
+                    if merged is None:
+                        robots[robot_id] = dict(fields)
+                    else:
+                        merged.update(fields)
+            kind = "delta"
+        frame = json.dumps({"type": kind, "seq": self.seq, "robots": robots})
+        self._frames[since] = frame
+        return frame
+
+    async def wait(self, since):
+        """Wait until there is a tick newer than `since`"""
+        if since is not None and since == self.seq:
+            await asyncio.shield(self._next_tick)
+
+    async def subscribe(self, max_fps=None):
+        """Yield encoded frames for one viewer, at most `max_fps` per second"""
+        interval = 1.0 / min(max_fps or self.max_fps, self.max_fps)
+        loop = asyncio.get_running_loop()
+        self.viewers += 1
+        if self._task is None:
+            # Bring the state up to date before the first frame
+            self._tick()
+            self._next_tick = loop.create_future()
+            self._task = loop.create_task(self._run())
+        try:
+            since = None
+            while True:
+                started = loop.time()
+                frame = self.frame(since)
+                since = self.seq
+                if frame is not None:
+                    yield frame
+                await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
+                await self.wait(since)
+        finally:
+            self.viewers -= 1
+
+    def stats(self):
+        return {
+            "viewers": self.viewers,
+            "seq": self.seq,
+            "robots": len(self._state),
+            "max_fps": self.max_fps,
+            "history_ticks": len(self._ticks),
+        }
+
+
+# Create a global fleet stream instance
+fleet_stream = FleetStream()
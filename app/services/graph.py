@@ -0,0 +1,374 @@
+import heapq
+import logging
+import math
+import threading
+from array import array
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app.core.cluster import cluster
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.warhouse import Edge, Node
+
+logger = logging.getLogger(__name__)
+
+
+class _CSRGraph:
+    """Compressed sparse row snapshot of the warehouse graph"""
+
+    __slots__ = ("node_ids", "index", "xs", "ys", "indptr", "indices", "weights", "heuristic_scale")
+
+    def __init__(self, nodes, edges, coordinate_scale):
+        node_ids = sorted(nodes)
+        index = {node_id: i for i, node_id in enumerate(node_ids)}
+
+        counts = [0] * (len(node_ids) + 1)
+        for source_id, _ in edges:
+            counts[index[source_id] + 1] += 1
+        indptr = array("l", counts)
+        for i in range(1, len(indptr)):
+            indptr[i] += indptr[i - 1]
+
+        fill = array("l", indptr)
+        indices = array("l", [0]) * len(edges)
+        weights = array("d", [0.0]) * len(edges)
+        for (source_id, target_id), weight in edges.items():
+            u = index[source_id]
+            pos = fill[u]
+            fill[u] += 1
+            indices[pos] = index[target_id]
+            weights[pos] = weight
+
+        self.node_ids = array("q", node_ids)
+        self.index = index
+        self.xs = array("d", (nodes[node_id][0] for node_id in node_ids))
+        self.ys = array("d", (nodes[node_id][1] for node_id in node_ids))
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.heuristic_scale = self._admissible_scale(coordinate_scale)
+
+    def _admissible_scale(self, coordinate_scale):
+        # The straight-line heuristic is only admissible if no edge is shorter
+        # than the distance between its endpoints, so clamp the scale to the
+        # tightest edge in the map.
+        scale = coordinate_scale
+        for u in range(len(self.xs)):
+            for pos in range(self.indptr[u], self.indptr[u + 1]):
+                scale = self._tighten(scale, u, self.indices[pos], self.weights[pos])
+        return scale
+
+    def _tighten(self, scale, u, v, weight):
+        distance = math.hypot(self.xs[u] - self.xs[v], self.ys[u] - self.ys[v])
+        if distance > 0 and weight < scale * distance:
+            return weight / distance
+        return scale
+
+    def edge_position(self, u, v):
+        for pos in range(self.indptr[u], self.indptr[u + 1]):
+            if self.indices[pos] == v:
+                return pos
+        return None
+
+    def astar(self, s, t):
+        """Return (node indices, cost) of the shortest s -> t path, or None"""
+        xs, ys, indptr, indices, weights = self.xs, self.ys, self.indptr, self.indices, self.weights
+        scale = self.heuristic_scale
+        tx, ty = xs[t], ys[t]
+        hypot = math.hypot
+        heappush, heappop = heapq.heappush, heapq.heappop
+
+        best = {s: 0.0}
+        parent = {s: -1}
+        heap = [(scale * hypot(xs[s] - tx, ys[s] - ty), 0.0, s)]
+        while heap:
+            _, cost, u = heappop(heap)
+            if u == t:
+                path = [t]
+                while parent[path[-1]] != -1:
+                    path.append(parent[path[-1]])
+                path.reverse()
+                return path, cost
+            if cost > best[u]:
+                continue  # stale heap entry
+            for pos in range(indptr[u], indptr[u + 1]):
+                v = indices[pos]
+                new_cost = cost + weights[pos]
+                if new_cost < best.get(v, math.inf):
+                    best[v] = new_cost
+                    parent[v] = u
+                    heappush(heap, (new_cost + scale * hypot(xs[v] - tx, ys[v] - ty), new_cost, v))
+        return None
+
+    def dijkstra(self, s):
+        """Distances and first hops from node index s to every node index.
+
+        Unreachable nodes get an infinite distance and a first hop of -1.
+        """
+        indptr, indices, weights = self.indptr, self.indices, self.weights
+        heappush, heappop = heapq.heappush, heapq.heappop
+
+        dist = [math.inf] * len(self.node_ids)
+        first = [-1] * len(self.node_ids)
+        dist[s] = 0.0
+        first[s] = s
+        heap = [(0.0, s)]
+        while heap:
+            cost, u = heappop(heap)
+            if cost > dist[u]:
+                continue
+            for pos in range(indptr[u], indptr[u + 1]):
+                v = indices[pos]
+                new_cost = cost + weights[pos]
+                if new_cost < dist[v]:
+                    dist[v] = new_cost
+                    first[v] = v if u == s else first[u]
+                    heappush(heap, (new_cost, v))
+        return dist, first
+
+
+class WarehouseGraph:
+    """Path-planning view of the `nodes` and `edges` tables.
+
+    The whole graph is loaded once into CSR arrays and queried with A*, using
+    the Euclidean distance between node coordinates as the heuristic. Committed
+    changes to `Node` and `Edge` are applied to the in-memory copy: weight and
+    coordinate updates patch the arrays in place, structural changes repack
+    them from memory on the next query, never from the database.
+    """
+
+    PATH_CACHE_SIZE = 10000
+
+    def __init__(self, session_factory=SessionLocal, coordinate_scale=None):
+        self._session_factory = session_factory
+        self.coordinate_scale = coordinate_scale or settings.GRAPH_COORDINATE_SCALE
+        self._lock = threading.Lock()
+        self._nodes = None  # node_id -> (x, y)
+        self._edges = None  # (source_id, target_id) -> weight_cm
+        self._csr = None
+        self._stale = True
+        self._path_cache = {}
+        self._listeners = []
+        self.version = 0
+
+    @property
+    def loaded(self):
+        return self._nodes is not None
+
+    def load(self, session=None):
+        """(Re)load the full graph from the database"""
+        own_session = session is None
+        session = session or self._session_factory()
+        try:
+            nodes = {
+                node_id: (x_pos, y_pos)
+                for node_id, x_pos, y_pos in session.query(Node.id, Node.x_pos, Node.y_pos)
+            }
+            edges = {
+                (source_id, target_id): float(weight_cm)
+                for source_id, target_id, weight_cm in session.query(
+                    Edge.source_id, Edge.target_id, Edge.weight_cm
+                )
+            }
+        finally:
+            if own_session:
+                session.close()
+
+        with self._lock:
+            self._nodes = nodes
+            self._edges = edges
+            self._csr = _CSRGraph(nodes, edges, self.coordinate_scale)
+            self._stale = False
+            self._changed()
+        logger.info(f"Loaded warehouse graph with {len(nodes)} nodes and {len(edges)} edges")
+        self._notify([("reload", None, None, None)])
+
+    def invalidate(self):
+        """Drop the in-memory graph; the next query reloads it from the database"""
+        with self._lock:
+            self._nodes = None
+            self._edges = None
+            self._csr = None
+            self._changed()
+        self._notify([("reload", None, None, None)])
+
+    def add_listener(self, callback):
+        """Call `callback(changes)` with (kind, key, old, new) tuples after each change"""
+        self._listeners.append(callback)
+
+    def snapshot(self):
+        """Current CSR snapshot, loading or repacking it first if needed"""
+        if self._nodes is None:
+            self.load()
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._csr = _CSRGraph(self._nodes, self._edges, self.coordinate_scale)
+                    self._stale = False
+        return self._csr
+
+    def shortest_path(self, source_id, target_id):
+        """Return (list of node ids, distance in cm), or None if unreachable.
+
+        Raises KeyError if either node does not exist.
+        """
+        key = (source_id, target_id)
+        cached = self._path_cache.get(key)
+        if cached is not None:
+            return cached
+
+        csr = self.snapshot()
+        version = self.version
+        s = csr.index[source_id]
+        t = csr.index[target_id]
+        found = csr.astar(s, t)
+        result = None
+        if found is not None:
+            path, cost = found
+            result = ([csr.node_ids[i] for i in path], cost)
+
+        cache = self._path_cache
+        if self.version == version:
+            if len(cache) >= self.PATH_CACHE_SIZE:
+                cache.clear()
+            cache[key] = result
+        return result
+
+    def distances(self, source_ids, target_ids):
+        """Distances in cm (inf if unreachable) from each source to each target.
+
+        Runs one Dijkstra search per source. Raises KeyError for unknown nodes.
+        """
+        csr = self.snapshot()
+        cols = [csr.index[node_id] for node_id in target_ids]
+        rows = []
+        for node_id in source_ids:
+            dist, _ = csr.dijkstra(csr.index[node_id])
+            rows.append([dist[j] for j in cols])
+        return rows
+
+    def apply_changes(self, changes):
+        """Apply committed Node/Edge changes to the in-memory graph"""
+        if self._nodes is None:
+            return  # Nothing loaded yet, the next query reads fresh data
+        applied = []
+        with self._lock:
+            if self._nodes is None:
+                return
+            csr = None if self._stale else self._csr
+            for kind, key, value in changes:
+                if kind == "node":
+                    old = self._nodes.get(key)
+                    existed = old is not None
+                    self._nodes[key] = value
+                    if existed and csr is not None:
+                        i = csr.index[key]
+                        csr.xs[i], csr.ys[i] = value
+                        # Moving a node can tighten the heuristic bound
+                        csr.heuristic_scale = csr._admissible_scale(self.coordinate_scale)
+                    else:
+                        # The snapshot no longer matches, so later changes in
+                        # this batch must not patch it either
+                        self._stale = True
+                        csr = None
+                elif kind == "node_deleted":
+                    old = self._nodes.pop(key, None)
+                    # Edges go with the node (ON DELETE CASCADE)
+                    for edge in [edge for edge in self._edges if key in edge]:
+                        applied.append(("edge_deleted", edge, self._edges.pop(edge), None))
+                    self._stale = True
+                    csr = None
+                elif kind == "edge":
+                    old = self._edges.get(key)
+                    existed = old is not None
+                    self._edges[key] = value
+                    pos = None
+                    if existed and csr is not None:
+                        u, v = csr.index[key[0]], csr.index[key[1]]
+                        pos = csr.edge_position(u, v)
+                    if pos is not None:
+                        csr.weights[pos] = value
+                        csr.heuristic_scale = csr._tighten(csr.heuristic_scale, u, v, value)
+                    else:
+                        self._stale = True
+                        csr = None
+                elif kind == "edge_deleted":
+                    old = self._edges.pop(key, None)
+                    if old is None:
+                        continue
+                    self._stale = True
+                    csr = None
+                applied.append((kind, key, old, value))
+            self._changed()
+        self._notify(applied)
+
+    def _notify(self, changes):
+        for callback in self._listeners:
+            try:
+                callback(changes)
+            except Exception as e:
+                logger.exception(f"Error in warehouse graph listener: {e}")
+
+    def _changed(self):
+        self._path_cache = {}
+        self.version += 1
+
+
+# Create a global warehouse graph instance
+warehouse_graph = WarehouseGraph()
+
+
+def _collect_changes(session, flush_context):
+    changes = session.info.setdefault("warehouse_graph_changes", [])
+    for obj in session.new.union(session.dirty):
+        if isinstance(obj, Node):
+            changes.append(("node", obj.id, (obj.x_pos, obj.y_pos)))
+        elif isinstance(obj, Edge):
+            # An edge re-pointed to other nodes removes its old connection
+            state = inspect(obj)
+            old_source = state.attrs.source_id.history.deleted
+            old_target = state.attrs.target_id.history.deleted
+            if old_source or old_target:
+                old_key = (
+                    old_source[0] if old_source else obj.source_id,
+                    old_target[0] if old_target else obj.target_id,
+                )
+                changes.append(("edge_deleted", old_key, None))
+            changes.append(("edge", (obj.source_id, obj.target_id), float(obj.weight_cm)))
+    for obj in session.deleted:
+        if isinstance(obj, Node):
+            changes.append(("node_deleted", obj.id, None))
+        elif isinstance(obj, Edge):
+            changes.append(("edge_deleted", (obj.source_id, obj.target_id), None))
+
+
+def _apply_changes(session):
+    changes = session.info.pop("warehouse_graph_changes", None)
+    if changes:
+        warehouse_graph.apply_changes(changes)
+        # The other workers apply the same committed changes to their copy
+        cluster.invalidate("graph", changes)
+
+
+def _apply_remote_changes(changes):
+    """Changes committed by another worker, or None to reload everything"""
+    if changes is None:
+        warehouse_graph.invalidate()
+        return
+    # JSON turned the tuple keys and coordinates into lists
+    warehouse_graph.apply_changes([
+        (kind, tuple(key) if isinstance(key, list) else key, tuple(value) if isinstance(value, list) else value)
+        for kind, key, value in changes
+    ])
+
+
+def _discard_changes(session, *args):
+    session.info.pop("warehouse_graph_changes", None)
+
+
+event.listen(Session, "after_flush", _collect_changes)
+event.listen(Session, "after_commit", _apply_changes)
+event.listen(Session, "after_soft_rollback", _discard_changes)
+cluster.on_invalidate("graph", _apply_remote_changes)
@@ -0,0 +1,432 @@
+import csv
+import io
+import json
+import logging
+import math
+import re
+import time
+
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from app.core.cluster import cluster
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.warhouse import Edge, Node
+from app.services.graph import warehouse_graph
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("json", "csv", "geojson")
+CSV_COLUMNS = ("kind", "id", "name", "x_pos", "y_pos", "source_id", "target_id", "weight_cm")
+
+# Characters read from the upload at a time
+READ_SIZE = 64 * 1024
+# Rows per statement when upserting and per fetch when exporting
+BATCH_SIZE = 5000
+
+_UPSERT_DIALECTS = {"postgresql": postgresql, "sqlite": sqlite}
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+
+
+class MapImportError(ValueError):
+    """Raised for layouts that cannot be parsed or fail validation"""
+
+
+class _ChunkReader(io.RawIOBase):
+    """File-like view of an iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def _text(chunks):
+    return io.TextIOWrapper(io.BufferedReader(_ChunkReader(chunks)), encoding="utf-8", newline="")
+
+
+class _JSONStream:
+    """Pull parser for the structure of a JSON document, decoding one value at
+    a time so only the current element of a long array is held in memory"""
+
+    def __init__(self, text):
+        self._text = text
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._text.read(READ_SIZE)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        self._eof = not chunk
+        return not self._eof
+
+    def peek(self):
+        """Next non-whitespace character, or "" at the end of the input"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise MapImportError(f"Invalid JSON: expected {char!r}")
+        self._pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buffer, self._pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                pass
+            if not self._fill():
+                raise MapImportError("Invalid JSON: truncated or malformed value")
+
+    def members(self, arrays):
+        """Yield (key, element) for each element of the top-level arrays named
+        in `arrays`; other members are read and skipped"""
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise MapImportError("Invalid JSON: expected an object key")
+            self.expect(":")
+            if key in arrays and self.peek() == "[":
+                self._pos += 1
+                if self.peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield key, self.value()
+                        char = self.peek()
+                        self._pos += 1
+                        if char == "]":
+                            break
+                        if char != ",":
+                            raise MapImportError("Invalid JSON: expected ',' or ']'")
+            else:
+                self.value()
+            char = self.peek()
+            self._pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise MapImportError("Invalid JSON: expected ',' or '}'")
+
+
+# Parsers yield ("node", (id, name, x, y)) and ("edge", (source, target, weight or None))
+
+
+def _node(id, name, x, y):
+    node = (int(id), name or None, float(x), float(y))
+    if not (math.isfinite(node[2]) and math.isfinite(node[3])):
+        raise ValueError("coordinates must be finite")
+    return node
+
+
+def _edge(source, target, weight):
+    return (int(source), int(target), None if weight in (None, "") else int(weight))
+
+
+def _parse_json(text):
+    for key, item in _JSONStream(text).members(("nodes", "edges")):
+        if key == "nodes":
+            yield "node", _node(item["id"], item.get("name"), item.get("x_pos", item.get("x")), item.get("y_pos", item.get("y")))
+        else:
+            yield "edge", _edge(item["source_id"], item["target_id"], item.get("weight_cm"))
+
+
+def _parse_geojson(text):
+    for _, feature in _JSONStream(text).members(("features",)):
+        geometry = feature.get("geometry") or {}
+        properties = feature.get("properties") or {}
+        if geometry.get("type") == "Point":
+            x, y = geometry["coordinates"][:2]
+            yield "node", _node(properties.get("id", feature.get("id")), properties.get("name"), x, y)
+        elif geometry.get("type") == "LineString":
+            yield "edge", _edge(properties["source_id"], properties["target_id"], properties.get("weight_cm"))
+        else:
+            raise ValueError(f"unsupported geometry {geometry.get('type')!r}")
+
+
+def _parse_csv(text):
+    for row in csv.DictReader(text):
+        kind = row.get("kind")
+        if kind == "node":
+            yield "node", _node(row["id"], row.get("name"), row["x_pos"], row["y_pos"])
+        elif kind == "edge":
+            yield "edge", _edge(row["source_id"], row["target_id"], row.get("weight_cm"))
+        else:
+            raise ValueError(f"unknown kind {kind!r}")
+
+
+_PARSERS = {"json": _parse_json, "geojson": _parse_geojson, "csv": _parse_csv}
+
+
+def parse_layout(chunks, fmt):
+    """Read a layout from byte chunks into ({id: (name, x, y)}, {(source, target): weight})"""
+    nodes = {}
+    edges = {}
+    records = _PARSERS[fmt](_text(chunks))
+    count = 0
+    while True:
+        count += 1
+        try:
+            record = next(records, None)
+        except (AttributeError, KeyError, TypeError, ValueError, IndexError) as e:
+            if isinstance(e, MapImportError):
+                raise
+            raise MapImportError(f"Invalid record {count}: {e}")
+        if record is None:
+            return nodes, edges
+        kind, values = record
+        if kind == "node":
+            nodes[values[0]] = values[1:]
+        else:
+            edges[values[:2]] = values[2]
+
+
+class MapImporter:
+    """Bulk import and streaming export of the `nodes` and `edges` tables.
+
+    An import is parsed as a stream, validated in memory (edge endpoints
+    exist, names are unique, weights are positive), then upserted with
+    batched multi-row statements in a single transaction. The bulk
+    statements bypass the ORM, so the warehouse graph and everything
+    derived from it are invalidated once, after the commit, in this worker
+    and (with one reload message) in the other cluster workers.
+    """
+
+    def __init__(self, session_factory=SessionLocal, graph=warehouse_graph):
+        self._session_factory = session_factory
+        self.graph = graph
+
+    def _validate(self, session, nodes, edges, replace):
+        positions = {}
+        names = {}
+        if not replace:
+            # Nodes not in the layout stay, so edges may use them and their names are taken
+            for node_id, name, x, y in session.execute(select(Node.id, Node.name, Node.x_pos, Node.y_pos)):
+                positions[node_id] = (x, y)
+                if name is not None and node_id not in nodes:
+                    names[name] = node_id
+        for node_id, (name, x, y) in nodes.items():
+            positions[node_id] = (x, y)
+            if name is None:
+                continue
+            owner = names.get(name)
+            if owner is not None and owner != node_id:
+                raise MapImportError(f"Nodes {owner} and {node_id} have the same name {name!r}")
+            names[name] = node_id
+
+        rows = []
+        for (source, target), weight in edges.items():
+            for node_id in (source, target):
+                if node_id not in positions:
+                    raise MapImportError(f"Edge {source} -> {target}: node {node_id} does not exist")
+            if source == target:
+                raise MapImportError(f"Edge {source} -> {target} is a loop")
+            if weight is None:
+                # Straight-line length when the layout does not give one
+                (x1, y1), (x2, y2) = positions[source], positions[target]
+                weight = max(1, round(math.hypot(x2 - x1, y2 - y1) * settings.GRAPH_COORDINATE_SCALE))
+            elif weight <= 0:
+                raise MapImportError(f"Edge {source} -> {target}: weight must be positive")
+            rows.append({"source_id": source, "target_id": target, "weight_cm": weight})
+        return rows
+
+    def import_layout(self, chunks, fmt, replace=False):
+        """Parse, validate and store a layout; returns counts of what changed"""
+        started = time.perf_counter()
+        nodes, edges = parse_layout(chunks, fmt)
+        session = self._session_factory()
+        try:
+            edge_rows = self._validate(session, nodes, edges, replace)
+            dialect = _UPSERT_DIALECTS[session.connection().dialect.name]
+            deleted_nodes = deleted_edges = 0
+            if replace:
+                # Edges first: SQLite does not cascade without foreign keys enabled
+                deleted_edges = self._delete_missing_edges(session, edges)
+                deleted_nodes = self._delete_missing_nodes(session, nodes)
+
+            node_rows = [
+                {"id": node_id, "name": name, "x_pos": x, "y_pos": y}
+                for node_id, (name, x, y) in nodes.items()
+            ]
+            stmt = dialect.insert(Node)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Node.id],
+                set_={"name": stmt.excluded.name, "x_pos": stmt.excluded.x_pos, "y_pos": stmt.excluded.y_pos},
+            )
+            for start in range(0, len(node_rows), BATCH_SIZE):
+                session.execute(stmt, node_rows[start:start + BATCH_SIZE])
+
+            stmt = dialect.insert(Edge)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Edge.source_id, Edge.target_id],
+                set_={"weight_cm": stmt.excluded.weight_cm},
+            )
+            for start in range(0, len(edge_rows), BATCH_SIZE):
+                session.execute(stmt, edge_rows[start:start + BATCH_SIZE])
+            session.commit()
+        except IntegrityError as e:
+            session.rollback()
+            raise MapImportError(f"Layout conflicts with existing data: {e.orig}")
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        # Everything cached from the old layout goes at once; the graph's
+        # listeners drop the spatial index, distance matrix and route caches
+        self.graph.invalidate()
+        cluster.invalidate("graph")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Imported {len(nodes)} nodes and {len(edge_rows)} edges in {elapsed_ms:.0f} ms")
+        return {
+            "nodes": len(nodes),
+            "edges": len(edge_rows),
+            "deleted_nodes": deleted_nodes,
+            "deleted_edges": deleted_edges,
+            "elapsed_ms": elapsed_ms,
+        }
+
+    def _delete_missing_edges(self, session, edges):
+        existing = session.execute(select(Edge.source_id, Edge.target_id)).all()
+        missing = [tuple(key) for key in existing if tuple(key) not in edges]
+        for start in range(0, len(missing), BATCH_SIZE):
+            session.execute(
+                delete(Edge).where(tuple_(Edge.source_id, Edge.target_id).in_(missing[start:start + BATCH_SIZE]))
+            )
+        return len(missing)
+
+    def _delete_missing_nodes(self, session, nodes):
+        missing = [node_id for node_id in session.execute(select(Node.id)).scalars() if node_id not in nodes]
+        for start in range(0, len(missing), BATCH_SIZE):
+            session.execute(delete(Node).where(Node.id.in_(missing[start:start + BATCH_SIZE])))
+        return len(missing)
+
+    # Export
+
+    def _rows(self, session, query):
+        return session.execute(query.execution_options(yield_per=BATCH_SIZE))
+
+    def export_layout(self, fmt):
+        """Yield the layout in `fmt` piece by piece, reading the tables in batches"""
+        session = self._session_factory()
+        try:
+            yield from getattr(self, f"_export_{fmt}")(session)
+        finally:
+            session.close()
+
+    def _nodes(self, session):
+        return self._rows(session, select(Node.id, Node.name, Node.x_pos, Node.y_pos).order_by(Node.id))
+
+    def _edges(self, session):
+        return self._rows(
+            session, select(Edge.source_id, Edge.target_id, Edge.weight_cm).order_by(Edge.source_id, Edge.target_id)
+        )
+
+    def _export_json(self, session):
+        yield '{"nodes": ['
+        separator = ""
+        for node_id, name, x, y in self._nodes(session):
+            yield separator + json.dumps({"id": node_id, "name": name, "x_pos": x, "y_pos": y})
+            separator = ","
+        yield '], "edges": ['
+        separator = ""
+        for source, target, weight in self._edges(session):
+            yield separator + json.dumps({"source_id": source, "target_id": target, "weight_cm": weight})
+            separator = ","
+        yield "]}"
+
+    def _export_csv(self, session):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+        for node_id, name, x, y in self._nodes(session):
+            writer.writerow(("node", node_id, name, x, y, "", "", ""))
+            if buffer.tell() >= READ_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        for source, target, weight in self._edges(session):
+            writer.writerow(("edge", "", "", "", "", source, target, weight))
+            if buffer.tell() >= READ_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def _export_geojson(self, session):
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = ""
+        for node_id, name, x, y in self._nodes(session):
+            yield separator + json.dumps(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [x, y]},
+                    "properties": {"id": node_id, "name": name},
+                }
+            )
+            separator = ","
+        source_node, target_node = aliased(Node), aliased(Node)
+        edges = self._rows(
+            session,
+            select(
+                Edge.source_id,
+                Edge.target_id,
+                Edge.weight_cm,
+                source_node.x_pos,
+                source_node.y_pos,
+                target_node.x_pos,
+                target_node.y_pos,
+            )
+            .join(source_node, Edge.source_id == source_node.id)
+            .join(target_node, Edge.target_id == target_node.id)
+            .order_by(Edge.source_id, Edge.target_id),
+        )
+        for source, target, weight, x1, y1, x2, y2 in edges:
+            yield separator + json.dumps(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "LineString", "coordinates": [[x1, y1], [x2, y2]]},
+                    "properties": {"source_id": source, "target_id": target, "weight_cm": weight},
+                }
+            )
+            separator = ","
+        yield "]}"
+
+
+# Create a global map importer instance
+map_importer = MapImporter()
@@ -0,0 +1,394 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+from app.core.cluster import cluster
+from app.core.config import settings
+from app.core.telemetry import telemetry_store
+from app.services.graph import warehouse_graph
+from app.services.spatial_index import spatial_index
+
+logger = logging.getLogger(__name__)
+
+
+class _Plan:
+    """Reserved route of one robot: (step, node id) waypoints, one per time
+    step it occupies a node, the table keys it holds in time order, and the
+    nodes it visits"""
+
+    __slots__ = ("robot_id", "waypoints", "keys", "nodes", "goal")
+
+    def __init__(self, robot_id, waypoints, keys, nodes, goal):
+        self.robot_id = robot_id
+        self.waypoints = waypoints
+        self.keys = keys
+        self.nodes = nodes
+        self.goal = goal
+
+
+class ReservationPlanner:
+    """Conflict-free routes for many robots over the warehouse graph.
+
+    Time is split into steps of `RESERVATION_STEP_SECONDS`, and crossing an
+    edge takes as many steps as the robot needs at `ROBOT_SPEED_CM_S`. A
+    reservation table maps (node, step) and (aisle, step) to the robot
+    holding it. Aisles are undirected, so two robots never meet head-on in
+    one. Batches are planned by prioritized planning: each request, highest
+    priority first, runs a space-time A* (waiting in place is a move) that
+    avoids everything reserved before it, then reserves its own route. The
+    robot is parked at its goal until it gets a new route or is released.
+    The table is keyed by node id rather than by the graph snapshot's node
+    index, so reservations stay valid when nodes are added or removed.
+
+    Every search is capped at `RESERVATION_HORIZON_STEPS` and
+    `RESERVATION_MAX_EXPANSIONS`, so planning time per request stays
+    bounded however many robots hold reservations. Reservations behind a
+    robot are released as its telemetry reports it at a node on its route,
+    and ones in the past are dropped before every batch.
+
+    With `CLUSTER_ENABLED=true` the table lives on the leader, which also
+    receives the telemetry, and other workers forward their calls to it.
+    """
+
+    HEURISTIC_CACHE_SIZE = 1024
+
+    def __init__(self, graph=warehouse_graph, step_seconds=None, speed=None):
+        self.graph = graph
+        self.step_seconds = step_seconds or settings.RESERVATION_STEP_SECONDS
+        self.speed = speed or settings.ROBOT_SPEED_CM_S
+        self.horizon = settings.RESERVATION_HORIZON_STEPS
+        self.max_expansions = settings.RESERVATION_MAX_EXPANSIONS
+        self._lock = threading.Lock()
+        self._epoch = time.time()
+        self._vertices = {}  # (node id, step) -> robot id
+        self._edges = {}  # (low node id, high node id, step) -> robot id
+        self._parked = {}  # node id -> (robot id, from step)
+        self._last_use = {}  # node id -> {robot id: last reserved step}
+        self._plans = {}  # robot id -> _Plan
+        self._heuristics = {}  # (graph version, goal index) -> steps to goal per node
+        self._incoming = None  # (graph version, [(predecessor, steps)] per node)
+        self.planned = 0
+        self.failed = 0
+        self.expansions = 0
+        graph.add_listener(self._on_graph_changes)
+
+    @property
+    def forwarding(self):
+        """Whether calls go to the cluster leader's table instead of ours"""
+        return settings.CLUSTER_ENABLED and not cluster.is_leader
+
+    def now(self):
+        """Current time step"""
+        return int((time.time() - self._epoch) / self.step_seconds)
+
+    def _time(self, step):
+        return self._epoch + step * self.step_seconds
+
+    def _duration(self, weight_cm):
+        return max(1, math.ceil(weight_cm / (self.speed * self.step_seconds)))
+
+    def _steps_to(self, csr, goal):
+        """Fewest steps from every node to `goal`, by a backward Dijkstra"""
+        key = (self.graph.version, goal)
+        steps = self._heuristics.get(key)
+        if steps is not None:
+            return steps
+        n = len(csr.node_ids)
+        if self._incoming is None or self._incoming[0] != self.graph.version:
+            incoming = [[] for _ in range(n)]
+            for u in range(n):
+                for pos in range(csr.indptr[u], csr.indptr[u + 1]):
+                    incoming[csr.indices[pos]].append((u, self._duration(csr.weights[pos])))
+            self._incoming = (self.graph.version, incoming)
+        incoming = self._incoming[1]
+        steps = [math.inf] * n
+        steps[goal] = 0
+        heap = [(0, goal)]
+        while heap:
+            cost, v = heapq.heappop(heap)
+            if cost > steps[v]:
+                continue
+            for u, duration in incoming[v]:
+                if cost + duration < steps[u]:
+                    steps[u] = cost + duration
+                    heapq.heappush(heap, (cost + duration, u))
+        if len(self._heuristics) >= self.HEURISTIC_CACHE_SIZE:
+            self._heuristics.clear()
+        self._heuristics[key] = steps
+        return steps
+
+    # Reservation table
+
+    def _vertex_free(self, robot_id, v, t):
+        owner = self._vertices.get((v, t))
+        if owner is not None and owner != robot_id:
+            return False
+        parked = self._parked.get(v)
+        return parked is None or parked[0] == robot_id or t < parked[1]
+
+    def _edge_free(self, robot_id, u, v, start, duration):
+        a, b = (u, v) if u < v else (v, u)
+        for t in range(start, start + duration):
+            owner = self._edges.get((a, b, t))
+            if owner is not None and owner != robot_id:
+                return False
+        return True
+
+    def _goal_free(self, robot_id, v, t):
+        """Whether the robot can stay at `v` from step t on without blocking anyone"""
+        parked = self._parked.get(v)
+        if parked is not None and parked[0] != robot_id:
+            return False
+        users = self._last_use.get(v)
+        return not users or all(last < t for owner, last in users.items() if owner != robot_id)
+
+    def _reserve(self, robot_id, moves, goal):
+        """Reserve a route given as (node id, arrival step, departure step,
+        edge duration to the next node) tuples"""
+        waypoints = []
+        keys = []
+        for v, arrive, depart, _ in moves:
+            for t in range(arrive, depart + 1):
+                self._vertices[(v, t)] = robot_id
+                keys.append((v, t))
+                waypoints.append((t, v))
+            users = self._last_use.setdefault(v, {})
+            users[robot_id] = max(users.get(robot_id, -1), depart)
+        for (u, _, depart, duration), (v, _, _, _) in zip(moves, moves[1:]):
+            a, b = (u, v) if u < v else (v, u)
+            for t in range(depart, depart + duration):
+                self._edges[(a, b, t)] = robot_id
+                keys.append((a, b, t))
+        keys.sort(key=lambda key: key[-1])
+        self._parked[goal] = (robot_id, moves[-1][1])
+        self._plans[robot_id] = _Plan(robot_id, waypoints, keys, {move[0] for move in moves}, goal)
+
+    def _release_keys(self, robot_id, keys):
+        for key in keys:
+            table = self._vertices if len(key) == 2 else self._edges
+            if table.get(key) == robot_id:
+                del table[key]
+
+    def _release(self, robot_id):
+        plan = self._plans.pop(robot_id, None)
+        if plan is None:
+            return False
+        self._release_keys(robot_id, plan.keys)
+        for v in plan.nodes:
+            users = self._last_use.get(v)
+            if users is not None:
+                users.pop(robot_id, None)
+                if not users:
+                    del self._last_use[v]
+        if self._parked.get(plan.goal, (None,))[0] == robot_id:
+            del self._parked[plan.goal]
+        return True
+
+    def _release_before(self, plan, step):
+        """Drop the part of a plan that lies before `step`"""
+        keys = plan.keys
+        cut = 0
+        while cut < len(keys) and keys[cut][-1] < step:
+            cut += 1
+        if cut:
+            self._release_keys(plan.robot_id, keys[:cut])
+            del keys[:cut]
+            cut = 0
+            while cut < len(plan.waypoints) and plan.waypoints[cut][0] < step:
+                cut += 1
+            del plan.waypoints[:cut]
+
+    def _prune(self, step):
+        for plan in self._plans.values():
+            self._release_before(plan, step)
+
+    # Planning
+
+    def _search(self, csr, robot_id, s, goal, start):
+        """Space-time A* from node index s at step `start`; returns moves or None.
+
+        The search walks node indices, the reservation table is keyed by node id.
+        """
+        h = self._steps_to(csr, goal)
+        ids = csr.node_ids
+        if math.isinf(h[s]) or not self._vertex_free(robot_id, ids[s], start):
+            return None
+        indptr, indices, weights = csr.indptr, csr.indices, csr.weights
+        limit = start + self.horizon
+        heap = [(h[s], start, s)]
+        parent = {(s, start): None}
+        expansions = 0
+        while heap and expansions < self.max_expansions:
+            _, t, v = heapq.heappop(heap)
+            expansions += 1
+            if v == goal and self._goal_free(robot_id, ids[v], t):
+                self.expansions += expansions
+                return self._moves(parent, (v, t))
+            # Wait in place
+            if t + 1 <= limit and (v, t + 1) not in parent and self._vertex_free(robot_id, ids[v], t + 1):
+                parent[(v, t + 1)] = (v, t)
+                heapq.heappush(heap, (t + 1 - start + h[v], t + 1, v))
+            for pos in range(indptr[v], indptr[v + 1]):
+                w = indices[pos]
+                arrive = t + self._duration(weights[pos])
+                if (
+                    arrive > limit
+                    or (w, arrive) in parent
+                    or math.isinf(h[w])
+                    or not self._vertex_free(robot_id, ids[w], arrive)
+                    or not self._edge_free(robot_id, ids[v], ids[w], t, arrive - t)
+                ):
+                    continue
+                parent[(w, arrive)] = (v, t)
+                heapq.heappush(heap, (arrive - start + h[w], arrive, w))
+        self.expansions += expansions
+        return None
+
+    def _moves(self, parent, state):
+        states = []
+        while state is not None:
+            states.append(state)
+            state = parent[state]
+        states.reverse()
+        # Merge waits into one (node, arrival, departure, duration) move each
+        moves = []
+        for v, t in states:
+            if moves and moves[-1][0] == v:
+                moves[-1][2] = t
+            else:
+                if moves:
+                    moves[-1][3] = t - moves[-1][2]
+                moves.append([v, t, t, 0])
+        return [tuple(move) for move in moves]
+
+    def plan(self, requests):
+        """Plan and reserve routes for a batch of requests.
+
+        Each request is a dict with `robot_id`, `source` and `target` node ids
+        and an optional `priority` (higher is planned first). Returns one
+        result per request, in the order given.
+        """
+        if self.forwarding:
+            return cluster.request("plan_routes", requests=requests)
+        csr = self.graph.snapshot()
+        order = sorted(range(len(requests)), key=lambda i: -requests[i].get("priority", 0))
+        results = [None] * len(requests)
+        with self._lock:
+            start = self.now()
+            self._prune(start)
+            # Every robot in the batch stands on its source node right now,
+            # so hold those before anyone plans through them
+            endpoints = {}
+            for i in order:
+                request = requests[i]
+                s = csr.index.get(request["source"])
+                goal = csr.index.get(request["target"])
+                if s is None or goal is None:
+                    continue
+                # A new route replaces the robot's previous one
+                self._release(request["robot_id"])
+                self._vertices.setdefault((request["source"], start), request["robot_id"])
+                endpoints[i] = (s, goal)
+            for i in order:
+                results[i] = self._plan_one(csr, requests[i], endpoints.get(i), start)
+        return results
+
+    def _plan_one(self, csr, request, endpoints, start):
+        robot_id = request["robot_id"]
+        result = {"robot_id": robot_id, "waypoints": []}
+        if endpoints is None:
+            result["status"] = "unknown_node"
+            return result
+        s, goal = endpoints
+        moves = self._search(csr, robot_id, s, goal, start)
+        if moves is None:
+            if self._vertices.get((request["source"], start)) == robot_id:
+                del self._vertices[(request["source"], start)]
+            self.failed += 1
+            result["status"] = "no_route"
+            return result
+        moves = [(csr.node_ids[v], arrive, depart, duration) for v, arrive, depart, duration in moves]
+        self._reserve(robot_id, moves, request["target"])
+        self.planned += 1
+        result["status"] = "planned"
+        result["waypoints"] = [
+            {
+                "node_id": v,
+                "arrive_at": self._time(arrive),
+                "depart_at": None if k == len(moves) - 1 else self._time(depart),
+            }
+            for k, (v, arrive, depart, _) in enumerate(moves)
+        ]
+        return result
+
+    def release(self, robot_id):
+        """Drop every reservation of a robot; returns whether it had any"""
+        if self.forwarding:
+            return cluster.request("release_routes", robot_id=robot_id)
+        with self._lock:
+            return self._release(robot_id)
+
+    def reached(self, robot_id, node_id):
+        """Release the part of a robot's route up to its visit of `node_id`"""
+        if robot_id not in self._plans:
+            return
+        with self._lock:
+            plan = self._plans.get(robot_id)
+            if plan is None:
+                return
+            for step, node in plan.waypoints:
+                if node == node_id:
+                    self._release_before(plan, step)
+                    return
+
+    def _on_telemetry(self, robot_id, record):
+        if robot_id not in self._plans:
+            return
+        node_id = record["node_id"]
+        if node_id is None:
+            node_id = int(spatial_index.snap([record["x"]], [record["y"]])[0])
+            if node_id < 0:
+                return
+        self.reached(robot_id, node_id)
+
+    def _on_graph_changes(self, changes):
+        # Routes over a changed graph may no longer exist; keep them (robots
+        # are already driving them, and they are keyed by node id, so a
+        # repacked snapshot does not move them) but replan with fresh heuristics
+        with self._lock:
+            self._heuristics = {}
+            self._incoming = None
+
+    def reservations(self, robot_id):
+        """Current waypoints reserved by a robot, or None"""
+        if self.forwarding:
+            return cluster.request("reserved_routes", robot_id=robot_id)
+        with self._lock:
+            plan = self._plans.get(robot_id)
+            if plan is None:
+                return None
+            return [{"node_id": node_id, "at": self._time(step)} for step, node_id in plan.waypoints]
+
+    def stats(self):
+        if self.forwarding:
+            return cluster.request("reservation_stats")
+        return {
+            "robots": len(self._plans),
+            "node_reservations": len(self._vertices),
+            "edge_reservations": len(self._edges),
+            "parked": len(self._parked),
+            "planned": self.planned,
+            "failed": self.failed,
+            "expansions": self.expansions,
+        }
+
+
+# Create a global reservation planner instance
+reservation_planner = ReservationPlanner()
+telemetry_store.add_listener(reservation_planner._on_telemetry)
+cluster.on_request("plan_routes", lambda message: reservation_planner.plan(message["requests"]))
+cluster.on_request("release_routes", lambda message: reservation_planner.release(message["robot_id"]))
+cluster.on_request("reserved_routes", lambda message: reservation_planner.reservations(message["robot_id"]))
+cluster.on_request("reservation_stats", lambda message: reservation_planner.stats())
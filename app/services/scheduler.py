@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import case, exists, update
+
+from app.core.command_queue import CommandOutcome, CommandQueueFull, command_queue
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.warhouse import Robot, Task, TaskStatus
+from app.services.distance_matrix import distance_matrix
+from app.services.graph import warehouse_graph
+from app.services.task_engine import task_engine
+
+logger = logging.getLogger(__name__)
+
+
+def solve_assignment(cost):
+    """Minimum-cost assignment for a rectangular cost matrix (Hungarian method).
+
+    Returns a list of (row, column) pairs, one for every row or every column,
+    whichever is fewer. The inner loop is vectorized over columns, so the
+    Python-level work is O(n^2) for an n x m problem.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return []
+
+    # Potentials and matching use 1-based indices, with column 0 as a sentinel
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    match = np.zeros(m + 1, dtype=np.int64)  # column -> row, 0 if free
+    way = np.zeros(m + 1, dtype=np.int64)
+
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        min_reduced = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = match[j0]
+            free = ~used
+            free[0] = False
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            improved = free[1:] & (reduced < min_reduced[1:])
+            min_reduced[1:][improved] = reduced[improved]
+            way[1:][improved] = j0
+
+            candidates = np.where(free, min_reduced, np.inf)
+            j1 = int(np.argmin(candidates))
+            delta = candidates[j1]
+
+            u[match[used]] += delta
+            v[used] -= delta
+            min_reduced[free] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+
+        # Flip the augmenting path
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    pairs = [(int(match[j]) - 1, j - 1) for j in range(1, m + 1) if match[j]]
+    if transposed:
+        pairs = [(col, row) for row, col in pairs]
+    return sorted(pairs)
+
+
+class TaskScheduler:
+    """Assign pending tasks to idle robots in periodic batches.
+
+    Each run reads all pending tasks and idle robots in two queries, builds a
+    robot x task cost matrix (travel distance to the task's start node plus a
+    penalty for low battery), solves it as one assignment problem and writes
+    every assignment back with a single UPDATE before publishing the commands.
+    """
+
+    def __init__(self, session_factory=SessionLocal, commands=None):
+        self._session_factory = session_factory
+        self.commands = command_queue if commands is None else commands
+        self._task = None
+        self.last_run = None
+
+    def _distances(self, robot_nodes, task_nodes):
+        if distance_matrix is not None:
+            return distance_matrix.distances(robot_nodes, task_nodes)
+        # One Dijkstra per distinct robot location
+        sources = sorted(set(robot_nodes))
+        rows = dict(zip(sources, warehouse_graph.distances(sources, task_nodes)))
+        return np.array([rows[node_id] for node_id in robot_nodes], dtype=np.float64)
+
+    def run_once(self):
+        """Run one scheduling batch; returns the list of assignments made"""
+        started = time.perf_counter()
+        session = self._session_factory()
+        try:
+            tasks = (
+                session.query(Task.id, Task.start_node_id, Task.end_node_id)
+                .filter(Task.status == TaskStatus.PENDING, Task.robot_id.is_(None))
+                .order_by(Task.id)
+                .limit(settings.SCHEDULER_BATCH_SIZE)
+                .all()
+            )
+            if not tasks:
+                return []
+
+            busy = exists().where(Task.robot_id == Robot.id, Task.status == TaskStatus.IN_PROGRESS)
+            robots = (
+                session.query(Robot.id, Robot.current_node_id, Robot.battery)
+                .filter(Robot.battery >= settings.SCHEDULER_MIN_BATTERY, ~busy)
+                .all()
+            )
+            if not robots:
+                return []
+
+            distances = np.asarray(
+                self._distances([r.current_node_id for r in robots], [t.start_node_id for t in tasks]),
+                dtype=np.float64,
+            )
+            battery = np.array([r.battery for r in robots], dtype=np.float64)
+            cost = distances + settings.SCHEDULER_BATTERY_PENALTY * (100.0 - battery)[:, None]
+
+            reachable = np.isfinite(cost)
+            if not reachable.any():
+                return []
+            # Unreachable pairs get a cost no real assignment can beat, and are
+            # discarded after solving
+            cost[~reachable] = cost[reachable].max() * len(robots) + 1.0
+
+            pairs = [
+                (robots[row], tasks[col])
+                for row, col in solve_assignment(cost)
+                if reachable[row, col]
+            ]
+            if not pairs:
+                return []
+
+            assigned = session.execute(
+                update(Task)
+                .where(
+                    Task.id.in_([task.id for _, task in pairs]),
+                    Task.status == TaskStatus.PENDING,
+                    Task.robot_id.is_(None),
+                )
+                .values(
+                    robot_id=case({task.id: robot.id for robot, task in pairs}, value=Task.id),
+                    status=TaskStatus.IN_PROGRESS,
+                )
+                .returning(Task.id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            session.commit()
+        finally:
+            session.close()
+
+        # Tasks taken by someone else since we read them are skipped
+        assigned = set(assigned)
+        task_engine.record_assignments(
+            [(task.id, robot.id) for robot, task in pairs if task.id in assigned]
+        )
+        assignments = []
+        for robot, task in pairs:
+            if task.id not in assigned:
+                continue
+            command = {
+                "command": "assign_task",
+                "task_id": task.id,
+                "start_node_id": task.start_node_id,
+                "end_node_id": task.end_node_id,
+            }
+            # Through the robot's command queue, behind anything still queued for it
+            try:
+                outcome = self.commands.submit(str(robot.id), command)
+            except CommandQueueFull:
+                outcome = CommandOutcome.FAILED
+            published = outcome not in (CommandOutcome.FAILED, CommandOutcome.SUPERSEDED)
+            assignments.append({"task_id": task.id, "robot_id": robot.id, "published": published})
+
+        self.last_run = time.time()
+        logger.info(
+            f"Assigned {len(assignments)} of {len(tasks)} pending tasks to "
+            f"{len(robots)} idle robots in {(time.perf_counter() - started) * 1000:.1f} ms"
+        )
+        return assignments
+
+    async def run_forever(self, interval=None):
+        interval = interval or settings.SCHEDULER_INTERVAL_SECONDS
+        while True:
+            try:
+                await run_in_threadpool(self.run_once)
+            except Exception as e:
+                logger.exception(f"Task scheduling batch failed: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Create a global task scheduler instance
+task_scheduler = TaskScheduler()
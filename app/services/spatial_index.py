@@ -0,0 +1,296 @@
+import logging
+import math
+import threading
+
+import numpy as np
+
+from app.core.config import settings
+from app.services.graph import warehouse_graph
+
+logger = logging.getLogger(__name__)
+
+# Offsets of a cell and its eight neighbours
+_NEIGHBOURS = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)], dtype=np.intp)
+
+
+class SpatialIndex:
+    """Uniform grid over the node coordinates of the warehouse graph.
+
+    Cells are rows of a dense `(nx + 2, ny + 2, per_cell)` table of node
+    slots, padded with an empty border, so a batch k-NN query gathers the
+    3x3 block around every query point with one fancy-indexing operation
+    and ranks the candidates with `argpartition`. A result is only kept if
+    the block provably contains it; the few queries whose neighbours lie
+    further out (sparse areas, points off the map) fall back to a
+    vectorized scan of every node.
+
+    The index follows committed changes through `warehouse_graph`
+    listeners: added, moved and deleted nodes update their cell in place,
+    and only a node outside the grid bounds or a full graph reload makes
+    the next query rebuild it.
+    """
+
+    # Nodes per cell the automatic cell size aims for
+    TARGET_PER_CELL = 2
+    # Upper bound on grid cells per node for the automatic cell size
+    MAX_CELLS_PER_NODE = 4
+    # Query points per chunk of the brute-force fallback, to bound memory
+    FALLBACK_CHUNK = 256
+
+    def __init__(self, graph=warehouse_graph, cell_size=None):
+        self.graph = graph
+        self.cell_size_setting = cell_size if cell_size is not None else settings.SPATIAL_CELL_SIZE
+        self._lock = threading.Lock()
+        self._stale = True
+        self.rebuilds = 0
+        self.fallbacks = 0
+        graph.add_listener(self._on_graph_changes)
+
+    def _build(self):
+        csr = self.graph.snapshot()
+        n = len(csr.node_ids)
+        # Room to add nodes before the arrays have to be rebuilt
+        capacity = max(16, 2 * n)
+        self.node_ids = np.full(capacity, -1, dtype=np.int64)
+        self.xs = np.full(capacity, np.nan)
+        self.ys = np.full(capacity, np.nan)
+        self.node_ids[:n] = np.frombuffer(csr.node_ids, dtype=np.int64)
+        self.xs[:n] = np.frombuffer(csr.xs, dtype=np.float64)
+        self.ys[:n] = np.frombuffer(csr.ys, dtype=np.float64)
+        self.slots = {int(node_id): slot for slot, node_id in enumerate(self.node_ids[:n])}
+        self.free = list(range(capacity - 1, n - 1, -1))
+
+        if n:
+            x_min, x_max = float(self.xs[:n].min()), float(self.xs[:n].max())
+            y_min, y_max = float(self.ys[:n].min()), float(self.ys[:n].max())
+        else:
+            x_min = x_max = y_min = y_max = 0.0
+        cell = self.cell_size_setting
+        if not cell:
+            # Size cells for the bulk of the map, so a few outlying nodes
+            # (chargers, loading docks) do not make every cell crowded...
+            if n:
+                x_lo, x_hi = np.percentile(self.xs[:n], (1, 99))
+                y_lo, y_hi = np.percentile(self.ys[:n], (1, 99))
+            else:
+                x_lo = x_hi = y_lo = y_hi = 0.0
+            area = max(x_hi - x_lo, 1.0) * max(y_hi - y_lo, 1.0)
+            cell = math.sqrt(area * self.TARGET_PER_CELL / max(n, 1))
+            # ...but keep the table small when they are far away
+            total = max(x_max - x_min, 1.0) * max(y_max - y_min, 1.0)
+            cell = max(cell, math.sqrt(total / (self.MAX_CELLS_PER_NODE * max(n, 1))))
+        self.cell = cell
+        # One spare cell on every side so nodes can move a little without a rebuild
+        self.x0 = x_min - cell
+        self.y0 = y_min - cell
+        self.nx = int((x_max - x_min) // cell) + 3
+        self.ny = int((y_max - y_min) // cell) + 3
+
+        cx, cy = self._cells(self.xs[:n], self.ys[:n])
+        flat = cx * self.ny + cy
+        counts = np.bincount(flat, minlength=self.nx * self.ny)
+        per_cell = max(1, int(counts.max()) if n else 1)
+        self.table = np.full((self.nx + 2, self.ny + 2, per_cell), -1, dtype=np.int64)
+        self.counts = np.zeros((self.nx + 2, self.ny + 2), dtype=np.int64)
+        self.cell_of = np.full((capacity, 2), -1, dtype=np.intp)
+        for slot in np.argsort(flat, kind="stable"):
+            self._place(int(slot), int(cx[slot]), int(cy[slot]))
+
+        self._stale = False
+        self.rebuilds += 1
+        logger.info(
+            f"Built spatial index for {n} nodes: {self.nx}x{self.ny} cells of {cell:g} units"
+        )
+
+    def _ensure_ready(self):
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._build()
+
+    def _cells(self, xs, ys):
+        """Grid cell of each point; may fall outside [0, nx) x [0, ny)"""
+        cx = np.floor((np.asarray(xs, dtype=np.float64) - self.x0) / self.cell).astype(np.intp)
+        cy = np.floor((np.asarray(ys, dtype=np.float64) - self.y0) / self.cell).astype(np.intp)
+        return cx, cy
+
+    def _place(self, slot, cx, cy):
+        # Table rows are offset by one for the empty border
+        count = self.counts[cx + 1, cy + 1]
+        if count == self.table.shape[2]:
+            grown = np.full(self.table.shape[:2] + (count * 2,), -1, dtype=np.int64)
+            grown[:, :, :count] = self.table
+            self.table = grown
+        self.table[cx + 1, cy + 1, count] = slot
+        self.counts[cx + 1, cy + 1] = count + 1
+        self.cell_of[slot] = (cx, cy)
+
+    def _unplace(self, slot):
+        cx, cy = self.cell_of[slot]
+        row = self.table[cx + 1, cy + 1]
+        last = self.counts[cx + 1, cy + 1] - 1
+        position = int(np.flatnonzero(row == slot)[0])
+        row[position] = row[last]
+        row[last] = -1
+        self.counts[cx + 1, cy + 1] = last
+        self.cell_of[slot] = (-1, -1)
+
+    def _move(self, node_id, x, y):
+        """Insert or move one node; returns False if it needs a rebuild"""
+        cx, cy = self._cells(x, y)
+        cx, cy = int(cx), int(cy)
+        if not (0 <= cx < self.nx and 0 <= cy < self.ny):
+            return False
+        slot = self.slots.get(node_id)
+        if slot is None:
+            if not self.free:
+                return False
+            slot = self.free.pop()
+            self.slots[node_id] = slot
+            self.node_ids[slot] = node_id
+        else:
+            self._unplace(slot)
+        self.xs[slot] = x
+        self.ys[slot] = y
+        self._place(slot, cx, cy)
+        return True
+
+    def _remove(self, node_id):
+        slot = self.slots.pop(node_id, None)
+        if slot is None:
+            return
+        self._unplace(slot)
+        self.node_ids[slot] = -1
+        self.xs[slot] = self.ys[slot] = np.nan
+        self.free.append(slot)
+
+    def _on_graph_changes(self, changes):
+        if self._stale:
+            return
+        with self._lock:
+            for kind, key, old, new in changes:
+                if kind == "node":
+                    if not self._move(key, *new):
+                        self._stale = True
+                elif kind == "node_deleted":
+                    self._remove(key)
+                elif kind == "reload":
+                    self._stale = True
+                if self._stale:
+                    return
+
+    def nearest(self, xs, ys, k=1, max_distance=None):
+        """The k nearest nodes of every query point, closest first.
+
+        Returns `(node_ids, distances)` arrays of shape `(len(xs), k)`;
+        missing neighbours (fewer than k nodes, or none within
+        `max_distance`) have node id -1 and an infinite distance.
+        """
+        self._ensure_ready()
+        qx = np.atleast_1d(np.asarray(xs, dtype=np.float64))
+        qy = np.atleast_1d(np.asarray(ys, dtype=np.float64))
+        with self._lock:
+            cx, cy = self._cells(qx, qy)
+            inside = (cx >= 0) & (cx < self.nx) & (cy >= 0) & (cy < self.ny)
+            bx = np.clip(cx, 0, self.nx - 1)
+            by = np.clip(cy, 0, self.ny - 1)
+
+            # Gather the 3x3 block of cells around every query point
+            gx = bx[:, None] + _NEIGHBOURS[:, 0] + 1
+            gy = by[:, None] + _NEIGHBOURS[:, 1] + 1
+            candidates = self.table[gx, gy].reshape(len(qx), -1)
+            slots, d2 = self._rank(candidates, qx, qy, k)
+
+            # The block covers every point closer than the query's distance
+            # to its outer edge; anything further may be missing
+            fx = qx - (self.x0 + bx * self.cell)
+            fy = qy - (self.y0 + by * self.cell)
+            reach = self.cell + np.minimum(
+                np.minimum(fx, self.cell - fx), np.minimum(fy, self.cell - fy)
+            )
+            exact = inside & (d2[:, -1] <= reach * reach)
+            missing = np.flatnonzero(~exact)
+            if len(missing):
+                self.fallbacks += len(missing)
+                live = np.flatnonzero(self.node_ids >= 0)
+                for start in range(0, len(missing), self.FALLBACK_CHUNK):
+                    rows = missing[start:start + self.FALLBACK_CHUNK]
+                    chunk = np.broadcast_to(live, (len(rows), len(live)))
+                    slots[rows], d2[rows] = self._rank(chunk, qx[rows], qy[rows], k)
+
+            node_ids = np.where(slots >= 0, self.node_ids[slots], -1)
+        distances = np.sqrt(d2)
+        if max_distance is not None:
+            beyond = distances > max_distance
+            node_ids[beyond] = -1
+            distances[beyond] = np.inf
+        return node_ids, distances
+
+    def _rank(self, candidates, qx, qy, k):
+        """The k closest of each row of candidate slots (-1 = empty)"""
+        valid = candidates >= 0
+        d2 = np.where(
+            valid,
+            (self.xs[candidates] - qx[:, None]) ** 2 + (self.ys[candidates] - qy[:, None]) ** 2,
+            np.inf,
+        )
+        width = d2.shape[1]
+        if k == 1 and width:
+            best = d2.argmin(axis=1)[:, None]
+            d2 = np.take_along_axis(d2, best, axis=1)
+            slots = np.take_along_axis(candidates, best, axis=1)
+            return np.where(np.isfinite(d2), slots, -1), d2
+        if width < k:
+            pad = k - width
+            d2 = np.pad(d2, ((0, 0), (0, pad)), constant_values=np.inf)
+            candidates = np.pad(candidates, ((0, 0), (0, pad)), constant_values=-1)
+        elif width > k:
+            part = np.argpartition(d2, k - 1, axis=1)[:, :k]
+            d2 = np.take_along_axis(d2, part, axis=1)
+            candidates = np.take_along_axis(candidates, part, axis=1)
+        order = np.argsort(d2, axis=1, kind="stable")
+        d2 = np.take_along_axis(d2, order, axis=1)
+        slots = np.where(np.isfinite(d2), np.take_along_axis(candidates, order, axis=1), -1)
+        return slots, d2
+
+    def within(self, x, y, radius):
+        """Node ids within `radius` of (x, y), closest first, with their distances"""
+        self._ensure_ready()
+        with self._lock:
+            (x_lo, x_hi), (y_lo, y_hi) = self._cells([x - radius, x + radius], [y - radius, y + radius])
+            x_lo, y_lo = max(int(x_lo), 0), max(int(y_lo), 0)
+            x_hi, y_hi = min(int(x_hi), self.nx - 1), min(int(y_hi), self.ny - 1)
+            if x_lo > x_hi or y_lo > y_hi:
+                return [], []
+            slots = self.table[x_lo + 1:x_hi + 2, y_lo + 1:y_hi + 2].ravel()
+            slots = slots[slots >= 0]
+            distances = np.hypot(self.xs[slots] - x, self.ys[slots] - y)
+            node_ids = self.node_ids[slots]
+        close = distances <= radius
+        order = np.argsort(distances[close], kind="stable")
+        return node_ids[close][order].tolist(), distances[close][order].tolist()
+
+    def snap(self, xs, ys, max_distance=None):
+        """Nearest node id of every point, -1 where none is within `max_distance`.
+
+        Defaults to `SPATIAL_SNAP_DISTANCE`, or no limit if that is 0.
+        """
+        if max_distance is None:
+            max_distance = settings.SPATIAL_SNAP_DISTANCE or None
+        node_ids, _ = self.nearest(xs, ys, k=1, max_distance=max_distance)
+        return node_ids[:, 0]
+
+    def stats(self):
+        self._ensure_ready()
+        return {
+            "nodes": len(self.slots),
+            "cell_size": self.cell,
+            "cells": self.nx * self.ny,
+            "max_per_cell": int(self.counts.max()),
+            "rebuilds": self.rebuilds,
+            "fallback_queries": self.fallbacks,
+        }
+
+
+# Create a global spatial index instance; it is built on first use
+spatial_index = SpatialIndex()
@@ -0,0 +1,501 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import case, insert, literal, select, update
+
+from app.core.cluster import RequestRejected, cluster
+from app.core.config import settings
+from app.core.mqtt import get_mqtt_client
+from app.db.session import SessionLocal
+from app.models.warhouse import Task, TaskEvent, TaskStatus
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = (TaskStatus.PENDING, TaskStatus.IN_PROGRESS)
+
+# Event -> status it moves the task to. Robots send the first four on
+# robot/<id>/task; the others come from the scheduler, the API and timeouts.
+EVENTS = {
+    "started": TaskStatus.IN_PROGRESS,
+    "progress": TaskStatus.IN_PROGRESS,
+    "completed": TaskStatus.COMPLETED,
+    "failed": TaskStatus.FAILED,
+    "assigned": TaskStatus.IN_PROGRESS,
+    "cancelled": TaskStatus.FAILED,
+    "timeout": TaskStatus.FAILED,
+}
+ROBOT_EVENTS = ("started", "progress", "completed", "failed")
+
+# Allowed status changes; completed and failed tasks are final
+TRANSITIONS = {
+    TaskStatus.PENDING: (TaskStatus.IN_PROGRESS, TaskStatus.FAILED),
+    TaskStatus.IN_PROGRESS: (TaskStatus.IN_PROGRESS, TaskStatus.COMPLETED, TaskStatus.FAILED),
+}
+
+
+class TaskTransitionError(ValueError):
+    """Raised for events that do not fit the current state of a task"""
+
+
+class _ActiveTask:
+    __slots__ = ("id", "start_node_id", "end_node_id", "robot_id", "status", "updated_at")
+
+    def __init__(self, id, start_node_id, end_node_id, robot_id, status, updated_at):
+        self.id = id
+        self.start_node_id = start_node_id
+        self.end_node_id = end_node_id
+        self.robot_id = robot_id
+        self.status = status
+        self.updated_at = updated_at
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "start_node_id": self.start_node_id,
+            "end_node_id": self.end_node_id,
+            "robot_id": self.robot_id,
+            "status": self.status,
+            "updated_at": self.updated_at,
+        }
+
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+class TaskEngine:
+    """Moves tasks through PENDING -> IN_PROGRESS -> COMPLETED / FAILED.
+
+    Pending and in-progress tasks are kept in memory, indexed by robot and
+    by status, so the scheduler, the API and the robots' progress events
+    never scan the `tasks` table. Transitions are validated and applied to
+    the index right away, then written by a background thread in batches:
+    one UPDATE per flush for the tasks and one insert for their
+    `task_events` history. In-progress tasks without any event for
+    `TASK_STALL_TIMEOUT_SECONDS` are failed.
+
+    Only the process that receives MQTT messages runs the engine (see
+    `start`); in other cluster workers the index is not maintained and
+    `authoritative` is False, so callers read the database instead and
+    creations and cancellations are forwarded to the leader.
+    """
+
+    def __init__(self, session_factory=SessionLocal, stall_timeout=None):
+        self._session_factory = session_factory
+        self.stall_timeout = stall_timeout or settings.TASK_STALL_TIMEOUT_SECONDS
+        self.flush_size = settings.TASK_FLUSH_SIZE
+        self.flush_interval = settings.TASK_FLUSH_INTERVAL_SECONDS
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._tasks = {}  # task id -> _ActiveTask
+        self._by_robot = {}  # robot id -> set of task ids
+        self._by_status = {status: set() for status in ACTIVE}
+        self._changes = []  # (task id, robot id, status, event, detail, timestamp)
+        self._thread = None
+        self._running = False
+        self.events = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.flushes = 0
+        self.failures = 0
+
+    @property
+    def authoritative(self):
+        return self._thread is not None
+
+    # Index
+
+    def _index(self, task):
+        self._tasks[task.id] = task
+        self._by_status[task.status].add(task.id)
+        if task.robot_id is not None:
+            self._by_robot.setdefault(task.robot_id, set()).add(task.id)
+
+    def _unindex(self, task):
+        self._tasks.pop(task.id, None)
+        self._by_status[task.status].discard(task.id)
+        if task.robot_id is not None:
+            tasks = self._by_robot.get(task.robot_id)
+            if tasks is not None:
+                tasks.discard(task.id)
+                if not tasks:
+                    del self._by_robot[task.robot_id]
+
+    def _load_tasks(self, session, *criteria):
+        now = time.time()
+        rows = (
+            session.query(Task.id, Task.start_node_id, Task.end_node_id, Task.robot_id, Task.status)
+            .filter(Task.status.in_(ACTIVE), *criteria)
+            .all()
+        )
+        return [_ActiveTask(*row, updated_at=now) for row in rows]
+
+    def load(self):
+        """(Re)build the index from the active tasks in the database"""
+        session = self._session_factory()
+        try:
+            tasks = self._load_tasks(session)
+        finally:
+            session.close()
+        with self._lock:
+            self._tasks = {}
+            self._by_robot = {}
+            self._by_status = {status: set() for status in ACTIVE}
+            for task in tasks:
+                self._index(task)
+        logger.info(f"Loaded {len(tasks)} active tasks")
+
+    def _refresh(self, task_id):
+        """Re-read one task, e.g. one created or changed by another worker"""
+        session = self._session_factory()
+        try:
+            tasks = self._load_tasks(session, Task.id == task_id)
+        finally:
+            session.close()
+        with self._lock:
+            current = self._tasks.get(task_id)
+            if current is not None:
+                self._unindex(current)
+            for task in tasks:
+                self._index(task)
+
+    # Transitions
+
+    def _transition_locked(self, task_id, event, robot_id=None, detail=None):
+        task = self._tasks.get(task_id)
+        if task is None:
+            raise TaskTransitionError(f"Task {task_id} is not pending or in progress")
+        status = EVENTS[event]
+        if status not in TRANSITIONS[task.status]:
+            raise TaskTransitionError(
+                f"Task {task_id} cannot go from {task.status.value} to {status.value}"
+            )
+        if event in ROBOT_EVENTS and task.robot_id is None:
+            # Only the scheduler hands out tasks
+            raise TaskTransitionError(f"Task {task_id} is not assigned to a robot")
+        if robot_id is not None and task.robot_id not in (None, robot_id):
+            raise TaskTransitionError(f"Task {task_id} is assigned to robot {task.robot_id}")
+
+        now = time.time()
+        changed = status != task.status or (robot_id is not None and robot_id != task.robot_id)
+        self._unindex(task)
+        task.status = status
+        if robot_id is not None:
+            task.robot_id = robot_id
+        task.updated_at = now
+        if status in ACTIVE:
+            self._index(task)
+        if changed:
+            # Progress reports only keep the task alive; they are not history
+            self._changes.append((task_id, task.robot_id, status, event, detail, now))
+            if len(self._changes) >= self.flush_size:
+                self._wakeup.notify()
+        return task.as_dict()
+
+    def transition(self, task_id, event, robot_id=None, detail=None):
+        """Apply an event to an active task; returns the task's new state.
+
+        Raises TaskTransitionError if the task is not active, the event is
+        not allowed from its current status, or it belongs to another robot
+        (or, for robot events, to none).
+        """
+        self.events += 1
+        try:
+            with self._lock:
+                return self._transition_locked(task_id, event, robot_id, detail)
+        except TaskTransitionError:
+            # Another worker may have created, assigned or changed it in the
+            # database; check once, unless our own newer state is unwritten
+            with self._lock:
+                task = self._tasks.get(task_id)
+                stale = task is None or (task.robot_id is None and event in ROBOT_EVENTS)
+                if not stale or any(change[0] == task_id for change in self._changes):
+                    raise
+            self._refresh(task_id)
+            with self._lock:
+                return self._transition_locked(task_id, event, robot_id, detail)
+
+    def handle_message(self, topic, payload):
+        """MQTT handler for robot/<id>/task progress events (JSON)"""
+        robot_id = topic.split("/")[1]
+        try:
+            data = json.loads(payload)
+            task_id = int(data["task_id"])
+            event = data["event"]
+            if event not in ROBOT_EVENTS:
+                raise ValueError(f"unknown event {event!r}")
+            self.transition(task_id, event, robot_id=int(robot_id), detail=data.get("reason"))
+        except (ValueError, KeyError, TypeError) as e:
+            self.rejected += 1
+            logger.warning(f"Rejected task event from robot {robot_id}: {e}")
+
+    def record_assignments(self, assignments):
+        """Index tasks the scheduler just assigned, given (task id, robot id) pairs"""
+        if not self.authoritative:
+            return
+        for task_id, robot_id in assignments:
+            try:
+                self.transition(task_id, "assigned", robot_id=robot_id)
+            except TaskTransitionError as e:
+                logger.warning(f"Could not record assignment: {e}")
+
+    def _expire_stalled(self):
+        deadline = time.time() - self.stall_timeout
+        with self._lock:
+            stalled = [
+                task_id
+                for task_id in self._by_status[TaskStatus.IN_PROGRESS]
+                if self._tasks[task_id].updated_at < deadline
+            ]
+            for task_id in stalled:
+                self._transition_locked(task_id, "timeout", detail=f"No progress for {self.stall_timeout:g} s")
+        if stalled:
+            self.timeouts += len(stalled)
+            logger.warning(f"Failed {len(stalled)} stalled tasks")
+
+    # Writes
+
+    def create(self, tasks):
+        """Insert new pending tasks given as (start node id, end node id) pairs.
+
+        In cluster mode a worker without the engine asks the leader, so the
+        new tasks land in the leader's index; raises ConnectionError if the
+        leader cannot be reached.
+        """
+        if not self.authoritative and settings.CLUSTER_ENABLED:
+            return cluster.request("create_tasks", tasks=[list(task) for task in tasks])
+        now = time.time()
+        session = self._session_factory()
+        try:
+            rows = [Task(start_node_id=start, end_node_id=end, status=TaskStatus.PENDING) for start, end in tasks]
+            session.add_all(rows)
+            session.flush()
+            session.execute(
+                insert(TaskEvent),
+                [
+                    {"task_id": row.id, "status": TaskStatus.PENDING, "event": "created", "recorded_at": _timestamp(now)}
+                    for row in rows
+                ],
+            )
+            session.commit()
+            created = [_ActiveTask(row.id, row.start_node_id, row.end_node_id, None, TaskStatus.PENDING, now) for row in rows]
+        finally:
+            session.close()
+        if self.authoritative:
+            with self._lock:
+                for task in created:
+                    self._index(task)
+        return [task.as_dict() for task in created]
+
+    def cancel(self, task_id, reason=None):
+        """Fail an active task on behalf of an operator.
+
+        In cluster mode a worker without the engine asks the leader, so the
+        leader's index and its pending writes see the cancellation; raises
+        ConnectionError if the leader cannot be reached.
+        """
+        if self.authoritative:
+            task = self.transition(task_id, "cancelled", detail=reason)
+            self.flush()
+            return task
+        if settings.CLUSTER_ENABLED:
+            try:
+                return cluster.request("cancel_task", task_id=task_id, reason=reason)
+            except RequestRejected as e:
+                raise TaskTransitionError(str(e))
+        # No engine running anywhere: write straight through
+        session = self._session_factory()
+        try:
+            row = session.query(Task).filter(Task.id == task_id).with_for_update().one_or_none()
+            if row is None or row.status not in ACTIVE:
+                raise TaskTransitionError(f"Task {task_id} is not pending or in progress")
+            row.status = TaskStatus.FAILED
+            session.add(
+                TaskEvent(
+                    task_id=task_id,
+                    robot_id=row.robot_id,
+                    status=TaskStatus.FAILED,
+                    event="cancelled",
+                    detail=reason,
+                    recorded_at=_timestamp(time.time()),
+                )
+            )
+            session.commit()
+            return {
+                "id": row.id,
+                "start_node_id": row.start_node_id,
+                "end_node_id": row.end_node_id,
+                "robot_id": row.robot_id,
+                "status": row.status,
+                "updated_at": None,
+            }
+        finally:
+            session.close()
+
+    def _create_request(self, message):
+        """Cluster handler for creations forwarded by other workers"""
+        tasks = self.create([tuple(task) for task in message["tasks"]])
+        return [{**task, "status": task["status"].value} for task in tasks]
+
+    def _cancel_request(self, message):
+        """Cluster handler for cancellations forwarded by other workers"""
+        task = self.cancel(message["task_id"], message.get("reason"))
+        return {**task, "status": task["status"].value}
+
+    def flush(self):
+        """Write out the transitions applied so far; returns how many"""
+        with self._flush_lock:
+            with self._lock:
+                changes, self._changes = self._changes, []
+            if not changes:
+                return 0
+            # Only the latest state of each task goes into its row
+            latest = {}
+            for task_id, robot_id, status, _, _, _ in changes:
+                latest[task_id] = (robot_id, status)
+            session = self._session_factory()
+            try:
+                # Rows another worker already finished are left alone, along
+                # with their history; the tasks are dropped from the index below
+                live = set(
+                    session.execute(
+                        select(Task.id).where(Task.id.in_(latest), Task.status.in_(ACTIVE)).with_for_update()
+                    ).scalars()
+                )
+                ended = [task_id for task_id in latest if task_id not in live]
+                if ended:
+                    changes = [change for change in changes if change[0] in live]
+                    latest = {task_id: state for task_id, state in latest.items() if task_id in live}
+                if not latest:
+                    session.commit()
+                    self._drop_ended(ended)
+                    return 0
+                assigned = {task_id: robot_id for task_id, (robot_id, _) in latest.items() if robot_id is not None}
+                # Literals carry the column type so the enum is stored by name
+                status_type = Task.__table__.c.status.type
+                values = {
+                    "status": case(
+                        {task_id: literal(status, status_type) for task_id, (_, status) in latest.items()},
+                        value=Task.id,
+                    )
+                }
+                if assigned:
+                    values["robot_id"] = case(assigned, value=Task.id, else_=Task.robot_id)
+                session.execute(
+                    update(Task)
+                    .where(Task.id.in_(latest), Task.status.in_(ACTIVE))
+                    .values(**values)
+                    .execution_options(synchronize_session=False)
+                )
+                session.execute(
+                    insert(TaskEvent),
+                    [
+                        {
+                            "task_id": task_id,
+                            "robot_id": robot_id,
+                            "status": status,
+                            "event": event,
+                            "detail": detail,
+                            "recorded_at": _timestamp(at),
+                        }
+                        for task_id, robot_id, status, event, detail, at in changes
+                    ],
+                )
+                session.commit()
+            except Exception:
+                session.rollback()
+                self.failures += 1
+                with self._lock:
+                    self._changes[:0] = changes
+                raise
+            finally:
+                session.close()
+            self._drop_ended(ended)
+            self.flushes += 1
+            return len(changes)
+
+    def _drop_ended(self, task_ids):
+        if not task_ids:
+            return
+        with self._lock:
+            for task_id in task_ids:
+                task = self._tasks.get(task_id)
+                if task is not None:
+                    self._unindex(task)
+        logger.warning(f"Discarded changes to {len(task_ids)} tasks already finished elsewhere")
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._running and len(self._changes) < self.flush_size:
+                    self._wakeup.wait(self.flush_interval)
+                running = self._running
+            try:
+                self._expire_stalled()
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Task engine flush failed: {e}")
+                if running:
+                    time.sleep(self.flush_interval)
+            if not running:
+                return
+
+    def start(self):
+        if self._thread is None:
+            self.load()
+            get_mqtt_client().register_handler("robot/+/task", self.handle_message, lane="acks")
+            cluster.on_request("create_tasks", self._create_request)
+            cluster.on_request("cancel_task", self._cancel_request)
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="task-engine", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flush thread after writing out pending transitions"""
+        if self._thread is not None:
+            with self._lock:
+                self._running = False
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+            get_mqtt_client().unregister_handler("robot/+/task", self.handle_message, lane="acks")
+
+    # Queries
+
+    def get(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return None if task is None else task.as_dict()
+
+    def active(self, status=None, robot_id=None):
+        """Pending and in-progress tasks, optionally by status and robot"""
+        with self._lock:
+            if robot_id is not None:
+                ids = self._by_robot.get(robot_id, set())
+                if status is not None:
+                    ids = ids & self._by_status.get(status, set())
+            elif status is not None:
+                ids = self._by_status.get(status, set())
+            else:
+                ids = self._tasks
+            return [self._tasks[task_id].as_dict() for task_id in sorted(ids)]
+
+    def stats(self):
+        return {
+            "pending": len(self._by_status[TaskStatus.PENDING]),
+            "in_progress": len(self._by_status[TaskStatus.IN_PROGRESS]),
+            "unflushed": len(self._changes),
+            "events": self.events,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "flushes": self.flushes,
+            "failures": self.failures,
+        }
+
+
+# Create a global task engine instance
+task_engine = TaskEngine()
@@ -0,0 +1,302 @@
+import csv
+import io
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from sqlalchemy import case, insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.core.config import settings
+from app.core.telemetry import telemetry_store
+from app.db.session import SessionLocal
+from app.models.telemetry import TelemetryRollup, TelemetrySample
+from app.models.warhouse import Robot
+from app.services.graph import warehouse_graph
+from app.services.spatial_index import spatial_index
+
+logger = logging.getLogger(__name__)
+
+# Rollup bucket widths in seconds
+ROLLUP_RESOLUTIONS = (1, 60)
+
+_SAMPLE_COLUMNS = ("robot_id", "recorded_at", "x", "y", "battery", "node_id")
+
+_UPSERT_DIALECTS = {"postgresql": postgresql, "sqlite": sqlite}
+
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+def rollup(samples, resolutions=ROLLUP_RESOLUTIONS):
+    """Aggregate samples into (robot_id, resolution, bucket_start) rows"""
+    buckets = {}
+    for robot_id, recorded_at, x, y, battery, node_id in samples:
+        for resolution in resolutions:
+            key = (robot_id, resolution, recorded_at - recorded_at % resolution)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = {
+                    "samples": 0,
+                    "battery_sum": 0.0,
+                    "battery_samples": 0,
+                    "battery_min": None,
+                    "last": -1.0,
+                }
+            bucket["samples"] += 1
+            if battery is not None:
+                bucket["battery_sum"] += battery
+                bucket["battery_samples"] += 1
+                if bucket["battery_min"] is None or battery < bucket["battery_min"]:
+                    bucket["battery_min"] = battery
+            if recorded_at >= bucket["last"]:
+                bucket["last"] = recorded_at
+                bucket["x"], bucket["y"], bucket["node_id"] = x, y, node_id
+
+    rows = []
+    for (robot_id, resolution, bucket_start), bucket in buckets.items():
+        del bucket["last"]
+        bucket.update(
+            robot_id=robot_id,
+            resolution=resolution,
+            bucket_start=_timestamp(bucket_start),
+        )
+        rows.append(bucket)
+    return rows
+
+
+class TelemetryWriter:
+    """Persist position reports to the database in batches.
+
+    Every update to the telemetry store is appended to an in-memory buffer,
+    which a background thread flushes whenever it reaches `flush_size`
+    samples or `flush_interval` seconds have passed. Each flush is one
+    transaction: the raw samples go into the append-only `telemetry_samples`
+    table with a single COPY (a multi-row INSERT on other databases), the
+    1 s and 1 min rollups are merged with one upsert, and the latest battery
+    and node of every reporting robot is written with one bulk UPDATE.
+    """
+
+    def __init__(self, session_factory=SessionLocal, flush_size=None, flush_interval=None, max_buffer=None):
+        self._session_factory = session_factory
+        self.flush_size = flush_size or settings.TELEMETRY_FLUSH_SIZE
+        self.flush_interval = flush_interval or settings.TELEMETRY_FLUSH_INTERVAL_SECONDS
+        self.max_buffer = max_buffer or settings.TELEMETRY_BUFFER_MAX
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()  # one flush at a time
+        self._thread = None
+        self._running = False
+
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failures = 0
+        self.last_flush_ms = 0.0
+
+    def record(self, robot_id, record):
+        """Buffer one sample; used as a telemetry store listener"""
+        sample = (
+            robot_id,
+            record["updated_at"],
+            record["x"],
+            record["y"],
+            record["battery"],
+            record["node_id"],
+        )
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                # The database is falling behind; shed the oldest samples
+                # rather than growing without bound
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(sample)
+            if len(self._buffer) >= self.flush_size:
+                self._wakeup.notify()
+
+    def flush(self):
+        """Write out everything buffered so far; returns the number of samples"""
+        with self._flush_lock:
+            with self._lock:
+                samples = list(self._buffer)
+                self._buffer.clear()
+            if not samples:
+                return 0
+
+            started = time.perf_counter()
+            samples = self._snap(samples)
+            session = self._session_factory()
+            try:
+                self._insert_samples(session, samples)
+                self._upsert_rollups(session, rollup(samples))
+                self._update_robots(session, samples)
+                session.commit()
+            except Exception:
+                session.rollback()
+                self.failures += 1
+                with self._lock:
+                    # Put the batch back in front so no samples are lost,
+                    # still respecting the buffer bound
+                    room = max(0, self.max_buffer - len(self._buffer))
+                    self._buffer.extendleft(reversed(samples[-room:] if room else []))
+                raise
+            finally:
+                session.close()
+
+            self.flushes += 1
+            self.written += len(samples)
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            logger.debug(f"Flushed {len(samples)} telemetry samples in {self.last_flush_ms:.1f} ms")
+            return len(samples)
+
+    def _snap(self, samples):
+        """Fill in the node of reports that only carry coordinates, in one batch query"""
+        unsnapped = [i for i, sample in enumerate(samples) if sample[5] is None]
+        if not unsnapped:
+            return samples
+        node_ids = spatial_index.snap(
+            [samples[i][2] for i in unsnapped], [samples[i][3] for i in unsnapped]
+        ).tolist()
+        for i, node_id in zip(unsnapped, node_ids):
+            if node_id >= 0:
+                samples[i] = samples[i][:5] + (node_id,)
+        return samples
+
+    def _insert_samples(self, session, samples):
+        connection = session.connection()
+        if connection.dialect.name == "postgresql":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for robot_id, recorded_at, x, y, battery, node_id in samples:
+                writer.writerow((robot_id, _timestamp(recorded_at).isoformat(), x, y, battery, node_id))
+            buf.seek(0)
+            # COPY through the session's own DBAPI connection, so it is part
+            # of the same transaction as the rollups and robot updates
+            cursor = connection.connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f"COPY {TelemetrySample.__tablename__} ({', '.join(_SAMPLE_COLUMNS)}) "
+                    "FROM STDIN WITH (FORMAT csv)",
+                    buf,
+                )
+            finally:
+                cursor.close()
+        else:
+            session.execute(
+                insert(TelemetrySample),
+                [
+                    {
+                        "robot_id": robot_id,
+                        "recorded_at": _timestamp(recorded_at),
+                        "x": x,
+                        "y": y,
+                        "battery": battery,
+                        "node_id": node_id,
+                    }
+                    for robot_id, recorded_at, x, y, battery, node_id in samples
+                ],
+            )
+
+    def _upsert_rollups(self, session, rows):
+        dialect = _UPSERT_DIALECTS[session.connection().dialect.name]
+        stmt = dialect.insert(TelemetryRollup)
+        table, new = TelemetryRollup.__table__.c, stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.robot_id, table.resolution, table.bucket_start],
+            set_={
+                "samples": table.samples + new.samples,
+                "x": new.x,
+                "y": new.y,
+                "node_id": new.node_id,
+                "battery_sum": table.battery_sum + new.battery_sum,
+                "battery_samples": table.battery_samples + new.battery_samples,
+                "battery_min": case(
+                    (new.battery_min.is_(None), table.battery_min),
+                    (table.battery_min.is_(None), new.battery_min),
+                    (new.battery_min < table.battery_min, new.battery_min),
+                    else_=table.battery_min,
+                ),
+            },
+        )
+        session.execute(stmt, rows)
+
+    def _update_robots(self, session, samples):
+        # Latest report per robot; only numeric ids map to `robots` rows
+        latest = {}
+        for robot_id, recorded_at, _, _, battery, node_id in samples:
+            if robot_id.isdigit():
+                latest[int(robot_id)] = (battery, node_id)
+        if not latest:
+            return
+
+        known_nodes = warehouse_graph.snapshot().index
+        batteries = {robot_id: battery for robot_id, (battery, _) in latest.items() if battery is not None}
+        nodes = {
+            robot_id: node_id
+            for robot_id, (_, node_id) in latest.items()
+            if node_id is not None and node_id in known_nodes
+        }
+        values = {}
+        if batteries:
+            values["battery"] = case(batteries, value=Robot.id, else_=Robot.battery)
+        if nodes:
+            values["current_node_id"] = case(nodes, value=Robot.id, else_=Robot.current_node_id)
+        if not values:
+            return
+        session.execute(
+            update(Robot)
+            .where(Robot.id.in_(set(batteries) | set(nodes)))
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._running and len(self._buffer) < self.flush_size:
+                    self._wakeup.wait(self.flush_interval)
+                running = self._running
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Telemetry flush failed: {e}")
+                if running:
+                    time.sleep(self.flush_interval)
+            if not running:
+                return
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="telemetry-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flush thread after writing out what is still buffered"""
+        if self._thread is not None:
+            with self._lock:
+                self._running = False
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+
+# Create a global telemetry writer instance
+telemetry_writer = TelemetryWriter()
+if settings.TELEMETRY_PERSIST_ENABLED:
+    telemetry_store.add_listener(telemetry_writer.record)
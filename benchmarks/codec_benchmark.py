@@ -0,0 +1,56 @@
+"""Compare decode throughput of JSON and binary position payloads.
+
+Run from the repository root:
+
+    python -m benchmarks.codec_benchmark --frames 200000
+"""
+import argparse
+import json
+import random
+import time
+
+from app.core.codec import decode_positions, encode_position, iter_positions
+
+
+def make_positions(count):
+    return [
+        (random.uniform(0, 5000), random.uniform(0, 5000), random.uniform(0, 100), random.randrange(1000))
+        for _ in range(count)
+    ]
+
+
+def measure(label, count, decode):
+    started = time.perf_counter()
+    decode()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {count / elapsed:>14,.0f} frames/s  ({elapsed * 1000:.1f} ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    positions = make_positions(args.frames)
+    json_payloads = [
+        json.dumps({"x": x, "y": y, "battery": battery, "node_id": node_id}).encode()
+        for x, y, battery, node_id in positions
+    ]
+    binary_payloads = [encode_position(*position) for position in positions]
+    print(
+        f"{args.frames} frames, {sum(map(len, json_payloads)) / args.frames:.0f} bytes as JSON, "
+        f"{len(binary_payloads[0])} bytes as binary"
+    )
+
+    def decode_all(payloads):
+        for payload in payloads:
+            for _ in iter_positions(payload):
+                pass
+
+    measure("json (iter_positions)", args.frames, lambda: decode_all(json_payloads))
+    measure("binary (iter_positions)", args.frames, lambda: decode_all(binary_payloads))
+    measure("binary (decode_positions)", args.frames, lambda: decode_positions(binary_payloads))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,636 @@
+"""Load-test the API and MQTT paths with a simulated robot fleet.
+
+Starts the API in a subprocess with the embedded MQTT broker, connects
+`--robots` simulated robots that publish `robot/<id>/position` and answer
+commands the way `esp32/mqtt.ino` does, and drives the HTTP endpoints from
+`--http-concurrency` keep-alive connections at the same time. Throughput,
+p50/p99 latency and message loss are written as JSON. Run from the
+repository root:
+
+    python -m benchmarks.load_test --robots 200 --duration 30 --output report.json
+
+Pass `--url` and `--broker` to test an already running deployment instead.
+Exits with status 1 when `--max-p99-ms` or `--max-loss` is exceeded, so the
+run can gate a release.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import sys
+import time
+import urllib.parse
+
+API_PREFIX = "/api/v1"
+DEFAULT_MIX = "command=5,fleet_status=2,robot_status=3,led=1,login=0.1"
+LED_ROBOT_ID = "esp32"
+
+# MQTT 3.1.1 control packet types used by the simulated robots
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = (
+    1, 2, 3, 4, 8, 9, 12, 13, 14
+)
+
+
+def percentiles(samples):
+    """Latency summary in milliseconds of a list of durations in seconds"""
+    if not samples:
+        return {"p50": None, "p99": None, "max": None, "mean": None}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        "p50": at(0.50),
+        "p99": at(0.99),
+        "max": round(ordered[-1] * 1000, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack("!H", len(value)) + value
+
+
+def _packet(packet_type, flags, body=b""):
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+async def _read_packet(reader):
+    first = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b""
+    return first >> 4, first & 0x0F, body
+
+
+class SimulatedRobot:
+    """One robot on its own MQTT connection.
+
+    Publishes a JSON position every `1 / rate` seconds and, like the ESP32
+    firmware, answers every command on `robot/<id>/state` with the command's
+    `cid` echoed back.
+    """
+
+    KEEPALIVE = 60
+
+    def __init__(self, robot_id, host, port, rate, username=None, password=None):
+        self.robot_id = robot_id
+        self.host = host
+        self.port = port
+        self.interval = 1 / rate if rate > 0 else None
+        self.username = username
+        self.password = password
+        self.connected = asyncio.Event()
+        self.x = random.uniform(0, 1000)
+        self.y = random.uniform(0, 1000)
+        self.battery = random.uniform(50, 100)
+        self.led_on = False
+
+        # Counters
+        self.positions_published = 0
+        self.commands_received = 0
+        self.delivery_latencies = []  # seconds from HTTP send to arrival here
+        self.error = None
+
+        self._writer = None
+
+    async def run(self, publishing, stop):
+        """Stay connected until `stop` is set, reporting positions while
+        `publishing` is set"""
+        try:
+            reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            await self._connect(reader)
+            tasks = [asyncio.create_task(self._read(reader)), asyncio.create_task(self._ping(stop))]
+            if self.interval is not None:
+                tasks.append(asyncio.create_task(self._publish_positions(publishing)))
+            await stop.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._send(_packet(DISCONNECT, 0))
+            self._writer.close()
+        except (OSError, asyncio.IncompleteReadError, ConnectionError) as e:
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            self.connected.set()
+
+    async def _connect(self, reader):
+        flags = 0x02  # clean session
+        payload = _string(f"loadtest-{self.robot_id}-{os.getpid()}")
+        if self.username is not None:
+            flags |= 0x80
+            payload += _string(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += _string(self.password)
+        self._send(_packet(
+            CONNECT, 0, _string("MQTT") + bytes([4, flags]) + struct.pack("!H", self.KEEPALIVE) + payload
+        ))
+        packet_type, _, body = await _read_packet(reader)
+        if packet_type != CONNACK or body[1] != 0:
+            raise ConnectionError(f"Connection refused with code {body[1] if len(body) > 1 else '?'}")
+        topic = f"robot/{self.robot_id}/commands"
+        self._send(_packet(SUBSCRIBE, 0x02, struct.pack("!H", 1) + _string(topic) + b"\x01"))
+        packet_type, _, _ = await _read_packet(reader)
+        if packet_type != SUBACK:
+            raise ConnectionError(f"Expected SUBACK, got packet type {packet_type}")
+        self.connected.set()
+
+    def _send(self, data):
+        self._writer.write(data)
+
+    def _publish(self, topic, payload):
+        self._send(_packet(PUBLISH, 0, _string(topic) + payload))
+
+    async def _read(self, reader):
+        while True:
+            packet_type, flags, body = await _read_packet(reader)
+            if packet_type != PUBLISH:
+                continue
+            topic_length = struct.unpack_from("!H", body)[0]
+            offset = 2 + topic_length
+            if (flags >> 1) & 0x03:
+                self._send(_packet(PUBACK, 0, body[offset:offset + 2]))
+                offset += 2
+            self._on_command(body[offset:])
+
+    def _on_command(self, payload):
+        received_at = time.time()
+        self.commands_received += 1
+        try:
+            command = json.loads(payload)
+        except ValueError:
+            # Binary commands carry no send time; count them and move on
+            return
+        if isinstance(command.get("sent_at"), (int, float)):
+            self.delivery_latencies.append(received_at - command["sent_at"])
+        changed = False
+        if command.get("command") in ("on", "off"):
+            led_on = command["command"] == "on"
+            changed = led_on != self.led_on
+            self.led_on = led_on
+        reply = {"state": "on" if self.led_on else "off", "status": "success", "changed": changed}
+        if "cid" in command:
+            reply["cid"] = command["cid"]
+        self._publish(f"robot/{self.robot_id}/state", json.dumps(reply).encode())
+
+    async def _publish_positions(self, publishing):
+        topic = f"robot/{self.robot_id}/position"
+        await publishing.wait()
+        # Spread the fleet over the interval instead of publishing in lockstep
+        await asyncio.sleep(random.uniform(0, self.interval))
+        next_at = time.monotonic()
+        while publishing.is_set():
+            self.x += random.uniform(-5, 5)
+            self.y += random.uniform(-5, 5)
+            self.battery = max(0.0, self.battery - 0.001)
+            self._publish(topic, json.dumps(
+                {"x": round(self.x, 2), "y": round(self.y, 2), "battery": round(self.battery, 2)}
+            ).encode())
+            self.positions_published += 1
+            await self._writer.drain()
+            next_at += self.interval
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+
+    async def _ping(self, stop):
+        while not stop.is_set():
+            await asyncio.sleep(self.KEEPALIVE / 2)
+            self._send(_packet(PINGREQ, 0))
+
+
+class HTTPConnection:
+    """Minimal keep-alive HTTP/1.1 client, so the harness needs nothing
+    beyond the standard library"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method, path, body=None, headers=None, content_type="application/json"):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        if body is not None:
+            lines.append(f"Content-Type: {content_type}")
+            lines.append(f"Content-Length: {len(body)}")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b""))
+        try:
+            return await self._response()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise
+
+    async def _response(self):
+        status_line = await self._reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self._reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            body = b"".join(chunks)
+        else:
+            body = await self._reader.readexactly(int(headers.get("content-length", 0)))
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, body
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class HTTPLoad:
+    """Concurrent workers issuing a weighted mix of API requests"""
+
+    def __init__(self, host, port, username, password, robot_ids, mix):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.robot_ids = robot_ids
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.token = None
+        self.latencies = {name: [] for name in self.operations}
+        self.errors = {name: {} for name in self.operations}
+        # Commands the API accepted, by delivery: "sent" ones were published,
+        # "queued" ones will be and "coalesced" ones replaced a queued one
+        self.commands = {"sent": 0, "queued": 0, "coalesced": 0}
+        self.led_confirmed = 0
+        self.led_unconfirmed = 0
+
+    async def login(self, connection):
+        body = urllib.parse.urlencode({"username": self.username, "password": self.password}).encode()
+        status, response = await connection.request(
+            "POST", f"{API_PREFIX}/auth/login", body, content_type="application/x-www-form-urlencoded"
+        )
+        if status == 200:
+            self.token = json.loads(response)["access_token"]
+        return status
+
+    async def _call(self, connection, name):
+        auth = {"Authorization": f"Bearer {self.token}"}
+        if name == "login":
+            return await self.login(connection)
+        if name == "command":
+            robot_id = random.choice(self.robot_ids)
+            body = json.dumps({"command": "move", "sent_at": time.time()}).encode()
+            status, response = await connection.request(
+                "POST", f"{API_PREFIX}/robots/{robot_id}/command", body, auth
+            )
+            if status == 200:
+                delivery = json.loads(response).get("delivery")
+                if delivery in self.commands:
+                    self.commands[delivery] += 1
+            return status
+        if name == "led":
+            body = json.dumps({"state": random.choice(("on", "off"))}).encode()
+            status, response = await connection.request("POST", f"{API_PREFIX}/led/control", body)
+            if status == 200:
+                if json.loads(response).get("confirmed"):
+                    self.led_confirmed += 1
+                else:
+                    self.led_unconfirmed += 1
+            return status
+        if name == "fleet_status":
+            status, _ = await connection.request("GET", f"{API_PREFIX}/robots/status", headers=auth)
+            return status
+        if name == "robot_status":
+            robot_id = random.choice(self.robot_ids)
+            status, _ = await connection.request(
+                "GET", f"{API_PREFIX}/robots/{robot_id}/status", headers=auth
+            )
+            return status
+        raise ValueError(f"Unknown operation {name}")
+
+    async def worker(self, deadline):
+        connection = HTTPConnection(self.host, self.port)
+        try:
+            while time.monotonic() < deadline:
+                name = random.choices(self.operations, self.weights)[0]
+                started = time.perf_counter()
+                try:
+                    status = await self._call(connection, name)
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - started
+                # A robot the fleet status has not seen yet is a 404, not a failure
+                if status == 200 or (name == "robot_status" and status == 404):
+                    self.latencies[name].append(elapsed)
+                else:
+                    errors = self.errors[name]
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+        finally:
+            connection.close()
+
+    def report(self, elapsed):
+        by_operation = {}
+        for name in self.operations:
+            count = len(self.latencies[name])
+            by_operation[name] = {
+                "requests": count,
+                "errors": self.errors[name],
+                "throughput_rps": round(count / elapsed, 1),
+                "latency_ms": percentiles(self.latencies[name]),
+            }
+        every_latency = [value for samples in self.latencies.values() for value in samples]
+        return {
+            "requests": len(every_latency),
+            "errors": sum(sum(errors.values()) for errors in self.errors.values()),
+            "throughput_rps": round(len(every_latency) / elapsed, 1),
+            "latency_ms": percentiles(every_latency),
+            "by_operation": by_operation,
+        }
+
+
+_METRIC_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+
+async def scrape_metrics(host, port):
+    """{(name, labels): value} from the API's /metrics endpoint, or None"""
+    connection = HTTPConnection(host, port)
+    try:
+        status, body = await connection.request("GET", "/metrics")
+    except OSError:
+        return None
+    finally:
+        connection.close()
+    if status != 200:
+        return None
+    values = {}
+    for line in body.decode().splitlines():
+        match = _METRIC_LINE.match(line)
+        if match:
+            values[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return values
+
+
+def _metric_delta(before, after, name, labels):
+    if before is None or after is None:
+        return None
+    return after.get((name, labels), 0) - before.get((name, labels), 0)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def ensure_user(username, password):
+    """Create the schema and the benchmark login in the configured database
+    if they are missing"""
+    from app.core.security import get_password_hash
+    from app.db.init_db import init_db
+    from app.db.session import SessionLocal
+    from app.models.user import User
+
+    init_db()
+    with SessionLocal() as db:
+        if db.query(User).filter(User.username == username).first() is None:
+            db.add(User(username=username, hashed_password=get_password_hash(password), role="admin"))
+            db.commit()
+
+
+async def _wait_until(check, timeout, what, server=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"The API exited with status {server.returncode} during startup")
+        try:
+            if await check():
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {what}")
+
+
+def start_server(http_port, broker_port):
+    env = dict(
+        os.environ,
+        MQTT_TRANSPORT="embedded",
+        MQTT_EMBEDDED_HOST="127.0.0.1",
+        MQTT_PORT=str(broker_port),
+        MQTT_ALLOW_ANONYMOUS="true",
+    )
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--host", "127.0.0.1", "--port", str(http_port), "--log-level", "warning",
+        ],
+        env=env,
+    )
+
+
+async def run(args):
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        http_host, http_port = url.hostname, url.port or 80
+        broker_host, _, broker_port = args.broker.partition(":")
+        broker_port = int(broker_port or 1883)
+        server = None
+    else:
+        http_host, http_port = "127.0.0.1", _free_port()
+        broker_host, broker_port = "127.0.0.1", _free_port()
+        ensure_user(args.username, args.password)
+        server = start_server(http_port, broker_port)
+
+    try:
+        async def api_ready():
+            connection = HTTPConnection(http_host, http_port)
+            try:
+                return (await connection.request("GET", "/"))[0] == 200
+            finally:
+                connection.close()
+
+        async def broker_ready():
+            _, writer = await asyncio.open_connection(broker_host, broker_port)
+            writer.close()
+            return True
+
+        await _wait_until(api_ready, args.startup_timeout, "the API", server)
+        await _wait_until(broker_ready, args.startup_timeout, "the MQTT broker", server)
+        return await _run_load(args, http_host, http_port, broker_host, broker_port)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+
+
+async def _run_load(args, http_host, http_port, broker_host, broker_port):
+    robot_ids = [str(index) for index in range(1, args.robots + 1)]
+    robots = [
+        SimulatedRobot(robot_id, broker_host, broker_port, args.rate, args.mqtt_username, args.mqtt_password)
+        for robot_id in robot_ids
+    ]
+    # Answers /led/control like the ESP32 on the bench; it does not report positions
+    led_robot = SimulatedRobot(LED_ROBOT_ID, broker_host, broker_port, 0, args.mqtt_username, args.mqtt_password)
+
+    publishing = asyncio.Event()
+    stop = asyncio.Event()
+    robot_tasks = [asyncio.create_task(robot.run(publishing, stop)) for robot in robots + [led_robot]]
+    connect_started = time.perf_counter()
+    await asyncio.gather(*(robot.connected.wait() for robot in robots + [led_robot]))
+    connect_seconds = time.perf_counter() - connect_started
+    connected = [robot for robot in robots if robot.error is None]
+
+    mix = dict(
+        (name, float(weight))
+        for name, _, weight in (item.partition("=") for item in args.mix.split(","))
+    )
+    load = HTTPLoad(http_host, http_port, args.username, args.password, robot_ids, mix)
+    login_connection = HTTPConnection(http_host, http_port)
+    login_status = await load.login(login_connection)
+    login_connection.close()
+    if login_status != 200:
+        raise RuntimeError(f"Login as {args.username} failed with status {login_status}")
+
+    metrics_before = await scrape_metrics(http_host, http_port)
+    publishing.set()
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(load.worker(deadline) for _ in range(args.http_concurrency)))
+    publishing.clear()
+    elapsed = time.monotonic() - started
+    published = sum(robot.positions_published for robot in robots)
+
+    # Let in-flight commands and positions arrive before counting losses
+    await asyncio.sleep(args.drain)
+    metrics_after = await scrape_metrics(http_host, http_port)
+    stop.set()
+    await asyncio.gather(*robot_tasks)
+
+    received_positions = _metric_delta(
+        metrics_before, metrics_after, "nest_mqtt_messages_received_total", 'topic="robot/+/position"'
+    )
+    # Each queued command leaves one message behind, whatever replaced it
+    commands_expected = load.commands["sent"] + load.commands["queued"]
+    commands_received = sum(robot.commands_received for robot in robots)
+    delivery = [value for robot in robots for value in robot.delivery_latencies]
+    led_total = load.led_confirmed + load.led_unconfirmed
+
+    report = {
+        "config": {
+            "robots": args.robots,
+            "position_rate_hz": args.rate,
+            "http_concurrency": args.http_concurrency,
+            "duration_s": args.duration,
+            "mix": mix,
+            "target": args.url or "embedded",
+        },
+        "elapsed_s": round(elapsed, 3),
+        "http": load.report(elapsed),
+        "mqtt": {
+            "robots_connected": len(connected),
+            "connect_s": round(connect_seconds, 3),
+            "connect_errors": sorted({robot.error for robot in robots if robot.error}),
+            "positions_published": published,
+            "positions_per_s": round(published / elapsed, 1),
+            # Counted by the API's /metrics; null when metrics are disabled
+            "positions_received": received_positions,
+            "position_loss": (
+                round(max(0.0, 1 - received_positions / published), 6)
+                if received_positions is not None and published else None
+            ),
+            "commands_sent": load.commands["sent"],
+            "commands_queued": load.commands["queued"],
+            "commands_coalesced": load.commands["coalesced"],
+            "commands_received": commands_received,
+            "command_loss": (
+                round(max(0.0, 1 - commands_received / commands_expected), 6) if commands_expected else None
+            ),
+            "command_delivery_ms": percentiles(delivery),
+            "led_confirmed": load.led_confirmed,
+            "led_unconfirmed": load.led_unconfirmed,
+            "led_loss": round(load.led_unconfirmed / led_total, 6) if led_total else None,
+        },
+    }
+    return report
+
+
+def check_thresholds(report, max_p99_ms, max_loss):
+    """Names of the limits the report exceeds"""
+    failures = []
+    p99 = report["http"]["latency_ms"]["p99"]
+    if max_p99_ms is not None and p99 is not None and p99 > max_p99_ms:
+        failures.append(f"http p99 {p99} ms > {max_p99_ms} ms")
+    if max_loss is not None:
+        for key in ("position_loss", "command_loss", "led_loss"):
+            loss = report["mqtt"][key]
+            if loss is not None and loss > max_loss:
+                failures.append(f"{key} {loss} > {max_loss}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--robots", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=5, help="position reports per robot per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of HTTP load")
+    parser.add_argument("--http-concurrency", type=int, default=16)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="relative weights of the HTTP operations")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for in-flight messages")
+    parser.add_argument("--url", help="API of a running deployment, e.g. http://localhost:8000")
+    parser.add_argument("--broker", default="localhost:1883", help="MQTT broker used with --url")
+    parser.add_argument("--username", default="loadtest")
+    parser.add_argument("--password", default="loadtest")
+    parser.add_argument("--mqtt-username")
+    parser.add_argument("--mqtt-password")
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--max-p99-ms", type=float)
+    parser.add_argument("--max-loss", type=float)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    report["failures"] = check_thresholds(report, args.max_p99_ms, args.max_loss)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(1 if report["failures"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -79,16 +79,20 @@ void callback(char* topic, byte* payload, unsigned int length) {
     Serial.println("LED turned OFF");
   }
 
-  // Publish state confirmation
-  if (state_changed) {
-    StaticJsonDocument<100> state_doc;
-    state_doc["state"] = current_led_state ? "on" : "off";
-    state_doc["status"] = "success";
-    
-    char buffer[100];
-    serializeJson(state_doc, buffer);
-    client.publish(state_topic, buffer);
+  // Publish state confirmation for every command, echoing the backend's
+  // correlation id so it can match the reply to the request
+  StaticJsonDocument<160> state_doc;
+  state_doc["state"] = current_led_state ? "on" : "off";
+  state_doc["status"] = "success";
+  state_doc["changed"] = state_changed;
+  const char* cid = doc["cid"];
+  if (cid) {
+    state_doc["cid"] = cid;
   }
+
+  char buffer[160];
+  serializeJson(state_doc, buffer);
+  client.publish(state_topic, buffer);
 }
 
 
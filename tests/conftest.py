@@ -0,0 +1,44 @@
+import os
+
+# Settings are read at import time; point them at a throwaway database
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("ASYNC_DATABASE_URL", "sqlite+aiosqlite://")
+os.environ.setdefault("TELEMETRY_PERSIST_ENABLED", "false")
+
+import pytest  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+from app.db.base import Base  # noqa: E402
+from app.models import telemetry, user, warhouse  # noqa: E402,F401
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def add_nodes(session_factory):
+    """Insert nodes as (id, x, y) and edges as (source_id, target_id, weight_cm)"""
+
+    def add(nodes, edges=()):
+        session = session_factory()
+        try:
+            for node_id, x_pos, y_pos in nodes:
+                session.add(warhouse.Node(id=node_id, name=f"N{node_id}", x_pos=x_pos, y_pos=y_pos))
+            session.flush()
+            for source_id, target_id, weight_cm in edges:
+                session.add(warhouse.Edge(source_id=source_id, target_id=target_id, weight_cm=weight_cm))
+            session.commit()
+        finally:
+            session.close()
+
+    return add
@@ -0,0 +1,46 @@
+from app.mqtt.broker import _AuthThrottle, topic_acl
+
+
+def test_operator_commands_robots_and_reads_positions():
+    acl = topic_acl("operator", "alice")
+    assert acl.can_publish("robot/7/commands")
+    assert not acl.can_publish("robot/7/position")
+    assert acl.can_subscribe("robot/+/position")
+    assert acl.can_subscribe("robot/7/position")
+    assert not acl.can_subscribe("#")
+    assert not acl.can_subscribe("robot/#")
+
+
+def test_robot_is_limited_to_its_own_topics():
+    acl = topic_acl("robot", "7")
+    assert acl.can_publish("robot/7/position")
+    assert acl.can_publish("robot/7/state")
+    assert not acl.can_publish("robot/7/commands")
+    assert not acl.can_publish("robot/8/position")
+    assert acl.can_subscribe("robot/7/commands")
+    assert not acl.can_subscribe("robot/+/commands")
+
+
+def test_wildcards_in_username_grant_nothing():
+    acl = topic_acl("robot", "+")
+    assert not acl.can_publish("robot/7/position")
+    assert not acl.can_subscribe("robot/7/commands")
+
+
+def test_anonymous_and_unknown_roles():
+    anonymous = topic_acl(None, None)
+    assert anonymous.can_publish("robot/7/position")
+    assert not anonymous.can_publish("robot/7/commands")
+    assert not anonymous.can_subscribe("#")
+    unknown = topic_acl("viewer", "bob")
+    assert not unknown.can_publish("robot/7/position")
+    assert not unknown.can_subscribe("robot/7/position")
+
+
+def test_throttle_resets_after_window():
+    throttle = _AuthThrottle(2)
+    throttle.failed("10.0.0.1", 0)
+    throttle.failed("10.0.0.1", 1)
+    assert not throttle.allowed("10.0.0.1", 2)
+    assert throttle.allowed("10.0.0.2", 2)
+    assert throttle.allowed("10.0.0.1", 61)
@@ -0,0 +1,14 @@
+import json
+
+from app.core.codec import PayloadCodec, decode_command, encode_command_binary
+
+
+def test_binary_command_round_trip():
+    command = {"command": "assign_task", "task_id": 1, "start_node_id": 2, "end_node_id": 3}
+    assert decode_command(encode_command_binary(command)) == command
+
+
+def test_out_of_range_argument_falls_back_to_json():
+    command = {"command": "assign_task", "task_id": 2 ** 40, "start_node_id": 2, "end_node_id": 3}
+    assert encode_command_binary(command) is None
+    assert json.loads(PayloadCodec("binary").encode_command("7", command)) == command
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from app.core import command_queue as command_queue_module
+from app.core.command_queue import CommandOutcome, CommandQueue
+
+
+class _Client:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, qos=1, retain=False, future=None):
+        self.published.append(payload)
+        if future is not None:
+            future.set_result(True)
+        return True
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = _Client()
+    monkeypatch.setattr(command_queue_module, "get_mqtt_client", lambda: client)
+    monkeypatch.setattr(command_queue_module.payload_codec, "encode_command", lambda robot_id, command: command["command"])
+    return client
+
+
+def test_zero_burst_disables_limit(client):
+    queue = CommandQueue(rate=5, burst=0, coalesce_types="")
+    outcomes = [queue.submit("alpha", {"command": f"move{i}"}) for i in range(3)]
+    assert outcomes == [CommandOutcome.SENT] * 3
+    assert client.published == ["move0", "move1", "move2"]
+
+
+def test_stop_drops_move_taken_off_queue_before_it(client):
+    # Practically no refill, so the publishing thread never gets a token
+    queue = CommandQueue(rate=0.001, burst=1)
+    try:
+        assert queue.submit("alpha", {"command": "move", "to": 1}) is CommandOutcome.SENT
+        assert queue.submit("alpha", {"command": "move", "to": 2}) is CommandOutcome.QUEUED
+        with queue._lock:
+            robot = queue._queues["alpha"]
+            robot.bucket.tokens = 1
+            (ready,), _ = queue._next_ready()
+
+        # The stop arrives while the popped move is still unpublished
+        stop = threading.Thread(target=queue.submit, args=("alpha", {"command": "stop"}))
+        stop.start()
+        while robot.generation == 0:
+            time.sleep(0.001)
+        robot_id, robot, ticket, generation, command, delivery = ready
+        assert queue._publish(robot_id, robot, ticket, command, generation, delivery) is None
+        stop.join()
+    finally:
+        queue.stop()
+    assert client.published == ["move", "stop"]
+    assert queue.stats()["superseded"] == 1
+
+
+def test_bulk_stop_waits_for_acks(client):
+    queue = CommandQueue(rate=0.001, burst=1, max_depth=1)
+    try:
+        queue.submit("alpha", {"command": "move", "to": 1})
+        queue.submit("alpha", {"command": "move", "to": 2})
+        queue.submit("beta", {"command": "move", "to": 1})
+        statuses = queue.deliver_many(["alpha", "beta"], {"command": "stop"}, timeout=1)
+    finally:
+        queue.stop()
+    # The queued move never goes out after the stop
+    assert statuses == ["acked", "acked"]
+    assert client.published == ["move", "move", "stop", "stop"]
+
+
+def test_bulk_command_queues_behind_earlier_commands(client):
+    queue = CommandQueue(rate=0.001, burst=1, max_depth=1, coalesce_types="")
+    try:
+        queue.submit("alpha", {"command": "move", "to": 1})
+        queue.submit("alpha", {"command": "move", "to": 2})
+        statuses = queue.deliver_many(["alpha", "beta"], {"command": "lift"}, timeout=0.05)
+    finally:
+        queue.stop()
+    assert statuses == ["rejected", "acked"]
+    assert client.published == ["move", "lift"]
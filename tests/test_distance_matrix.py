@@ -0,0 +1,69 @@
+import math
+import os
+
+import pytest
+
+from app.core.cluster import cluster
+from app.core.config import settings
+from app.services.distance_matrix import DistanceMatrix
+from app.services.graph import WarehouseGraph
+
+
+@pytest.fixture
+def clustered(monkeypatch):
+    monkeypatch.setattr(settings, "CLUSTER_ENABLED", True)
+    monkeypatch.setattr(cluster, "is_leader", False)
+    return cluster
+
+
+@pytest.fixture
+def graphs(session_factory, add_nodes):
+    add_nodes([(1, 0, 0), (2, 100, 0), (3, 200, 0)], [(1, 2, 100), (2, 3, 100)])
+    leader_graph = WarehouseGraph(session_factory=session_factory, coordinate_scale=1.0)
+    follower_graph = WarehouseGraph(session_factory=session_factory, coordinate_scale=1.0)
+    leader_graph.load()
+    follower_graph.load()
+    return leader_graph, follower_graph
+
+
+def test_follower_answers_from_graph_until_leader_builds(tmp_path, clustered, graphs):
+    follower = DistanceMatrix(graphs[1], base_path=str(tmp_path / "matrix"))
+    assert follower.distances([1], [3]).tolist() == [[200.0]]
+    assert not os.path.exists(tmp_path / "matrix.meta.json")
+
+
+def test_only_leader_writes_tables(tmp_path, clustered, graphs):
+    leader_graph, follower_graph = graphs
+    base_path = str(tmp_path / "matrix")
+    leader = DistanceMatrix(leader_graph, base_path=base_path)
+    follower = DistanceMatrix(follower_graph, base_path=base_path)
+
+    clustered.is_leader = True
+    assert leader.distances([1], [3]).tolist() == [[200.0]]
+    meta_mtime = os.stat(f"{base_path}.meta.json").st_mtime_ns
+
+    clustered.is_leader = False
+    # The follower's graph diverging must not rebuild or patch the shared files
+    follower_graph.apply_changes([("edge", (1, 2), 10.0), ("node", 4, (300, 0))])
+    assert follower.distances([1], [3]).tolist() == [[200.0]]
+    assert not follower.dist.flags.writeable
+    assert os.stat(f"{base_path}.meta.json").st_mtime_ns == meta_mtime
+
+    # The leader's updates reach the follower through the mapped files
+    clustered.is_leader = True
+    leader_graph.apply_changes([("edge", (2, 3), 50.0)])
+    clustered.is_leader = False
+    assert follower.distances([1], [3]).tolist() == [[150.0]]
+    assert math.isinf(follower.distances([3], [1])[0, 0])
+
+
+def test_build_matches_graph(tmp_path, session_factory, add_nodes):
+    add_nodes(
+        [(1, 0, 0), (2, 100, 0), (3, 200, 0), (4, 100, 100)],
+        [(1, 2, 100), (2, 3, 100), (1, 4, 50), (4, 3, 60), (3, 1, 500)],
+    )
+    graph = WarehouseGraph(session_factory=session_factory, coordinate_scale=1.0)
+    matrix = DistanceMatrix(graph, base_path=str(tmp_path / "matrix"))
+    assert matrix.path(1, 3) == [1, 4, 3]
+    assert matrix.path(3, 2) == [3, 1, 2]
+    assert matrix.distances([1, 3], [3, 2]).tolist() == [[110.0, 100.0], [0.0, 600.0]]
@@ -0,0 +1,38 @@
+import pytest
+
+from app.services.graph import WarehouseGraph
+
+
+@pytest.fixture
+def graph(session_factory, add_nodes):
+    add_nodes([(1, 0, 0), (2, 100, 0), (3, 200, 0)], [(1, 2, 100), (2, 3, 100)])
+    graph = WarehouseGraph(session_factory=session_factory, coordinate_scale=1.0)
+    graph.load()
+    return graph
+
+
+def test_shortest_path(graph):
+    assert graph.shortest_path(1, 3) == ([1, 2, 3], 200.0)
+    assert graph.shortest_path(3, 1) is None
+
+
+def test_node_added_then_updated_in_one_batch(graph):
+    graph.apply_changes([("node", 7, (1, 1)), ("node", 7, (2, 2))])
+    assert graph.snapshot().index[7] == 3
+    assert graph.snapshot().xs[3] == 2
+
+
+def test_edge_added_then_updated_in_one_batch(graph):
+    graph.apply_changes([
+        ("node", 4, (300, 0)),
+        ("edge", (3, 4), 100.0),
+        ("edge", (3, 4), 150.0),
+    ])
+    assert graph.shortest_path(1, 4) == ([1, 2, 3, 4], 350.0)
+
+
+def test_weight_update_patches_snapshot_in_place(graph):
+    csr = graph.snapshot()
+    graph.apply_changes([("edge", (1, 2), 50.0)])
+    assert graph.snapshot() is csr
+    assert graph.shortest_path(1, 3) == ([1, 2, 3], 150.0)
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from app.core.cluster import cluster
+from app.services.graph import WarehouseGraph
+from app.services.map_io import MapImporter
+
+
+class _Channel:
+    def __init__(self):
+        self.sent = []
+
+    def send_invalidation(self, cache, key=None):
+        self.sent.append((cache, key))
+
+
+@pytest.fixture
+def channel():
+    cluster.channel = channel = _Channel()
+    yield channel
+    cluster.channel = None
+
+
+def test_import_invalidates_graph_once_everywhere(session_factory, add_nodes, channel):
+    add_nodes([(1, 0, 0)])
+    graph = WarehouseGraph(session_factory=session_factory, coordinate_scale=1.0)
+    graph.load()
+    notified = []
+    graph.add_listener(notified.append)
+    channel.sent.clear()
+
+    layout = {
+        "nodes": [{"id": 1, "name": "A", "x_pos": 0, "y_pos": 0}, {"id": 2, "name": "B", "x_pos": 100, "y_pos": 0}],
+        "edges": [{"source_id": 1, "target_id": 2, "weight_cm": 100}],
+    }
+    MapImporter(session_factory=session_factory, graph=graph).import_layout([json.dumps(layout).encode()], "json")
+
+    assert notified == [[("reload", None, None, None)]]
+    assert channel.sent == [("graph", None)]
+    assert graph.shortest_path(1, 2) == ([1, 2], 100.0)
@@ -0,0 +1,49 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.core.metrics import route_template, topic_pattern
+from app.core.mqtt import MessageDispatcher
+
+
+def _handler(topic, payload):
+    pass
+
+
+def test_inbound_label_is_matched_subscription():
+    dispatcher = MessageDispatcher(workers=1, queue_size=10)
+    dispatcher.register("robot/+/position", _handler)
+    dispatcher.register("robot/#", _handler)
+    assert dispatcher.match("robot/alpha/position")[0] == "robot/+/position"
+    assert dispatcher.match("robot/beta/position")[0] == "robot/+/position"
+    assert dispatcher.match("robot/alpha/battery/cells")[0] == "robot/#"
+
+
+def test_publish_label_collapses_robot_id():
+    assert topic_pattern("robot/alpha/commands") == "robot/+/commands"
+    assert topic_pattern("robot/17/commands") == "robot/+/commands"
+    assert topic_pattern("fleet/status") == "fleet/status"
+
+
+def test_http_label_is_route_template():
+    app = FastAPI()
+    seen = []
+
+    @app.get("/x/{a}/y/{b}")
+    def repeated(a: int, b: int):
+        pass
+
+    @app.get("/items/{name}")
+    def static_value(name: str):
+        pass
+
+    @app.middleware("http")
+    async def record(request, call_next):
+        response = await call_next(request)
+        seen.append(route_template(request.scope))
+        return response
+
+    client = TestClient(app)
+    client.get("/x/5/y/5")
+    client.get("/items/items")
+    client.get("/nowhere")
+    assert seen == ["/x/{a}/y/{b}", "/items/{name}", "unmatched"]
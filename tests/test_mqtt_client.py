@@ -0,0 +1,26 @@
+import asyncio
+
+from app.core.mqtt import MessageDispatcher
+from app.mqtt.client import _LoopIngress
+
+
+def test_full_block_lane_pauses_reading_instead_of_blocking_loop():
+    dispatcher = MessageDispatcher(workers=1, queue_size=1)
+    handled = []
+    dispatcher.register("robot/+/state", lambda topic, payload: handled.append(payload))
+    events = []
+    ingress = _LoopIngress(dispatcher, lambda: events.append("pause"), lambda: events.append("resume"))
+
+    async def receive():
+        for payload in (b"1", b"2", b"3"):
+            ingress("robot/a/state", payload)  # returns at once even when full
+        assert events == ["pause"]
+        dispatcher.start()
+        while events != ["pause", "resume"]:
+            await asyncio.sleep(0.01)
+
+    try:
+        asyncio.run(asyncio.wait_for(receive(), 5))
+    finally:
+        dispatcher.stop()
+    assert handled == [b"1", b"2", b"3"]
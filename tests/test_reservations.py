@@ -0,0 +1,86 @@
+import pytest
+
+from app.core.cluster import cluster
+from app.core.config import settings
+from app.services.graph import WarehouseGraph
+from app.services.reservations import ReservationPlanner
+
+
+@pytest.fixture
+def graph(session_factory, add_nodes):
+    # A corridor 10 - 20 - 30 with one step per aisle in each direction
+    add_nodes(
+        [(10, 0, 0), (20, 100, 0), (30, 200, 0)],
+        [(10, 20, 100), (20, 10, 100), (20, 30, 100), (30, 20, 100)],
+    )
+    graph = WarehouseGraph(session_factory=session_factory, coordinate_scale=1.0)
+    graph.load()
+    return graph
+
+
+@pytest.fixture
+def planner(graph):
+    # Hour-long steps, so a test never straddles two of them
+    return ReservationPlanner(graph=graph, step_seconds=3600, speed=100 / 3600)
+
+
+def _nodes(planner, robot_id):
+    return [waypoint["node_id"] for waypoint in planner.reservations(robot_id)]
+
+
+def test_plan_reserves_route(planner):
+    (result,) = planner.plan([{"robot_id": "1", "source": 10, "target": 30}])
+    assert result["status"] == "planned"
+    assert [waypoint["node_id"] for waypoint in result["waypoints"]] == [10, 20, 30]
+    assert _nodes(planner, "1") == [10, 20, 30]
+
+
+def test_reservations_survive_node_added_before_them(graph, planner):
+    planner.plan([{"robot_id": "1", "source": 10, "target": 30}])
+    # Node 5 sorts first, so every snapshot index shifts by one
+    graph.apply_changes([("node", 5, (-100, 0))])
+    graph.snapshot()
+    assert _nodes(planner, "1") == [10, 20, 30]
+
+    # Robot 1 still holds node 10 now, so nobody else can start there
+    (result,) = planner.plan([{"robot_id": "2", "source": 10, "target": 20}])
+    assert result["status"] == "no_route"
+
+
+def test_reservations_survive_node_deleted(graph, planner):
+    graph.apply_changes([("node", 5, (-100, 0))])
+    graph.snapshot()
+    planner.plan([{"robot_id": "1", "source": 10, "target": 30}])
+    # Every index shifts down, and the last one no longer exists
+    graph.apply_changes([("node_deleted", 5, None)])
+    graph.snapshot()
+    assert _nodes(planner, "1") == [10, 20, 30]
+    planner.reached("1", 20)
+    assert _nodes(planner, "1") == [20, 30]
+
+
+def test_follower_forwards_to_leader_table(graph, planner, monkeypatch):
+    follower = ReservationPlanner(graph=graph, step_seconds=3600, speed=100 / 3600)
+    handlers = {
+        "plan_routes": lambda message: planner.plan(message["requests"]),
+        "reserved_routes": lambda message: planner.reservations(message["robot_id"]),
+        "release_routes": lambda message: planner.release(message["robot_id"]),
+    }
+
+    def request(op, **fields):
+        # The handler runs on the leader, where nothing is forwarded
+        cluster.is_leader = True
+        try:
+            return handlers[op](fields)
+        finally:
+            cluster.is_leader = False
+
+    monkeypatch.setattr(settings, "CLUSTER_ENABLED", True)
+    monkeypatch.setattr(cluster, "is_leader", False)
+    monkeypatch.setattr(cluster, "request", request)
+
+    follower.plan([{"robot_id": "1", "source": 10, "target": 30}])
+    assert _nodes(planner, "1") == [10, 20, 30]
+    assert _nodes(follower, "1") == [10, 20, 30]
+    assert follower.release("1")
+    assert planner.reservations("1") is None
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from app.core.cluster import cluster
+from app.core.config import settings
+from app.models.warhouse import Task, TaskStatus
+from app.services.task_engine import TaskEngine, TaskTransitionError
+
+
+@pytest.fixture
+def engine(session_factory, add_nodes):
+    add_nodes([(1, 0, 0), (2, 100, 0)])
+    engine = TaskEngine(session_factory=session_factory)
+    engine.create([(1, 2)])
+    engine.load()
+    return engine
+
+
+def _status(session_factory, task_id):
+    session = session_factory()
+    try:
+        return session.get(Task, task_id).status
+    finally:
+        session.close()
+
+
+def test_flush_keeps_status_written_by_another_worker(engine, session_factory):
+    engine.transition(1, "assigned", robot_id=7)
+    engine.transition(1, "completed", robot_id=7)
+    # Cancelled by another worker before this one flushed
+    session = session_factory()
+    session.get(Task, 1).status = TaskStatus.FAILED
+    session.commit()
+    session.close()
+
+    assert engine.flush() == 0
+    assert _status(session_factory, 1) == TaskStatus.FAILED
+    assert engine.get(1) is None
+
+
+def test_robot_cannot_claim_unassigned_task(engine, session_factory):
+    with pytest.raises(TaskTransitionError):
+        engine.transition(1, "started", robot_id=7)
+    engine.handle_message("robot/7/task", json.dumps({"task_id": 1, "event": "started"}))
+    assert engine.rejected == 1
+    assert engine.get(1)["status"] == TaskStatus.PENDING
+
+    # Assigned by a scheduler in another worker: the event is accepted
+    session = session_factory()
+    row = session.get(Task, 1)
+    row.robot_id, row.status = 7, TaskStatus.IN_PROGRESS
+    session.commit()
+    session.close()
+    assert engine.transition(1, "progress", robot_id=7)["robot_id"] == 7
+
+
+def test_follower_creates_tasks_through_leader(engine, session_factory, monkeypatch):
+    follower = TaskEngine(session_factory=session_factory)
+    handlers = {"create_tasks": engine._create_request}
+    monkeypatch.setattr(TaskEngine, "authoritative", property(lambda self: self is engine))
+    monkeypatch.setattr(settings, "CLUSTER_ENABLED", True)
+    monkeypatch.setattr(cluster, "request", lambda op, **fields: handlers[op](json.loads(json.dumps(fields))))
+
+    (task,) = follower.create([(2, 1)])
+    assert task["status"] == TaskStatus.PENDING.value
+    assert engine.get(task["id"])["start_node_id"] == 2
+    assert _status(session_factory, task["id"]) == TaskStatus.PENDING